@@ -7,36 +7,224 @@ converts the response to JSON format, and publishes it to an MQTT broker
 with Home Assistant auto-discovery support.
 """
 
+import argparse
+import asyncio
+import calendar
+import csv
+import datetime
+import hashlib
+import io
 import json
 import logging
+import math
+import pickle
+import re
+import signal
 import socket
+import struct
+import sys
+import threading
 import time
-from datetime import datetime
-from os import environ, path
-from typing import Any, Dict, Optional, Union
-
-import paho.mqtt.client as mqtt
-
-# Configure logging for Home Assistant addon compatibility
-log_level = environ.get("LOG_LEVEL", "INFO").upper()
-logging.basicConfig(
-    level=getattr(logging, log_level, logging.INFO),
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
+from functools import lru_cache
+from os import cpu_count, environ, listdir, makedirs, path, remove, replace
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Union,
 )
+from urllib.parse import parse_qsl, urlsplit
+
+# paho-mqtt and urllib.request are imported when first needed, which keeps
+# imports and `--check` fast on small devices
+if TYPE_CHECKING:
+    from multiprocessing.connection import Connection
+    from multiprocessing.process import BaseProcess
+
+    import paho.mqtt.client as mqtt
+
 logger = logging.getLogger("solarmax-agent")
 
+
+def configure_logging():
+    """Configure logging for Home Assistant addon compatibility."""
+    log_level = environ.get("LOG_LEVEL", "INFO").upper()
+    logging.basicConfig(
+        level=getattr(logging, log_level, logging.INFO),
+        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+
 # Home Assistant addon configuration paths
 CONFIG_PATH = "/data/options.json"
 HASSIO_CONFIG_PATH = "/config/solarmax-agent.json"
 
 
-def load_config() -> Dict[str, Any]:
-    """Load configuration from Home Assistant addon or environment variables."""
+def env_flag(name: str, default: bool = False) -> bool:
+    """Read a boolean flag such as ``true``/``1``/``yes`` from the environment."""
+    value = environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def env_json(name: str) -> Any:
+    """Read a JSON value such as a list of inverters from the environment."""
+    value = environ.get(name)
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError as e:
+        logger.warning(f"Failed to parse {name}: {e}")
+        return None
+
+
+def env_float(name: str) -> Optional[float]:
+    """Read an optional number such as a coordinate from the environment."""
+    value = environ.get(name)
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        logger.warning(f"Failed to parse {name}: {value!r}")
+        return None
+
+
+def parse_addresses(spec: Union[str, int, List[int]]) -> List[int]:
+    """Parse bus addresses given as a list or a string such as ``"1-4,7"``."""
+    if isinstance(spec, int):
+        return [spec]
+    if isinstance(spec, list):
+        return [int(address) for address in spec]
+    addresses: List[int] = []
+    for part in str(spec).split(","):
+        first, _, last = part.strip().partition("-")
+        addresses.extend(range(int(first), int(last or first) + 1))
+    return addresses
+
+
+def expand_addresses(entries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Expand entries with ``addresses`` into one entry per bus address.
+
+    The inverters of such an entry share its gateway (IP and port); a given
+    ``device_id`` is used as prefix of theirs.
+    """
+    expanded = []
+    for entry in entries:
+        if not entry.get("addresses"):
+            expanded.append(entry)
+            continue
+        template = {
+            key: value
+            for key, value in entry.items()
+            if key not in ("addresses", "device_id", "mqtt_topic_prefix")
+        }
+        for address in parse_addresses(entry["addresses"]):
+            inverter = {**template, "address": address}
+            if entry.get("device_id"):
+                inverter["device_id"] = f"{entry['device_id']}_{address:02d}"
+            expanded.append(inverter)
+    return expanded
+
+
+def build_inverter_list(
+    config: Dict[str, Any], entries: Optional[List[Dict[str, Any]]] = None
+) -> List[Dict[str, Any]]:
+    """Expand the configuration into one entry per inverter to poll.
+
+    Without an explicit ``inverters`` list the top-level single-inverter
+    options are used, keeping the original topic layout. With a list, each
+    inverter gets its own device id and topics below ``mqtt_topic_prefix``.
+    """
+    if not entries:
+        return [
+            {
+                "ip": config["inverter_ip"],
+                "port": config["inverter_port"],
+                "address": 1,
+                "device_id": config["device_id"],
+                "device_name": config["device_name"],
+                "mqtt_topic_prefix": config["mqtt_topic_prefix"],
+                "availability_topic": config["availability_topic"],
+                "update_interval": config["update_interval"],
+                "persistent_connection": config.get("persistent_connection", False),
+                "field_intervals": config.get("field_intervals") or {},
+                "installed_power": config.get("installed_power"),
+            }
+        ]
+
+    inverters = []
+    for index, entry in enumerate(expand_addresses(entries), start=1):
+        address = int(entry.get("address", 1))
+        device_id = entry.get("device_id") or f"{config['device_id']}_{address:02d}"
+        topic_prefix = (
+            entry.get("mqtt_topic_prefix")
+            or f"{config['mqtt_topic_prefix']}/{device_id}"
+        )
+        inverters.append(
+            {
+                "ip": entry.get("ip") or config["inverter_ip"],
+                "port": int(entry.get("port") or config["inverter_port"]),
+                "address": address,
+                "device_id": device_id,
+                "device_name": entry.get("device_name")
+                or f"{config['device_name']} {index}",
+                "mqtt_topic_prefix": topic_prefix,
+                "availability_topic": entry.get("availability_topic")
+                or f"{topic_prefix}/availability",
+                "update_interval": int(
+                    entry.get("update_interval") or config["update_interval"]
+                ),
+                "persistent_connection": entry.get(
+                    "persistent_connection",
+                    config.get("persistent_connection", False),
+                ),
+                "field_intervals": entry.get("field_intervals")
+                or config.get("field_intervals")
+                or {},
+                "installed_power": entry.get(
+                    "installed_power", config.get("installed_power")
+                ),
+            }
+        )
+    return inverters
+
+
+def config_file() -> Optional[str]:
+    """Path of the options file the configuration is loaded from, if any."""
+    for file_path in (CONFIG_PATH, HASSIO_CONFIG_PATH):
+        if path.exists(file_path):
+            return file_path
+    return None
+
+
+def load_config(config_path: Optional[str] = None) -> Dict[str, Any]:
+    """Load configuration from Home Assistant addon or environment variables.
+
+    ``config_path`` replaces the default locations of the options file.
+    """
     config = {}
 
+    if config_path is not None:
+        try:
+            with open(config_path, "r") as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to load config file {config_path}: {e}")
+
     # Try Home Assistant addon configuration first
-    if path.exists(CONFIG_PATH):
+    elif path.exists(CONFIG_PATH):
         try:
             with open(CONFIG_PATH, "r") as f:
                 config = json.load(f)
@@ -53,44 +241,152 @@ def load_config() -> Dict[str, Any]:
         except Exception as e:
             logger.warning(f"Failed to load config file: {e}")
 
+    # Additional inverters may be given as a JSON list in the environment
+    inverters = config.get("inverters") or env_json("INVERTERS")
+    # Several inverters chained behind the gateway at inverter_ip
+    addresses = config.get("inverter_addresses") or environ.get("INVERTER_ADDRESSES")
+    if addresses and not inverters:
+        inverters = [{"addresses": addresses}]
+
+    # Per-field or per-group poll intervals, e.g. {"power": 2, "energy": 300}
+    field_intervals = config.get("field_intervals") or env_json("FIELD_INTERVALS")
+
     # Fallback to environment variables with Home Assistant defaults
-    return {
+    result = {
         "inverter_ip": config.get("inverter_ip") or environ.get("INVERTER_IP"),
         "inverter_port": config.get("inverter_port")
         or int(environ.get("INVERTER_PORT", "12345")),
         "update_interval": config.get("update_interval")
         or int(environ.get("UPDATE_TIME", "30")),
+        "persistent_connection": config.get(
+            "persistent_connection", env_flag("PERSISTENT_CONNECTION")
+        ),
+        "bus_timeout": float(
+            config.get("bus_timeout") or environ.get("BUS_TIMEOUT", "2")
+        ),
+        "field_intervals": {
+            key: value for key, value in (field_intervals or {}).items() if value
+        },
+        "extended_fields": config.get("extended_fields", env_flag("EXTENDED_FIELDS")),
+        # Fields not polled, e.g. ["SWV", "TKK"]
+        "disabled_fields": config.get("disabled_fields")
+        or env_json("DISABLED_FIELDS")
+        or [],
+        "adaptive_polling": config.get(
+            "adaptive_polling", env_flag("ADAPTIVE_POLLING")
+        ),
+        "derived_metrics": config.get("derived_metrics", env_flag("DERIVED_METRICS")),
+        "status_events": config.get("status_events", env_flag("STATUS_EVENTS")),
+        "installed_power": config.get("installed_power", env_float("INSTALLED_POWER")),
+        "max_poll_interval": config.get("max_poll_interval")
+        or int(environ.get("MAX_POLL_INTERVAL", "1800")),
+        "latitude": config.get("latitude", env_float("LATITUDE")),
+        "longitude": config.get("longitude", env_float("LONGITUDE")),
+        "publish_on_change": config.get(
+            "publish_on_change", env_flag("PUBLISH_ON_CHANGE")
+        ),
+        "deadbands": config.get("deadbands") or env_json("DEADBANDS") or {},
+        "compact_state": config.get("compact_state", env_flag("COMPACT_STATE")),
+        "keyframe_interval": config.get("keyframe_interval")
+        or int(environ.get("KEYFRAME_INTERVAL", "600")),
+        "log_level": str(
+            config.get("log_level") or environ.get("LOG_LEVEL", "INFO")
+        ).upper(),
+        "remote_config": config.get("remote_config", env_flag("REMOTE_CONFIG")),
+        "workers": int(config.get("workers", environ.get("WORKERS", "1"))),
         "mqtt_host": config.get("mqtt_host")
         or environ.get("MQTT_BROKER_IP", "core-mosquitto"),
         "mqtt_port": config.get("mqtt_port")
         or int(environ.get("MQTT_BROKER_PORT", "1883")),
         "mqtt_username": config.get("mqtt_username") or environ.get("MQTT_USERNAME"),
         "mqtt_password": config.get("mqtt_password") or environ.get("MQTT_PASSWORD"),
+        "mqtt_qos": config.get("mqtt_qos") or int(environ.get("MQTT_QOS", "0")),
+        "mqtt_max_inflight": config.get("mqtt_max_inflight")
+        or int(environ.get("MQTT_MAX_INFLIGHT", "20")),
+        "metrics_port": int(
+            config.get("metrics_port", environ.get("METRICS_PORT", "0")) or 0
+        ),
+        "metrics_host": config.get("metrics_host")
+        or environ.get("METRICS_HOST", "0.0.0.0"),
+        "sinks": config.get("sinks") or env_json("SINKS") or [],
+        "sink_queue_size": config.get("sink_queue_size")
+        or int(environ.get("SINK_QUEUE_SIZE", "1000")),
+        "api_port": int(config.get("api_port", environ.get("API_PORT", "0")) or 0),
+        "api_host": config.get("api_host") or environ.get("API_HOST", "0.0.0.0"),
+        "history_dir": config.get("history_dir", environ.get("HISTORY_DIR", "")),
+        "history_fields": config.get("history_fields") or env_json("HISTORY_FIELDS"),
+        "history_days": config.get("history_days")
+        or float(environ.get("HISTORY_DAYS", "7")),
+        "outbox_dir": config.get("outbox_dir", environ.get("OUTBOX_DIR", "")),
+        "outbox_max_mb": config.get("outbox_max_mb")
+        or int(environ.get("OUTBOX_MAX_MB", "50")),
+        "outbox_max_age_hours": config.get("outbox_max_age_hours")
+        or int(environ.get("OUTBOX_MAX_AGE_HOURS", "168")),
+        "outbox_replay_rate": config.get("outbox_replay_rate")
+        or float(environ.get("OUTBOX_REPLAY_RATE", "5")),
         "mqtt_topic_prefix": config.get("mqtt_topic_prefix")
         or environ.get("MQTT_INVERTER_TOPIC", "homeassistant/sensor/solarmax"),
         "device_name": config.get("device_name", "Solarmax Inverter"),
         "device_id": config.get("device_id", "solarmax_inverter"),
         "home_assistant_discovery": config.get("home_assistant_discovery", True),
         "discovery_prefix": config.get("discovery_prefix", "homeassistant"),
+        "discovery_cache": config.get(
+            "discovery_cache", environ.get("DISCOVERY_CACHE", "")
+        ),
         "availability_topic": config.get(
             "availability_topic", "homeassistant/sensor/solarmax/availability"
         ),
     }
+    result["inverters"] = build_inverter_list(result, inverters)
+    return result
 
 
-# Load configuration
-CONFIG = load_config()
+def check_settings(settings: Dict[str, Any]) -> List[str]:
+    """Return the problems of options to change in the running agent."""
+    problems = []
+    for name, value in settings.items():
+        if name not in RELOADABLE_OPTIONS:
+            problems.append(f"{name} cannot be changed at runtime")
+        elif name in ("update_interval", "keyframe_interval"):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                problems.append(f"{name} must be a number")
+            elif value <= 0:
+                problems.append(f"{name} must be positive")
+        elif name in ("field_intervals", "deadbands"):
+            if not isinstance(value, dict):
+                problems.append(f"{name} must be an object")
+        elif name == "extended_fields":
+            if not isinstance(value, bool):
+                problems.append(f"{name} must be true or false")
+        elif name == "disabled_fields":
+            if not isinstance(value, list) or not all(
+                isinstance(field, str) for field in value
+            ):
+                problems.append(f"{name} must be a list of fields")
+            else:
+                unknown = [
+                    field
+                    for field in value
+                    if field not in FIELD_MAP_INVERTER
+                    and field not in FIELD_MAP_EXTENDED
+                ]
+                if unknown:
+                    problems.append(f"{name} has unknown fields: {', '.join(unknown)}")
+        elif name == "log_level":
+            if str(value).upper() not in LOG_LEVELS:
+                problems.append(f"{name} must be one of {', '.join(LOG_LEVELS)}")
+    return problems
 
-# Validate required configuration
-if not all([CONFIG["inverter_ip"], CONFIG["mqtt_host"]]):
-    logger.error("Missing required configuration: inverter_ip, mqtt_host")
-    exit(1)
 
-logger.info(
-    f"Starting Solarmax Agent with config: "
-    f"inverter={CONFIG['inverter_ip']}:{CONFIG['inverter_port']}, "
-    f"mqtt={CONFIG['mqtt_host']}:{CONFIG['mqtt_port']}"
-)
+def validate_config(config: Dict[str, Any]) -> List[str]:
+    """Return the problems that prevent the agent from starting."""
+    problems = []
+    if not config["mqtt_host"]:
+        problems.append("mqtt_host is not set")
+    for inverter in config["inverters"]:
+        if not inverter["ip"]:
+            problems.append(f"inverter_ip of {inverter['device_id']} is not set")
+    return problems
 
 
 # PAC = "PAC" # AC power (W)
@@ -195,6 +491,19 @@ ALARM_CODES = {
     65536: "Alarm 17",
 }
 
+# Single alarm bits of the SAL bitmask, each published as a binary sensor
+ALARM_BITS = [code for code in ALARM_CODES if code]
+ALARM_MASK = sum(ALARM_BITS)
+
+# Status code reported while the inverter cannot be reached
+NO_COMMUNICATION_STATUS = 20000
+
+# Energy and counter fields keep their last value while the inverter is offline
+COUNTER_FIELDS = ("KDY", "KMT", "KYR", "KT0", "KHR", "CAC")
+
+# Event types published on the events topic when status_events is enabled
+EVENT_TYPES = ["status_change", "alarm_raised", "alarm_cleared"]
+
 # Home Assistant device class mappings for better integration
 DEVICE_CLASSES = {
     "PAC": "power",
@@ -206,12 +515,21 @@ DEVICE_CLASSES = {
     "UL3": "voltage",
     "UD01": "voltage",
     "UD02": "voltage",
+    "UDC": "voltage",
+    "UM1": "voltage",
+    "UM2": "voltage",
+    "UM3": "voltage",
     "IL1": "current",
     "IL2": "current",
     "IL3": "current",
     "IDC": "current",
     "ID01": "current",
     "ID02": "current",
+    "IML1": "current",
+    "IML2": "current",
+    "IML3": "current",
+    "TNF": "frequency",
+    "PIN": "power",
     "KDY": "energy",
     "KMT": "energy",
     "KYR": "energy",
@@ -232,12 +550,28 @@ UNITS_OF_MEASUREMENT = {
     "UL3": "V",
     "UD01": "V",
     "UD02": "V",
+    "UDC": "V",
+    "UM1": "V",
+    "UM2": "V",
+    "UM3": "V",
     "IL1": "A",
     "IL2": "A",
     "IL3": "A",
     "IDC": "A",
     "ID01": "A",
     "ID02": "A",
+    "IML1": "A",
+    "IML2": "A",
+    "IML3": "A",
+    "TNF": "Hz",
+    "PIN": "W",
+    "EFF": "%",
+    "SIMB": "%",
+    "SPY": "kWh/kWp",
+    "EDAY": "Wh",
+    "PMAX": "W",
+    "PAVG": "W",
+    "PRL": "%",
     "KDY": "Wh",
     "KMT": "kWh",
     "KYR": "kWh",
@@ -266,6 +600,21 @@ STATE_CLASSES = {
     "IDC": "measurement",
     "ID01": "measurement",
     "ID02": "measurement",
+    "UDC": "measurement",
+    "UM1": "measurement",
+    "UM2": "measurement",
+    "UM3": "measurement",
+    "IML1": "measurement",
+    "IML2": "measurement",
+    "IML3": "measurement",
+    "TNF": "measurement",
+    "PRL": "measurement",
+    "EFF": "measurement",
+    "SIMB": "measurement",
+    "SPY": "total_increasing",
+    "EDAY": "total_increasing",
+    "PMAX": "measurement",
+    "PAVG": "measurement",
     "KDY": "total_increasing",
     "KMT": "total_increasing",
     "KYR": "total_increasing",
@@ -303,391 +652,3987 @@ FIELD_MAP_INVERTER = {
     "SYS": "status_Code",
 }
 
-# Base request template
-REQUEST_TEMPLATE = "{FB;01;!!|64:&&|$$$$}"
+# Additional registers polled when extended_fields is enabled
+FIELD_MAP_EXTENDED = {
+    "KLD": "Energy_Yesterday (Wh)",
+    "KLM": "Energy_Last_Month (kWh)",
+    "KLY": "Energy_Last_Year (kWh)",
+    "UDC": "DC_Voltage (V)",
+    "UM1": "AC_Voltage_10min_Phase_1 (V)",
+    "UM2": "AC_Voltage_10min_Phase_2 (V)",
+    "UM3": "AC_Voltage_10min_Phase_3 (V)",
+    "IML1": "AC_Current_Mean_Phase_1 (A)",
+    "IML2": "AC_Current_Mean_Phase_2 (A)",
+    "IML3": "AC_Current_Mean_Phase_3 (A)",
+    "IED": "DC_Fault_Current",
+    "IEE": "AC_Fault_Current",
+    "TNF": "AC_Frequency (Hz)",
+    "PIN": "Installed_Power (W)",
+    "PRL": "Relative_Power (%)",
+    "PAM": "PAM",
+    "PDA": "PDA",
+    "QAC": "QAC",
+    "SAC": "SAC",
+    "UI1": "UI1",
+    "UI2": "UI2",
+    "UI3": "UI3",
+    "ADR": "Address",
+    "TYP": "Type",
+    "SWV": "Software_Version",
+    "DYR": "Year",
+    "DMT": "Month",
+    "DDY": "Day",
+    "THR": "Hour",
+    "TMI": "Minute",
+}
+
+# Sensors computed from the readings when derived_metrics is enabled
+DERIVED_FIELDS = {
+    "EFF": "DC_AC_Efficiency (%)",
+    "SIMB": "String_Imbalance (%)",
+    "SPY": "Specific_Yield (kWh/kWp)",
+    "EDAY": "Energy_Day_Integrated (Wh)",
+    "PMAX": "AC_Power_Peak_Day (W)",
+    "PAVG": "AC_Power_Mean (W)",
+}
+
+# Time constant of the PAVG rolling mean (seconds)
+DERIVED_MEAN_WINDOW = 300
+
+# Fields requested when scanning a bus for inverters
+SCAN_FIELDS = {"ADR": "Address", "TYP": "Type"}
+
+# Field groups that can be given their own poll interval in field_intervals
+FIELD_GROUPS = {
+    "power": [
+        "PAC",
+        "PDC",
+        "PD01",
+        "PD02",
+        "UDC",
+        "UD01",
+        "UD02",
+        "IDC",
+        "ID01",
+        "ID02",
+        "UL1",
+        "UL2",
+        "UL3",
+        "IL1",
+        "IL2",
+        "IL3",
+        "PRL",
+        "TNF",
+        "QAC",
+        "SAC",
+        "PDA",
+    ],
+    "grid": ["UM1", "UM2", "UM3", "IML1", "IML2", "IML3", "IED", "IEE", "PAM"],
+    "energy": ["KDY", "KMT", "KYR", "KT0", "KLD", "KLM", "KLY", "KHR", "CAC"],
+    "status": ["SYS", "SAL", "TKK"],
+    "info": ["TYP", "SWV", "PIN", "ADR", "DYR", "DMT", "DDY", "THR", "TMI"],
+}
+
+# Fields due within this many seconds are polled early to share a cycle
+SCHEDULE_TOLERANCE = 1.0
+
+# Longest frame the protocol's two hex digit length field can describe
+MAX_FRAME_LENGTH = 0xFF
+
+# Expected hex digits of a reply value, used to size requests so that the
+# reply fits into one frame. Fields not listed are assumed to need four.
+VALUE_WIDTHS = {
+    "KT0": 6,
+    "KHR": 6,
+    "KYR": 5,
+    "KLY": 5,
+    "CAC": 5,
+    "SAL": 5,
+    "SYS": 6,
+}
+DEFAULT_VALUE_WIDTH = 4
+
+# Seconds to wait for the broker's CONNACK before polling starts anyway
+MQTT_CONNECT_TIMEOUT = 10
+
+# Upper bound of paho's automatic reconnect backoff (seconds)
+MQTT_RECONNECT_MAX_DELAY = 120
+
+# Seconds to wait for outstanding acknowledgements on shutdown
+MQTT_DRAIN_TIMEOUT = 2
 
+# Result codes of paho's publish(), without importing paho
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
 
-def build_request(field_map: Dict[str, str]) -> str:
-    """Build the request message for the inverter."""
+# Address of the requesting master in the Solarmax protocol
+MASTER_ADDRESS = "FB"
+
+# Seconds to wait before polling again when the inverter is offline or errors
+OFFLINE_RETRY_INTERVAL = 60
+
+# Status codes of an inverter that is not feeding in (night, low irradiance)
+IDLE_STATUS_CODES = (20000, 20002)
+
+# Adaptive polling: resume this many seconds before sunrise
+SUNRISE_LEAD = 1800
+
+# Doublings of the idle backoff counted at most, max_interval caps it long before
+MAX_IDLE_DOUBLINGS = 16
+
+# A PAC change beyond this fraction or these watts counts as a ramp,
+# during which the power fields are polled every RAMP_INTERVAL seconds
+RAMP_THRESHOLD = 0.2
+RAMP_MIN_CHANGE = 100
+RAMP_INTERVAL = 5
+RAMP_DURATION = 120
+
+# Worker processes send a heartbeat this often (seconds) and are restarted
+# after WORKER_HEARTBEAT_TIMEOUT without any message, with a backoff that
+# doubles up to WORKER_RESTART_BACKOFF_MAX
+WORKER_HEARTBEAT_INTERVAL = 5
+WORKER_HEARTBEAT_TIMEOUT = 30
+WORKER_RESTART_BACKOFF_MAX = 60
+
+# Seconds between checks of the options file for changes
+CONFIG_WATCH_INTERVAL = 5
+
+# Options applied to the running agent when changed, without a restart
+RELOADABLE_OPTIONS = (
+    "update_interval",
+    "field_intervals",
+    "extended_fields",
+    "disabled_fields",
+    "deadbands",
+    "keyframe_interval",
+    "log_level",
+)
+
+# Reloadable options that are also set per inverter
+INVERTER_RELOADABLE_OPTIONS = ("update_interval", "field_intervals")
+
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+# Reconnect backoff for persistent sessions, doubling up to OFFLINE_RETRY_INTERVAL
+RECONNECT_BACKOFF_MIN = 1
+
+# TCP keepalive settings to detect half-open persistent sessions (seconds)
+KEEPALIVE_IDLE = 10
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+
+# Bytes requested from the socket per read while assembling a frame
+READ_CHUNK_SIZE = 1024
+
+# Longest plausible "{SRC;DST;LL|" header before the frame is considered garbage
+MAX_HEADER_LENGTH = 16
+
+
+class FrameError(Exception):
+    """Raised when a frame from the inverter is malformed or fails its checksum."""
+
+
+def build_frame(source: str, destination: str, payload: str) -> str:
+    """Build a ``{SRC;DST;LL|payload|CCCC}`` frame with length and checksum."""
+    # Braces, separators and the checksum take 10 characters plus the length
+    # field itself, which is two hex digits unless the frame exceeds 255 bytes
+    fixed = len(source) + len(destination) + len(payload) + 10
+    digits = 2
+    while len(format(fixed + digits, "02X")) > digits:
+        digits += 1
+    length = fixed + digits
+    body = f"{source};{destination};{length:02X}|{payload}|"
+    return "{" + body + calculate_checksum(body) + "}"
+
+
+def build_request(field_map: Dict[str, str], address: int = 1) -> str:
+    """Build the request message for the inverter at the given bus address."""
     fields = ";".join(field_map.keys())
-    req = REQUEST_TEMPLATE.replace("&&", fields)
-    # Replace !! with length of string in 2-digit hex
-    req = req.replace("!!", format(len(req), "02X"))
-    # Replace $$$$ with checksum
-    req = req.replace("$$$$", calculate_checksum((req[1:])[:-5]))
-    return req
+    return build_frame(MASTER_ADDRESS, format(address, "02X"), f"64:{fields}")
+
+
+def split_fields(
+    fields: List[str], max_length: int = MAX_FRAME_LENGTH
+) -> List[List[str]]:
+    """Split fields into batches whose request and reply each fit in one frame.
+
+    The reply size is estimated from VALUE_WIDTHS since the inverter echoes
+    every field as ``NAME=VALUE;``. Batches are filled greedily in order.
+    """
+    # "{01;FB;LL|64:" and "|CCCC}" surround the field list in both directions
+    budget = max_length - 19
+    batches: List[List[str]] = []
+    batch: List[str] = []
+    request_size = reply_size = 0
+    for field in fields:
+        value_width = VALUE_WIDTHS.get(field, DEFAULT_VALUE_WIDTH)
+        field_request = len(field) + (1 if batch else 0)
+        field_reply = len(field) + 1 + value_width + (1 if batch else 0)
+        if batch and (
+            request_size + field_request > budget or reply_size + field_reply > budget
+        ):
+            batches.append(batch)
+            batch = []
+            request_size = reply_size = 0
+            field_request -= 1
+            field_reply -= 1
+        batch.append(field)
+        request_size += field_request
+        reply_size += field_reply
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def build_requests(
+    field_map: Dict[str, str], address: int = 1, max_length: int = MAX_FRAME_LENGTH
+) -> List[str]:
+    """Build as many requests as needed to poll all fields of the field map."""
+    return [
+        build_request({field: field_map[field] for field in batch}, address)
+        for batch in split_fields(list(field_map), max_length)
+    ]
+
+
+def resolve_field_option(options: Dict[str, Any], field: str) -> Any:
+    """Look up a per-field option, falling back to the field's group entry."""
+    if field in options:
+        return options[field]
+    for group, members in FIELD_GROUPS.items():
+        if field in members and group in options:
+            return options[group]
+    return None
+
+
+def frame_source(frame: bytes) -> Optional[int]:
+    """Bus address of the sender of a ``{SRC;DST;LL|...}`` frame."""
+    try:
+        return int(frame[1 : frame.index(b";")], 16)
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=256)
+def requests_for_fields(fields: Tuple[str, ...], address: int = 1) -> Tuple[str, ...]:
+    """Return the request frames for exactly these fields, cached per subset."""
+    return tuple(
+        build_request(dict.fromkeys(batch, ""), address)
+        for batch in split_fields(list(fields))
+    )
 
 
 def calculate_checksum(data: str) -> str:
     """Calculate the checksum for the message."""
-    checksum_value = sum(ord(c) for c in data)
-    logger.debug(f"Checksum calculation for '{data}': {checksum_value}")
-    return format(checksum_value, "04X")
+    # The checksum field is four hex digits, so the sum wraps at 16 bits
+    return format(sum(data.encode("latin-1")) & 0xFFFF, "04X")
+
+
+def extract_frame(buffer: bytearray) -> Optional[bytes]:
+    """Remove and return the first complete frame from the buffer.
+
+    Returns None while the frame is still incomplete. Bytes before the
+    opening brace are discarded. Raises FrameError if the header is
+    malformed, the frame is not terminated or the checksum does not match.
+    """
+    start = buffer.find(b"{")
+    if start < 0:
+        buffer.clear()
+        return None
+    if start > 0:
+        del buffer[:start]
+
+    header_end = buffer.find(b"|")
+    if header_end < 0:
+        if len(buffer) > MAX_HEADER_LENGTH:
+            buffer.clear()
+            raise FrameError("Frame header not terminated")
+        return None
+
+    header = bytes(buffer[1:header_end]).split(b";")
+    try:
+        length = int(header[2], 16)
+    except (IndexError, ValueError):
+        buffer.clear()
+        raise FrameError(f"Malformed frame header: {header!r}")
+    if length <= header_end + 6:
+        buffer.clear()
+        raise FrameError(f"Invalid frame length: {length}")
+    if len(buffer) < length:
+        return None
+
+    frame = bytes(buffer[:length])
+    del buffer[:length]
+    if frame[-1:] != b"}":
+        raise FrameError(f"Frame of length {length} not terminated by '}}'")
+
+    try:
+        checksum = int(frame[-5:-1], 16)
+    except ValueError:
+        raise FrameError(f"Malformed checksum: {frame[-5:-1]!r}")
+    expected = sum(memoryview(frame)[1:-5]) & 0xFFFF
+    if checksum != expected:
+        raise FrameError(f"Checksum mismatch: {checksum:04X} != {expected:04X}")
+    return frame
+
+
+# Decoding table: field -> (divisor, lookup table, text for unknown codes).
+# Fields without an entry are published as raw integers.
+FIELD_DECODERS: Dict[str, Tuple[float, Optional[Dict[int, str]], str]] = {
+    "SYS": (1, STATUS_CODES, "Unknown Status Code"),
+    "SAL": (1, ALARM_CODES, "Unknown Alarm Code"),
+    **dict.fromkeys(["PAC", "PD01", "PD02", "PDC", "PIN"], (2, None, "")),
+    **dict.fromkeys(
+        ["UL1", "UL2", "UL3", "UDC", "UD01", "UD02", "UM1", "UM2", "UM3"],
+        (10.0, None, ""),
+    ),
+    **dict.fromkeys(
+        ["IDC", "ID01", "ID02", "IL1", "IL2", "IL3", "IML1", "IML2", "IML3", "TNF"],
+        (100.0, None, ""),
+    ),
+}
+
+# Matches ";NAME=VALUE" pairs in a reply; the ",0" suffix of SYS is not matched
+VALUE_PATTERN = re.compile(rb"[:;]([A-Z0-9]+)=([0-9A-Fa-f]+)")
+
+# Merged schemas remembered per schema
+SCHEMA_MERGE_CACHE_SIZE = 16
+
+# Decoded field names, so every poll reuses the same str objects
+_FIELD_NAMES: Dict[bytes, str] = {}
+
+
+def alarm_names(mask: int) -> List[str]:
+    """Names of the alarms set in a SAL bitmask."""
+    names = [ALARM_CODES[bit] for bit in ALARM_BITS if mask & bit]
+    if mask & ~ALARM_MASK:
+        names.append("Unknown Alarm Code")
+    return names
 
 
 def map_data_value(field: str, value: int) -> Union[str, float, int]:
     """Convert raw inverter values to useful units."""
-    if field == "SYS":
-        return STATUS_CODES.get(value, "Unknown Status Code")
-    elif field == "SAL":
-        return ALARM_CODES.get(value, "Unknown Alarm Code")
-    elif field in ["PAC", "PD01", "PD02", "PDC"]:
-        return value / 2
-    elif field in ["UL1", "UL2", "UL3", "UDC", "UD01", "UD02"]:
-        return value / 10.0
-    elif field in ["IDC", "ID01", "ID02", "IL1", "IL2", "IL3"]:
-        return value / 100.0
-    else:
+    decoder = FIELD_DECODERS.get(field)
+    if decoder is None:
         return value
+    divisor, lookup, unknown = decoder
+    if lookup is not None:
+        text = lookup.get(value)
+        if text is None:
+            # Several alarms at once are reported as a combination of bits
+            if lookup is ALARM_CODES:
+                return ", ".join(alarm_names(value))
+            return unknown
+        return text
+    return value / divisor
 
 
-class HomeAssistantMQTTPublisher:
-    """MQTT Publisher with Home Assistant auto-discovery support."""
+def decode_values(data: Union[bytes, bytearray, memoryview]) -> Dict[str, int]:
+    """Extract the raw integer value of every field in an inverter reply.
 
-    def __init__(self, config: Dict[str, Any]):
-        self.config = config
-        self.client: Optional[mqtt.Client] = None
-        self.discovery_sent = False
+    Works directly on the received bytes without splitting them into copies;
+    the frame header and checksum contain no "=" and are skipped.
+    """
+    values = {}
+    for raw_name, raw_value in VALUE_PATTERN.findall(data):
+        name = _FIELD_NAMES.get(raw_name)
+        if name is None:
+            name = _FIELD_NAMES.setdefault(raw_name, raw_name.decode("ascii"))
+        values[name] = int(raw_value, 16)
+    return values
 
-    def _create_client(self) -> mqtt.Client:
-        """Create and configure MQTT client."""
-        client = mqtt.Client(client_id=f"solarmax_{self.config['device_id']}")
 
-        if self.config.get("mqtt_username") and self.config.get("mqtt_password"):
-            client.username_pw_set(
-                username=self.config["mqtt_username"],
-                password=self.config["mqtt_password"],
-            )
+class ReadingSchema:
+    """Field layout shared by all readings of an inverter.
 
-        # Set up callbacks for better debugging
-        client.on_connect = self._on_connect
-        client.on_disconnect = self._on_disconnect
-        client.on_publish = self._on_publish
+    Holds the field names and descriptions once, so a reading only needs
+    its values in the same order.
+    """
 
-        return client
+    __slots__ = ("fields", "descriptions", "index", "_merged")
 
-    def _on_connect(self, client, userdata, flags, rc):
-        """Callback for when the client connects to the MQTT broker."""
-        if rc == 0:
-            logger.info("Successfully connected to MQTT broker")
-            # Publish availability
-            self._publish_availability("online")
+    def __init__(self, descriptions: Mapping[str, str]):
+        self.fields = tuple(descriptions)
+        self.descriptions = tuple(descriptions.values())
+        self.index = {field: position for position, field in enumerate(self.fields)}
+        self._merged: Dict[int, Tuple["ReadingSchema", "ReadingSchema"]] = {}
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+    def merged(self, other: "ReadingSchema") -> "ReadingSchema":
+        """Schema with the fields of both, built once per pair of schemas.
+
+        Returns this schema itself if it already has all fields of the other.
+        """
+        if other is self:
+            return self
+        cached = self._merged.get(id(other))
+        if cached is not None and cached[0] is other:
+            return cached[1]
+        if all(field in self.index for field in other.fields):
+            schema = self
         else:
-            logger.error(f"Failed to connect to MQTT broker with code {rc}")
+            descriptions = dict(zip(self.fields, self.descriptions))
+            descriptions.update(zip(other.fields, other.descriptions))
+            schema = ReadingSchema(descriptions)
+        # Bounded, as converted readings bring a new schema each time
+        if len(self._merged) >= SCHEMA_MERGE_CACHE_SIZE:
+            self._merged.clear()
+        self._merged[id(other)] = (other, schema)
+        return schema
 
-    def _on_disconnect(self, client, userdata, rc):
-        """Callback for when the client disconnects from the MQTT broker."""
-        logger.warning(f"Disconnected from MQTT broker with code {rc}")
 
-    def _on_publish(self, client, userdata, mid):
-        """Callback for when a message is published."""
-        logger.debug(f"Message {mid} published successfully")
+class Reading(Mapping[str, Dict[str, Any]]):
+    """One reading of an inverter, stored as two lists laid out by a schema.
 
-    def _publish_availability(self, status: str):
-        """Publish availability status for Home Assistant."""
-        if self.client:
-            self.client.publish(self.config["availability_topic"], status, retain=True)
+    ``raw`` holds the raw values and ``decoded`` the decoded ones; None marks
+    fields missing from the reading. A reading is never modified after it
+    was built. It can be used like the ``{field: {"Value", "Description",
+    "Raw Value"}}`` dict of earlier releases, but those per-field dicts are
+    only built on access; ``value()``, ``entries()`` and ``to_dict()``
+    avoid them on the hot paths.
+    """
 
-    def _send_discovery_config(self, field: str, field_data: Dict[str, Any]):
-        """Send Home Assistant discovery configuration for a sensor."""
-        if not self.config.get("home_assistant_discovery", True):
-            return
+    __slots__ = ("schema", "raw", "decoded")
 
-        sensor_name = f"{self.config['device_name']} {field}"
-        unique_id = f"{self.config['device_id']}_{field.lower()}"
+    def __init__(
+        self,
+        schema: ReadingSchema,
+        raw: Optional[List[Any]] = None,
+        decoded: Optional[List[Any]] = None,
+    ):
+        self.schema = schema
+        self.raw = raw if raw is not None else [None] * len(schema)
+        self.decoded = decoded if decoded is not None else [None] * len(schema)
 
-        # Create discovery topic
-        discovery_topic = (
-            f"{self.config['discovery_prefix']}/sensor/"
-            f"{self.config['device_id']}/{field.lower()}/config"
+    @classmethod
+    def of(cls, data: Mapping[str, Any]) -> "Reading":
+        """Return a reading as is, or convert a reading in the dict format."""
+        if isinstance(data, Reading):
+            return data
+        schema = ReadingSchema(
+            {
+                field: field_data.get("Description", field)
+                for field, field_data in data.items()
+            }
         )
+        raw = [
+            field_data.get("Raw Value", field_data.get("Value"))
+            for field_data in data.values()
+        ]
+        values = [
+            field_data.get("Value", field_data.get("Raw Value"))
+            for field_data in data.values()
+        ]
+        return cls(schema, raw, values)
 
-        # Create discovery payload
-        discovery_payload = {
-            "name": sensor_name,
-            "unique_id": unique_id,
-            "state_topic": f"{self.config['mqtt_topic_prefix']}/{field}",
-            "availability_topic": self.config["availability_topic"],
-            "device": {
-                "identifiers": [self.config["device_id"]],
-                "name": self.config["device_name"],
-                "manufacturer": "Solarmax",
-                "model": "Inverter",
-                "sw_version": "1.0.0",
-            },
-            "json_attributes_topic": f"{self.config['mqtt_topic_prefix']}/attributes",
+    @classmethod
+    def from_entries(
+        cls, schema: ReadingSchema, entries: Iterable[Tuple[str, Any, Any]]
+    ) -> "Reading":
+        """Build a reading from (field, value, raw value) tuples.
+
+        Fields unknown to the schema get their name as description.
+        """
+        entries = list(entries)
+        unknown = {field: field for field, _, _ in entries if field not in schema.index}
+        if unknown:
+            schema = schema.merged(ReadingSchema(unknown))
+        reading = cls(schema)
+        index = schema.index
+        for field, value, raw in entries:
+            position = index[field]
+            reading.raw[position] = raw
+            reading.decoded[position] = value
+        return reading
+
+    def __getitem__(self, field: str) -> Dict[str, Any]:
+        position = self.schema.index[field]
+        raw = self.raw[position]
+        if raw is None:
+            raise KeyError(field)
+        return {
+            "Value": self.decoded[position],
+            "Description": self.schema.descriptions[position],
+            "Raw Value": raw,
         }
 
-        # Add device class if available
-        if field in DEVICE_CLASSES and DEVICE_CLASSES[field]:
-            discovery_payload["device_class"] = DEVICE_CLASSES[field]
+    def __iter__(self) -> Iterator[str]:
+        for field, raw in zip(self.schema.fields, self.raw):
+            if raw is not None:
+                yield field
 
-        # Add unit of measurement
-        if field in UNITS_OF_MEASUREMENT and UNITS_OF_MEASUREMENT[field]:
-            discovery_payload["unit_of_measurement"] = UNITS_OF_MEASUREMENT[field]
+    def __len__(self) -> int:
+        return len(self.raw) - self.raw.count(None)
 
-        # Add state class for statistics
-        if field in STATE_CLASSES:
-            discovery_payload["state_class"] = STATE_CLASSES[field]
+    def __contains__(self, field: object) -> bool:
+        position = self.schema.index.get(field)  # type: ignore[call-overload]
+        return position is not None and self.raw[position] is not None
 
-        # Special handling for energy sensors (for Energy dashboard)
-        if field in ["KDY", "KMT", "KYR", "KT0"]:
-            discovery_payload["icon"] = "mdi:solar-power"
-            if field == "KT0":  # Total energy - important for energy dashboard
-                discovery_payload["last_reset_topic"] = (
-                    f"{self.config['mqtt_topic_prefix']}/last_reset"
-                )
+    def __repr__(self) -> str:
+        return f"Reading({self.to_dict()!r})"
 
-        # Special handling for power sensors
-        if field in ["PAC", "PDC", "PD01", "PD02"]:
-            discovery_payload["icon"] = "mdi:solar-power"
+    def value(self, field: str, default: Any = None) -> Any:
+        """Decoded value of a field, or the default if it is missing."""
+        position = self.schema.index.get(field)
+        if position is None or self.raw[position] is None:
+            return default
+        return self.decoded[position]
 
-        # Special handling for status sensors
-        if field in ["SYS", "SAL"]:
-            discovery_payload["icon"] = "mdi:information"
+    def raw_value(self, field: str, default: Any = None) -> Any:
+        """Raw value of a field, or the default if it is missing."""
+        position = self.schema.index.get(field)
+        if position is None or self.raw[position] is None:
+            return default
+        return self.raw[position]
 
-        if self.client:
-            self.client.publish(
-                discovery_topic, json.dumps(discovery_payload), retain=True
+    def entries(self) -> Iterator[Tuple[str, Any, Any]]:
+        """(field, value, raw value) of every field in the reading."""
+        for field, value, raw in zip(self.schema.fields, self.decoded, self.raw):
+            if raw is not None:
+                yield field, value, raw
+
+    def value_items(self) -> Iterator[Tuple[str, Any]]:
+        """(field, value) of every field in the reading."""
+        for field, value, raw in zip(self.schema.fields, self.decoded, self.raw):
+            if raw is not None:
+                yield field, value
+
+    def to_dict(self) -> Dict[str, Dict[str, Any]]:
+        """The reading in the dict format, e.g. for JSON serialization."""
+        return {
+            field: {"Value": value, "Description": description, "Raw Value": raw}
+            for field, description, value, raw in zip(
+                self.schema.fields, self.schema.descriptions, self.decoded, self.raw
             )
-            logger.debug(f"Sent discovery config for {sensor_name}")
+            if raw is not None
+        }
 
-    def publish_data(self, data: Dict[str, Any]) -> bool:
-        """Publish the data to MQTT broker with Home Assistant support."""
-        try:
-            if not self.client:
-                self.client = self._create_client()
-                self.client.connect(
-                    self.config["mqtt_host"], self.config["mqtt_port"], 60
+    def merged(self, other: "Reading") -> "Reading":
+        """New reading with the fields of ``other`` replacing those of this one."""
+        schema = self.schema.merged(other.schema)
+        if schema is self.schema:
+            raw = list(self.raw)
+            values = list(self.decoded)
+        else:
+            raw = [None] * len(schema)
+            values = [None] * len(schema)
+            for field, value, raw_value in self.entries():
+                position = schema.index[field]
+                raw[position] = raw_value
+                values[position] = value
+        index = schema.index
+        for field, value, raw_value in other.entries():
+            position = index[field]
+            raw[position] = raw_value
+            values[position] = value
+        return Reading(schema, raw, values)
+
+
+def decode_reading(
+    schema: ReadingSchema, frames: Iterable[Union[bytes, bytearray, memoryview]]
+) -> Reading:
+    """Decode the replies to one poll into a single reading.
+
+    Fields missing from the schema are added with their name as description.
+    """
+    reading = Reading(schema)
+    unknown: List[Tuple[str, Any, Any]] = []
+    index = schema.index
+    try:
+        for frame in frames:
+            if not frame:
+                continue
+            # Like decode_values, without building a dict per frame
+            for raw_name, raw_value in VALUE_PATTERN.findall(frame):
+                field = _FIELD_NAMES.get(raw_name)
+                if field is None:
+                    field = _FIELD_NAMES.setdefault(raw_name, raw_name.decode("ascii"))
+                value = int(raw_value, 16)
+                position = index.get(field)
+                if position is None:
+                    unknown.append((field, map_data_value(field, value), value))
+                    continue
+                reading.raw[position] = value
+                reading.decoded[position] = map_data_value(field, value)
+    except Exception as e:
+        logger.error(f"Error decoding reading: {e}")
+        return Reading(schema)
+    if unknown:
+        reading = reading.merged(Reading.from_entries(schema, unknown))
+    return reading
+
+
+class ChangeFilter:
+    """Decides which values are worth publishing in change-only mode.
+
+    A value is published when it moved beyond its deadband since it was last
+    published. Deadbands are given per field or group as an absolute number
+    or as ``{"absolute": x, "relative": y}``; the larger band applies. Every
+    ``keyframe_interval`` seconds all values of a device are sent regardless.
+    Values and keyframes only count as published once the publisher reports
+    them sent with ``remember`` and ``keyframe_sent``.
+    """
+
+    def __init__(
+        self,
+        deadbands: Optional[Dict[str, Any]] = None,
+        keyframe_interval: float = 600,
+    ):
+        self.deadbands = deadbands or {}
+        self.keyframe_interval = keyframe_interval
+        self.last_values: Dict[str, Dict[str, Any]] = {}
+        self.last_keyframe: Dict[str, float] = {}
+        self._bands: Dict[str, Tuple[float, float]] = {}
+
+    def _band(self, field: str) -> Tuple[float, float]:
+        """Return the (absolute, relative) deadband of a field."""
+        band = self._bands.get(field)
+        if band is None:
+            option = resolve_field_option(self.deadbands, field)
+            if isinstance(option, dict):
+                band = (
+                    float(option.get("absolute", 0)),
+                    float(option.get("relative", 0)),
                 )
-                self.client.loop_start()
-                time.sleep(1)  # Give connection time to establish
+            else:
+                band = (float(option or 0), 0.0)
+            self._bands[field] = band
+        return band
 
-            # At this point, self.client is guaranteed to be not None
-            if self.client is None:
-                raise RuntimeError("MQTT client failed to initialize")
+    def configure(self, deadbands: Optional[Dict[str, Any]], keyframe_interval: float):
+        """Change the deadbands and the keyframe interval."""
+        self.deadbands = deadbands or {}
+        self.keyframe_interval = keyframe_interval
+        self._bands.clear()
 
-            # Send discovery configs on first run
-            if not self.discovery_sent and self.config.get(
-                "home_assistant_discovery", True
-            ):
-                for field in data.keys():
-                    self._send_discovery_config(field, data[field])
-                self.discovery_sent = True
-                logger.info("Sent Home Assistant discovery configurations")
+    def start_cycle(self, device_id: str, now: float) -> bool:
+        """Start a publish cycle for a device; True if it is a keyframe."""
+        last = self.last_keyframe.get(device_id)
+        return last is None or now - last >= self.keyframe_interval
 
-            # Publish individual sensor values
-            for field, field_data in data.items():
-                topic = f"{self.config['mqtt_topic_prefix']}/{field}"
-                value = field_data.get("Value", 0)
-                self.client.publish(topic, str(value), retain=True)
+    def keyframe_sent(self, device_id: str, now: float):
+        """Record that a keyframe of the device was published at ``now``."""
+        self.last_keyframe[device_id] = now
 
-            # Publish full data as attributes
-            attributes_topic = f"{self.config['mqtt_topic_prefix']}/attributes"
-            self.client.publish(attributes_topic, json.dumps(data), retain=True)
+    def changed(
+        self, device_id: str, field: str, value: Any, force: bool = False
+    ) -> bool:
+        """Whether the value should be published."""
+        values = self.last_values.get(device_id)
+        if not force and values is not None and field in values:
+            last = values[field]
+            if isinstance(value, (int, float)) and isinstance(last, (int, float)):
+                absolute, relative = self._band(field)
+                if abs(value - last) <= max(absolute, relative * abs(last)):
+                    return False
+            elif value == last:
+                return False
+        return True
 
-            # Update availability
-            self._publish_availability("online")
+    def remember(self, device_id: str, field: str, value: Any):
+        """Record a value as published."""
+        self.last_values.setdefault(device_id, {})[field] = value
 
-            logger.info(f"Published data for {len(data)} sensors")
-            return True
 
-        except Exception as e:
-            logger.error(f"Failed to publish MQTT message: {e}")
-            if self.client:
-                self.client.loop_stop()
-                self.client.disconnect()
-                self.client = None
-            return False
+class StatusEvents:
+    """Turns the SYS and SAL values of readings into edge-triggered events.
 
-    def disconnect(self):
-        """Disconnect from MQTT broker."""
-        if self.client:
-            self._publish_availability("offline")
-            self.client.loop_stop()
-            self.client.disconnect()
-            self.client = None
+    Remembers the last status code and alarm bitmask per device. The first
+    reading of a device only sets the baseline. While the inverter cannot
+    be reached its alarms keep their last known state.
+    """
 
+    def __init__(self):
+        self.status: Dict[str, int] = {}
+        self.alarms: Dict[str, int] = {}
 
-def convert_to_json(field_map: Dict[str, str], data: str) -> Dict[str, Any]:
-    """Convert inverter response to JSON format."""
-    # Example data:
-    # b'{01;FB;EA|64:PAC=1F0A;PD01=CB2;PD02=13BA;PDC=206C;CAC=CAF;...}'
-    try:
-        data_split = data.split(":")[1].split("|")[0].split(";")
-        result_dict = {}
+    def update(
+        self, device_id: str, data: Reading, timestamp: float
+    ) -> Tuple[Dict[int, bool], List[Dict[str, Any]]]:
+        """Return the alarm bits that changed and the events of a reading.
 
-        for item in data_split:
-            if "=" not in item:
-                continue
+        Alarm bits are returned for every bit on the first reading, so that
+        the binary sensors get their initial state.
+        """
+        changed: Dict[int, bool] = {}
+        events: List[Dict[str, Any]] = []
+        status = data.raw_value("SYS")
+        if isinstance(status, int):
+            last = self.status.get(device_id)
+            if last is not None and status != last:
+                events.append(
+                    {
+                        "event_type": "status_change",
+                        "timestamp": timestamp,
+                        "from_code": last,
+                        "from": map_data_value("SYS", last),
+                        "to_code": status,
+                        "to": map_data_value("SYS", status),
+                    }
+                )
+            self.status[device_id] = status
+        mask = data.raw_value("SAL")
+        if isinstance(mask, int) and status != NO_COMMUNICATION_STATUS:
+            last = self.alarms.get(device_id)
+            for bit in ALARM_BITS:
+                active = bool(mask & bit)
+                if last is None:
+                    changed[bit] = active
+                elif active != bool(last & bit):
+                    changed[bit] = active
+                    events.append(
+                        {
+                            "event_type": "alarm_raised" if active else "alarm_cleared",
+                            "timestamp": timestamp,
+                            "code": bit,
+                            "alarm": ALARM_CODES[bit],
+                        }
+                    )
+            self.alarms[device_id] = mask
+        return changed, events
 
-            field, value_str = item.split("=", 1)
 
-            if field == "SYS":
-                # Cut off the ",0" in SYS status
-                value = int(value_str.split(",")[0], 16)
-            else:
-                value = int(value_str, 16)
+# Histogram buckets in seconds and bytes
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+SIZE_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096)
 
-            result_dict[field] = {
-                "Value": map_data_value(field, value),
-                "Description": field_map[field],
-                "Raw Value": value,
-            }
+# Type, help text and (for histograms) buckets of every exported metric
+METRIC_DEFINITIONS: Dict[str, Tuple[str, str, Tuple[float, ...]]] = {
+    "solarmax_value": ("gauge", "Current value of an inverter field", ()),
+    "solarmax_counter_total": (
+        "counter",
+        "Counter read from the inverter (energy in kWh, hours, start-ups)",
+        (),
+    ),
+    "solarmax_up": ("gauge", "Whether the last poll of the inverter succeeded", ()),
+    "solarmax_polls_total": ("counter", "Polls of the inverter", ()),
+    "solarmax_poll_failures_total": ("counter", "Polls without valid data", ()),
+    "solarmax_poll_seconds": ("histogram", "Duration of a poll", LATENCY_BUCKETS),
+    "solarmax_connect_seconds": (
+        "histogram",
+        "Time to open a connection to the inverter",
+        LATENCY_BUCKETS,
+    ),
+    "solarmax_reconnects_total": ("counter", "Connections opened again", ()),
+    "solarmax_connect_failures_total": ("counter", "Failed connection attempts", ()),
+    "solarmax_read_seconds": (
+        "histogram",
+        "Time from sending a request to a complete reply",
+        LATENCY_BUCKETS,
+    ),
+    "solarmax_frame_bytes": ("histogram", "Size of reply frames", SIZE_BUCKETS),
+    "solarmax_checksum_failures_total": ("counter", "Invalid reply frames", ()),
+    "solarmax_parse_seconds": ("histogram", "Time to decode a reply", LATENCY_BUCKETS),
+    "solarmax_publish_seconds": (
+        "histogram",
+        "Time to hand a reading to the MQTT client",
+        LATENCY_BUCKETS,
+    ),
+    "solarmax_mqtt_connected": ("gauge", "Whether the MQTT broker is connected", ()),
+    "solarmax_mqtt_pending_messages": (
+        "gauge",
+        "QoS 1/2 messages not yet acknowledged by the broker",
+        (),
+    ),
+    "solarmax_outbox_bytes": ("gauge", "Readings waiting in the outbox", ()),
+    "solarmax_sink_queue_depth": ("gauge", "Readings queued for a sink", ()),
+    "solarmax_worker_up": ("gauge", "Whether a worker process is running", ()),
+    "solarmax_worker_restarts_total": (
+        "counter",
+        "Worker processes restarted after exiting or missing heartbeats",
+        (),
+    ),
+    "solarmax_sink_dropped_total": (
+        "counter",
+        "Readings dropped because a sink fell behind",
+        (),
+    ),
+    "solarmax_sink_errors_total": ("counter", "Failed writes to a sink", ()),
+    "solarmax_sink_write_seconds": (
+        "histogram",
+        "Time to write a batch of readings to a sink",
+        LATENCY_BUCKETS,
+    ),
+}
 
-        logger.debug(f"Converted data: {result_dict}")
-        return result_dict
 
-    except Exception as e:
-        logger.error(f"Error converting data to JSON: {e}")
-        return {}
+def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    """Format label pairs in the Prometheus text format."""
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
 
 
-class InverterConnection:
-    """Handles socket connection to the Solarmax inverter."""
+# Series of a metrics registry: (values, histograms) by name and labels
+MetricsSnapshot = Tuple[
+    Dict[str, Dict[Tuple[Tuple[str, str], ...], float]],
+    Dict[str, Dict[Tuple[Tuple[str, str], ...], List[float]]],
+]
 
-    def __init__(self, ip: str, port: int, timeout: int = 10):
-        self.ip = ip
-        self.port = port
-        self.timeout = timeout
 
-    def connect(self) -> Optional[socket.socket]:
-        """Establish connection to the inverter."""
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(self.timeout)
-            sock.connect((self.ip, self.port))
-            logger.info(f"Connected to inverter at {self.ip}:{self.port}")
-            return sock
-        except socket.error as e:
-            logger.error(f"Failed to connect to inverter: {e}")
-            return None
+class Metrics:
+    """In-memory registry of counters, gauges and histograms.
 
-    def read_data(self, sock: socket.socket, request: str) -> str:
-        """Send request and read response from inverter."""
-        try:
-            logger.info(f"Sending request: {request}")
-            sock.send(bytes(request, "utf-8"))
+    Recording is a no-op until the registry is enabled, so the hot paths
+    pay nothing when no metrics endpoint is configured. Collectors are
+    called on every scrape to refresh gauges that are cheaper to read
+    on demand than to track.
+    """
 
-            response = ""
-            start_time = datetime.now()
-            data_received = False
+    def __init__(self):
+        self.enabled = False
+        self.values: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {}
+        self.histograms: Dict[str, Dict[Tuple[Tuple[str, str], ...], List[float]]] = {}
+        self.collectors: List[Callable[[], None]] = []
+        # Snapshots of the registries of worker processes, by worker
+        self.remote: Dict[str, MetricsSnapshot] = {}
 
-            while (
-                not data_received and (datetime.now() - start_time).total_seconds() < 2
-            ):
-                buf = sock.recv(1024)
-                if len(buf) > 0:
-                    response += buf.decode("utf-8", errors="ignore")
-                    data_received = True
+    def inc(self, name: str, amount: float = 1, /, **labels: str):
+        """Increase a counter."""
+        if self.enabled:
+            series = self.values.setdefault(name, {})
+            key = tuple(sorted(labels.items()))
+            series[key] = series.get(key, 0) + amount
 
-            logger.info(f"Received response: {response}")
-            return response
+    def set(self, name: str, value: float, /, **labels: str):
+        """Set a gauge or a counter read from the inverter."""
+        if self.enabled:
+            self.values.setdefault(name, {})[tuple(sorted(labels.items()))] = value
 
-        except Exception as e:
-            logger.error(f"Error reading data from inverter: {e}")
-            return ""
+    def observe(self, name: str, value: float, /, **labels: str):
+        """Record a value in a histogram."""
+        if not self.enabled:
+            return
+        buckets = METRIC_DEFINITIONS[name][2]
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        # Counts per bucket plus +Inf, then the sum
+        counts = series.get(key)
+        if counts is None:
+            counts = series[key] = [0.0] * (len(buckets) + 2)
+        for index, bound in enumerate(buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[len(buckets)] += 1
+        counts[-1] += value
 
+    def snapshot(self) -> "MetricsSnapshot":
+        """Copy of the recorded series, to pass them to another process."""
+        return (
+            {name: dict(series) for name, series in self.values.items()},
+            {
+                name: {labels: list(counts) for labels, counts in series.items()}
+                for name, series in self.histograms.items()
+            },
+        )
 
-def generate_empty_data(
-    field_map: Dict[str, str], last_data: Optional[Dict[str, Any]] = None
-) -> Dict[str, Any]:
-    """Generate empty/default data when inverter is not available."""
-    if last_data:
-        # Update last known data with offline status
-        data = last_data.copy()
-        for field in data:
-            if field in ["KDY", "KMT", "KYR", "KT0", "KHR", "CAC"]:
-                continue  # Keep energy/counter values
-            elif field == "SYS":
-                data[field]["Value"] = map_data_value(field, 20000)
-            else:
-                data[field]["Raw Value"] = 0
-                data[field]["Value"] = map_data_value(field, 0)
-        return data
-    else:
-        # Generate fresh empty data
-        data = {}
-        for field in field_map:
-            if field == "SYS":
-                data[field] = {
-                    "Value": "Keine Kommunikation",
-                    "Description": field_map[field],
-                    "Raw Value": 20000,
-                }
-            else:
-                data[field] = {
-                    "Value": 0,
-                    "Description": field_map[field],
-                    "Raw Value": 0,
-                }
-        return data
+    def _merged(self) -> "MetricsSnapshot":
+        """The local series, completed by the series of the worker processes.
 
+        A series recorded here, such as the values of readings passed on by
+        a worker, takes precedence over the worker's copy.
+        """
+        if not self.remote:
+            return self.values, self.histograms
+        values, histograms = self.snapshot()
+        for remote_values, remote_histograms in self.remote.values():
+            for name, series in remote_values.items():
+                merged = values.setdefault(name, {})
+                for labels, value in series.items():
+                    merged.setdefault(labels, value)
+            for name, counts_by_labels in remote_histograms.items():
+                merged_counts = histograms.setdefault(name, {})
+                for labels, counts in counts_by_labels.items():
+                    merged_counts.setdefault(labels, counts)
+        return values, histograms
 
-def main():
-    """Main function to run the inverter monitoring agent."""
-    logger.info("Starting Solarmax to MQTT Agent for Home Assistant...")
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        for collector in self.collectors:
+            collector()
+        values, histograms = self._merged()
+        lines = []
+        for name, (kind, help_text, buckets) in METRIC_DEFINITIONS.items():
+            series = values.get(name) or histograms.get(name)
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind != "histogram":
+                for labels, value in values[name].items():
+                    lines.append(f"{name}{format_labels(labels)} {value:g}")
+                continue
+            for labels, counts in histograms[name].items():
+                cumulative = 0.0
+                for bound, count in zip(buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    bucket_labels = format_labels(labels + (("le", le),))
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative:g}")
+                lines.append(f"{name}_sum{format_labels(labels)} {counts[-1]:g}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative:g}")
+        return "\n".join(lines) + "\n"
 
-    # Initialize components with config
-    inverter = InverterConnection(CONFIG["inverter_ip"], CONFIG["inverter_port"])
-    mqtt_publisher = HomeAssistantMQTTPublisher(CONFIG)
 
-    # Build request for inverter
-    request_message = build_request(FIELD_MAP_INVERTER)
-    last_good_data = {}
+METRICS = Metrics()
 
-    # Set up signal handler for graceful shutdown
-    import signal
 
-    def signal_handler(signum, frame):
-        logger.info("Received shutdown signal, cleaning up...")
-        mqtt_publisher.disconnect()
-        exit(0)
+class Outbox:
+    """Disk-backed, append-only buffer of readings for broker outages.
 
-    signal.signal(signal.SIGTERM, signal_handler)
-    signal.signal(signal.SIGINT, signal_handler)
+    Readings are appended as JSON lines to numbered segment files. A cursor
+    file remembers how far they have been replayed, so a restart neither
+    loses nor repeats readings. Segments are evicted oldest first once the
+    outbox exceeds ``max_bytes`` or a segment is older than ``max_age``.
+    """
 
-    while True:
-        try:
-            # Try to connect to inverter
-            connection = inverter.connect()
-
-            if connection:
-                # Read data from inverter
-                raw_data = inverter.read_data(connection, request_message)
-                json_data = convert_to_json(FIELD_MAP_INVERTER, raw_data)
-
-                if json_data:  # Only publish if we got valid data
-                    mqtt_publisher.publish_data(json_data)
-                    last_good_data = json_data
-                    sleep_time = CONFIG["update_interval"]
-                else:
-                    logger.warning("No valid data received from inverter")
-                    sleep_time = 60  # Wait longer on data errors
+    CURSOR_FILE = "cursor.json"
+    SEGMENT_SUFFIX = ".ndjson"
 
-                connection.close()
-            else:
-                # Inverter not available, publish empty/last known data
-                logger.warning("Inverter not available, publishing offline status")
-                if last_good_data:
-                    json_data = generate_empty_data(FIELD_MAP_INVERTER, last_good_data)
-                else:
-                    json_data = generate_empty_data(FIELD_MAP_INVERTER)
-
-                mqtt_publisher.publish_data(json_data)
-                sleep_time = 60  # Wait longer when inverter is offline
-
-            logger.debug(f"Sleeping for {sleep_time} seconds...")
-            time.sleep(sleep_time)
-
-        except KeyboardInterrupt:
-            logger.info("Agent stopped by user")
-            mqtt_publisher.disconnect()
-            break
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = 50 * 1024 * 1024,
+        max_age: float = 7 * 24 * 3600,
+        segment_bytes: int = 256 * 1024,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_bytes = segment_bytes
+        makedirs(directory, exist_ok=True)
+        self.segment, self.offset = self._load_cursor()
+        self._batch_end: Optional[Tuple[str, int]] = None
+        # Position after each reading of the last batch
+        self._entry_ends: List[Tuple[str, int]] = []
+
+    def _path(self, name: str) -> str:
+        return path.join(self.directory, name)
+
+    def _segments(self) -> List[str]:
+        """Segment file names, oldest first."""
+        return sorted(
+            name
+            for name in listdir(self.directory)
+            if name.endswith(self.SEGMENT_SUFFIX)
+        )
+
+    def _load_cursor(self) -> Tuple[str, int]:
+        try:
+            with open(self._path(self.CURSOR_FILE), "r") as f:
+                cursor = json.load(f)
+            return cursor["segment"], int(cursor["offset"])
+        except (OSError, ValueError, KeyError):
+            return "", 0
+
+    def _save_cursor(self):
+        temp_path = self._path(self.CURSOR_FILE + ".tmp")
+        with open(temp_path, "w") as f:
+            json.dump({"segment": self.segment, "offset": self.offset}, f)
+        replace(temp_path, self._path(self.CURSOR_FILE))
+
+    def pending_bytes(self) -> int:
+        """Bytes of readings not yet replayed."""
+        total = 0
+        for name in self._segments():
+            if name < self.segment:
+                continue
+            total += path.getsize(self._path(name))
+            if name == self.segment:
+                total -= self.offset
+        return max(total, 0)
+
+    def pending(self) -> bool:
+        """Whether readings are waiting to be replayed."""
+        return self.pending_bytes() > 0
+
+    def append(self, device_id: str, data: Dict[str, Any], timestamp: float):
+        """Append a reading to the newest segment."""
+        segments = self._segments()
+        if segments and path.getsize(self._path(segments[-1])) < self.segment_bytes:
+            name = segments[-1]
+        else:
+            number = int(segments[-1].split(".")[0]) + 1 if segments else 1
+            name = f"{number:010d}{self.SEGMENT_SUFFIX}"
+        line = json.dumps({"ts": timestamp, "device": device_id, "data": data})
+        with open(self._path(name), "a") as f:
+            f.write(line + "\n")
+        self._evict()
+
+    def _evict(self):
+        """Drop the oldest segments beyond the size or age limit."""
+        segments = self._segments()
+        sizes = {name: path.getsize(self._path(name)) for name in segments}
+        total = sum(sizes.values())
+        now = time.time()
+        # Never evict the segment currently being written
+        for name in segments[:-1]:
+            too_old = now - path.getmtime(self._path(name)) > self.max_age
+            if total <= self.max_bytes and not too_old:
+                break
+            logger.warning(f"Outbox full or expired, dropping segment {name}")
+            remove(self._path(name))
+            total -= sizes[name]
+
+    def read_batch(self, limit: int) -> List[Dict[str, Any]]:
+        """Return up to ``limit`` of the oldest readings without removing them."""
+        entries: List[Dict[str, Any]] = []
+        self._entry_ends = []
+        segment, offset = self.segment, self.offset
+        for name in self._segments():
+            if name < segment:
+                continue
+            if name != segment:
+                segment, offset = name, 0
+            with open(self._path(name), "rb") as f:
+                f.seek(offset)
+                while len(entries) < limit:
+                    line = f.readline()
+                    if not line.endswith(b"\n"):
+                        break  # End of segment or a line still being written
+                    offset += len(line)
+                    try:
+                        entries.append(json.loads(line))
+                        self._entry_ends.append((segment, offset))
+                    except ValueError:
+                        logger.warning(f"Skipping corrupt outbox entry in {name}")
+            if len(entries) >= limit:
+                break
+        self._batch_end = (segment, offset)
+        return entries
+
+    def ack(self, count: Optional[int] = None):
+        """Mark the readings of the last batch as replayed.
+
+        With ``count`` only the first ``count`` readings are; the next batch
+        starts with the rest.
+        """
+        if self._batch_end is None:
+            return
+        if count is None or count >= len(self._entry_ends):
+            end = self._batch_end
+        elif count > 0:
+            end = self._entry_ends[count - 1]
+        else:
+            return
+        self.segment, self.offset = end
+        self._batch_end = None
+        self._entry_ends = []
+        # Fully replayed segments other than the newest can go
+        segments = self._segments()
+        for name in segments[:-1]:
+            if name < self.segment or (
+                name == self.segment and self.offset >= path.getsize(self._path(name))
+            ):
+                remove(self._path(name))
+        self._save_cursor()
+
+
+class DiscoveryCache:
+    """Hashes of the discovery configs already published, by topic.
+
+    Discovery configs are retained by the broker, so a config that did not
+    change since it was last published does not need to be sent again, not
+    even after a restart when the hashes are persisted to ``file_path``.
+    """
+
+    def __init__(self, file_path: Optional[str] = None):
+        self.file_path = file_path
+        self.hashes: Dict[str, str] = {}
+        self.dirty = False
+        if file_path and path.exists(file_path):
+            try:
+                with open(file_path, "r") as f:
+                    self.hashes = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable discovery cache {file_path}: {e}")
+
+    @staticmethod
+    def digest(payload: str) -> str:
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def changed(self, topic: str, payload: str) -> bool:
+        """Whether the payload differs from the one last published to topic."""
+        return self.hashes.get(topic) != self.digest(payload)
+
+    def remember(self, topic: str, payload: str):
+        self.hashes[topic] = self.digest(payload)
+        self.dirty = True
+
+    def forget(self, topic: str):
+        if self.hashes.pop(topic, None) is not None:
+            self.dirty = True
+
+    def save(self):
+        """Persist the hashes if they changed since the last save."""
+        if not self.file_path or not self.dirty:
+            return
+        temp_path = self.file_path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(self.hashes, f)
+            replace(temp_path, self.file_path)
+            self.dirty = False
+        except OSError as e:
+            logger.warning(f"Failed to save discovery cache {self.file_path}: {e}")
+
+
+class HomeAssistantMQTTPublisher:
+    """MQTT Publisher with Home Assistant auto-discovery support."""
+
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self.client: Optional["mqtt.Client"] = None
+        self.qos = int(config.get("mqtt_qos", 0))
+        self.connected = threading.Event()
+        # Message ids of QoS 1/2 messages not yet acknowledged by the broker
+        self.pending: Dict[int, str] = {}
+        self._acked_early: Set[int] = set()
+        self._pending_lock = threading.Lock()
+        self.discovery_sent: Set[str] = set()
+        self.discovery_cache = DiscoveryCache(config.get("discovery_cache") or None)
+        # Devices whose discovery must be re-sent regardless of the cache
+        self.discovery_forced: Set[str] = set()
+        # Known before their first reading, so the outbox can be replayed
+        self.devices: Dict[str, Dict[str, Any]] = {
+            device["device_id"]: device
+            for device in config.get("inverters", [config])
+            if "device_id" in device
+        }
+        # Last value of every field by device, as readings only carry the
+        # fields polled in their cycle
+        self.state: Dict[str, Reading] = {}
+        self.outbox: Optional[Outbox] = None
+        if config.get("outbox_dir"):
+            self.outbox = Outbox(
+                config["outbox_dir"],
+                max_bytes=int(config.get("outbox_max_mb", 50)) * 1024 * 1024,
+                max_age=float(config.get("outbox_max_age_hours", 168)) * 3600,
+            )
+        self.change_filter: Optional[ChangeFilter] = None
+        if config.get("publish_on_change"):
+            self.change_filter = ChangeFilter(
+                config.get("deadbands"), config.get("keyframe_interval", 600)
+            )
+        self.status_events: Optional[StatusEvents] = None
+        if config.get("status_events"):
+            self.status_events = StatusEvents()
+        # Called in the event loop with the payload of a command message
+        self.on_command: Optional[Callable[[bytes], Any]] = None
+        # Loop owning the device and discovery state, see _in_loop
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _device(self, device: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Return the device/topic settings, defaulting to the top-level config."""
+        return device if device is not None else self.config
+
+    def _create_client(self) -> "mqtt.Client":
+        """Create and configure MQTT client."""
+        import paho.mqtt.client as mqtt
+
+        client = mqtt.Client(client_id=f"solarmax_{self.config['device_id']}")
+
+        if self.config.get("mqtt_username") and self.config.get("mqtt_password"):
+            client.username_pw_set(
+                username=self.config["mqtt_username"],
+                password=self.config["mqtt_password"],
+            )
+
+        # Let the broker mark the agent offline if the connection is lost
+        client.will_set(
+            self.config["availability_topic"], "offline", qos=self.qos, retain=True
+        )
+
+        # Bound the in-flight window and the queue of unsent QoS 1/2 messages;
+        # paho reconnects on its own with this backoff
+        client.max_inflight_messages_set(self.config.get("mqtt_max_inflight", 20))
+        client.max_queued_messages_set(self.config.get("mqtt_max_queued", 1000))
+        client.reconnect_delay_set(min_delay=1, max_delay=MQTT_RECONNECT_MAX_DELAY)
+
+        # Set up callbacks for better debugging
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_publish = self._on_publish
+        client.on_message = self._on_message
+
+        return client
+
+    def start(self):
+        """Start connecting to the broker in the background, if not yet started."""
+        if self.client is not None:
+            return
+        try:
+            self.loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.loop = None
+        self.client = self._create_client()
+        self.client.connect_async(
+            self.config["mqtt_host"], self.config["mqtt_port"], 60
+        )
+        self.client.loop_start()
+
+    def wait_connected(self, timeout: float) -> bool:
+        """Block until the broker acknowledged the connection or timeout."""
+        return self.connected.wait(timeout)
+
+    def _in_loop(self, callback: Callable[..., Any], *args: Any):
+        """Run a callback of paho's network thread in the event loop.
+
+        The loop publishes readings and changes the device and discovery
+        state meanwhile. Without a loop the callback runs right away.
+        """
+        if self.loop is None or self.loop.is_closed():
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def _announce_online(self):
+        """Publish availability for every known inverter."""
+        for device in self.devices.values():
+            self._publish_availability("online", device)
+
+    def _rediscover(self):
+        """Re-send all discovery configs with the next readings."""
+        logger.info("Home Assistant came online, re-sending discovery")
+        self.discovery_forced.update(self.devices)
+        self._announce_online()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        """Callback for when the client connects to the MQTT broker."""
+        if rc == 0:
+            logger.info("Successfully connected to MQTT broker")
+            self.connected.set()
+            self._in_loop(self._announce_online)
+            # Home Assistant announces restarts on its status topic
+            if self.config.get("home_assistant_discovery", True):
+                client.subscribe(f"{self.config['discovery_prefix']}/status")
+            if self.on_command is not None:
+                client.subscribe(self.command_topic)
+        else:
+            logger.error(f"Failed to connect to MQTT broker with code {rc}")
+
+    def _on_disconnect(self, client, userdata, rc):
+        """Callback for when the client disconnects from the MQTT broker."""
+        self.connected.clear()
+        logger.warning(f"Disconnected from MQTT broker with code {rc}")
+
+    @property
+    def command_topic(self) -> str:
+        """Topic of the runtime configuration commands."""
+        return f"{self.config['mqtt_topic_prefix']}/set"
+
+    def enable_commands(self, callback: Callable[[bytes], Any]):
+        """Pass the payloads of messages on the command topic to callback."""
+        self.on_command = callback
+        if self.client is not None and self.connected.is_set():
+            self.client.subscribe(self.command_topic)
+
+    def _on_message(self, client, userdata, message):
+        """Handle commands, and re-send discovery when Home Assistant comes online."""
+        if message.topic == self.command_topic:
+            if self.on_command is not None:
+                self._in_loop(self.on_command, message.payload)
+        elif message.payload == b"online" and not message.retain:
+            # A retained status is delivered on every subscribe; only a live
+            # birth message means that Home Assistant restarted
+            self._in_loop(self._rediscover)
+
+    def _on_publish(self, client, userdata, mid):
+        """Callback for when a message is published."""
+        with self._pending_lock:
+            if self.pending.pop(mid, None) is None and self.qos > 0:
+                self._acked_early.add(mid)
+        logger.debug("Message %s published successfully", mid)
+
+    def _publish(self, topic: str, payload: str, retain: bool = True) -> bool:
+        """Publish a message; False if it was dropped instead of sent or queued."""
+        if self.client is None:
+            return False
+        info = self.client.publish(topic, payload, qos=self.qos, retain=retain)
+        # QoS 1/2 messages are queued by paho while the broker is unreachable
+        if info.rc == MQTT_ERR_SUCCESS or (
+            self.qos > 0 and info.rc == MQTT_ERR_NO_CONN
+        ):
+            if self.qos > 0:
+                with self._pending_lock:
+                    if info.mid in self._acked_early:
+                        self._acked_early.discard(info.mid)
+                    else:
+                        self.pending[info.mid] = topic
+            return True
+        import paho.mqtt.client as mqtt
+
+        logger.warning(f"Dropped MQTT message to {topic}: {mqtt.error_string(info.rc)}")
+        return False
+
+    def _publish_availability(
+        self, status: str, device: Optional[Dict[str, Any]] = None
+    ):
+        """Publish availability status for Home Assistant."""
+        device = self._device(device)
+        self._publish(device["availability_topic"], status)
+
+    def _send_discovery_config(
+        self,
+        field: str,
+        field_data: Dict[str, Any],
+        device: Optional[Dict[str, Any]] = None,
+        force: bool = False,
+    ) -> bool:
+        """Send Home Assistant discovery configuration for a sensor.
+
+        Unless forced, configs identical to the last published one are
+        skipped. Returns whether the config was sent.
+        """
+        if not self.config.get("home_assistant_discovery", True):
+            return False
+
+        device = self._device(device)
+        sensor_name = f"{device['device_name']} {field}"
+        unique_id = f"{device['device_id']}_{field.lower()}"
+
+        # Create discovery topic
+        discovery_topic = self._discovery_topic(field, device)
+
+        # Create discovery payload
+        discovery_payload: Dict[str, Any] = {
+            "name": sensor_name,
+            "unique_id": unique_id,
+            "state_topic": f"{device['mqtt_topic_prefix']}/{field}",
+            "availability_topic": device["availability_topic"],
+            "device": self._device_info(device),
+            "json_attributes_topic": f"{device['mqtt_topic_prefix']}/attributes",
+        }
+
+        # In compact mode all sensors read their value from one state document
+        if self.config.get("compact_state"):
+            discovery_payload["state_topic"] = f"{device['mqtt_topic_prefix']}/state"
+            discovery_payload["value_template"] = f"{{{{ value_json.{field} }}}}"
+            del discovery_payload["json_attributes_topic"]
+
+        # Add device class if available
+        if field in DEVICE_CLASSES and DEVICE_CLASSES[field]:
+            discovery_payload["device_class"] = DEVICE_CLASSES[field]
+
+        # Add unit of measurement
+        if field in UNITS_OF_MEASUREMENT and UNITS_OF_MEASUREMENT[field]:
+            discovery_payload["unit_of_measurement"] = UNITS_OF_MEASUREMENT[field]
+
+        # Add state class for statistics
+        if field in STATE_CLASSES:
+            discovery_payload["state_class"] = STATE_CLASSES[field]
+
+        # Special handling for energy sensors (for Energy dashboard)
+        if field in ["KDY", "KMT", "KYR", "KT0"]:
+            discovery_payload["icon"] = "mdi:solar-power"
+            if field == "KT0":  # Total energy - important for energy dashboard
+                discovery_payload["last_reset_topic"] = (
+                    f"{device['mqtt_topic_prefix']}/last_reset"
+                )
+
+        # Special handling for power sensors
+        if field in ["PAC", "PDC", "PD01", "PD02", "PMAX", "PAVG", "EDAY", "SPY"]:
+            discovery_payload["icon"] = "mdi:solar-power"
+
+        # Special handling for status sensors
+        if field in ["SYS", "SAL"]:
+            discovery_payload["icon"] = "mdi:information"
+
+        return self._send_config(discovery_topic, discovery_payload, force)
+
+    def _discovery_topic(self, field: str, device: Dict[str, Any]) -> str:
+        """Topic of the discovery config of a field's sensor."""
+        return (
+            f"{self.config['discovery_prefix']}/sensor/"
+            f"{device['device_id']}/{field.lower()}/config"
+        )
+
+    def _device_info(self, device: Dict[str, Any]) -> Dict[str, Any]:
+        """The device block shared by all discovery configs of an inverter."""
+        return {
+            "identifiers": [device["device_id"]],
+            "name": device["device_name"],
+            "manufacturer": "Solarmax",
+            "model": "Inverter",
+            "sw_version": "1.0.0",
+        }
+
+    def _send_config(
+        self, topic: str, discovery_payload: Dict[str, Any], force: bool
+    ) -> bool:
+        """Publish a discovery config unless it is unchanged and not forced."""
+        payload = json.dumps(discovery_payload, sort_keys=True)
+        if not force and not self.discovery_cache.changed(topic, payload):
+            return False
+        if not self._publish(topic, payload):
+            return False
+        self.discovery_cache.remember(topic, payload)
+        logger.debug(f"Sent discovery config for {discovery_payload['name']}")
+        return True
+
+    def _send_status_discovery(self, device: Dict[str, Any], force: bool) -> int:
+        """Send the configs of the alarm binary sensors and the event entity.
+
+        Returns the number of configs sent.
+        """
+        prefix = self.config["discovery_prefix"]
+        device_id = device["device_id"]
+        sent = 0
+        for bit in ALARM_BITS:
+            sent += self._send_config(
+                f"{prefix}/binary_sensor/{device_id}/alarm_{bit}/config",
+                {
+                    "name": f"{device['device_name']} {ALARM_CODES[bit]}",
+                    "unique_id": f"{device_id}_alarm_{bit}",
+                    "state_topic": f"{device['mqtt_topic_prefix']}/alarm/{bit}",
+                    "availability_topic": device["availability_topic"],
+                    "device": self._device_info(device),
+                    "device_class": "problem",
+                },
+                force,
+            )
+        sent += self._send_config(
+            f"{prefix}/event/{device_id}/events/config",
+            {
+                "name": f"{device['device_name']} Events",
+                "unique_id": f"{device_id}_events",
+                "state_topic": f"{device['mqtt_topic_prefix']}/events",
+                "availability_topic": device["availability_topic"],
+                "device": self._device_info(device),
+                "event_types": EVENT_TYPES,
+                "icon": "mdi:alert-circle",
+            },
+            force,
+        )
+        return sent
+
+    def _publish_status_events(
+        self, data: Reading, device: Dict[str, Any], timestamp: float
+    ):
+        """Publish changed alarm states and the status and alarm events."""
+        assert self.status_events is not None
+        changed, events = self.status_events.update(
+            device["device_id"], data, timestamp
+        )
+        prefix = device["mqtt_topic_prefix"]
+        for bit, active in changed.items():
+            self._publish(f"{prefix}/alarm/{bit}", "ON" if active else "OFF")
+        # Events are not retained, so they are only seen once
+        for event in events:
+            payload = json.dumps(event)
+            self._publish(f"{prefix}/events", payload, retain=False)
+            logger.info(f"Event of {device['device_name']}: {payload}")
+
+    def publish_data(
+        self, data: Mapping[str, Any], device: Optional[Dict[str, Any]] = None
+    ) -> bool:
+        """Publish the data to MQTT broker with Home Assistant support.
+
+        With an outbox, readings taken while the broker is unreachable, or
+        while older readings are still being replayed, are stored on disk.
+        """
+        data = Reading.of(data)
+        device = self._device(device)
+        self.devices[device["device_id"]] = device
+        self.start()
+        if self.outbox is not None:
+            if self.connected.is_set() and not self.outbox.pending():
+                if self._publish_reading(data, device):
+                    return True
+            self.outbox.append(device["device_id"], data.to_dict(), time.time())
+            logger.debug(f"Stored reading of {device['device_name']} in the outbox")
+            return True
+        return self._publish_reading(data, device)
+
+    def reconfigure(self, config: Dict[str, Any], removed_fields: Iterable[str] = ()):
+        """Apply changed reloadable options.
+
+        The sensors of fields no longer polled are removed from Home
+        Assistant. Discovery is sent again with the next reading of every
+        inverter, skipping configs that did not change, so that sensors of
+        new fields appear.
+        """
+        for name in RELOADABLE_OPTIONS:
+            if name in config:
+                self.config[name] = config[name]
+        if self.change_filter is not None:
+            self.change_filter.configure(
+                config.get("deadbands"), config.get("keyframe_interval", 600)
+            )
+        removed_fields = list(removed_fields)
+        if removed_fields:
+            # Later readings must not bring back the values of removed fields
+            for device_id, reading in self.state.items():
+                self.state[device_id] = Reading.from_entries(
+                    reading.schema,
+                    (
+                        entry
+                        for entry in reading.entries()
+                        if entry[0] not in removed_fields
+                    ),
+                )
+        if removed_fields and self.config.get("home_assistant_discovery", True):
+            for device in self.devices.values():
+                for field in removed_fields:
+                    topic = self._discovery_topic(field, device)
+                    # An empty retained config deletes the sensor
+                    self._publish(topic, "")
+                    self.discovery_cache.forget(topic)
+            self.discovery_cache.save()
+        self.discovery_sent.clear()
+
+    def collect_metrics(self):
+        """Refresh the connection and queue gauges before a scrape."""
+        METRICS.set("solarmax_mqtt_connected", int(self.connected.is_set()))
+        with self._pending_lock:
+            METRICS.set("solarmax_mqtt_pending_messages", len(self.pending))
+        if self.outbox is not None:
+            METRICS.set("solarmax_outbox_bytes", self.outbox.pending_bytes())
+
+    async def replay_outbox(self, rate: float):
+        """Replay stored readings in order, at most ``rate`` per second."""
+        while self.outbox is not None:
+            if not self.connected.is_set() or not self.outbox.pending():
+                await asyncio.sleep(1)
+                continue
+            batch = self.outbox.read_batch(max(int(rate), 1))
+            # Acknowledge each reading once sent, so none is published twice
+            replayed = 0
+            for entry in batch:
+                device = self.devices.get(entry["device"])
+                if device is None:
+                    logger.warning(
+                        f"Dropping outbox reading of unknown device {entry['device']}"
+                    )
+                elif not self._publish_reading(entry["data"], device, entry.get("ts")):
+                    break
+                replayed += 1
+            self.outbox.ack(replayed)
+            if replayed:
+                logger.info(f"Replayed {replayed} reading(s) from the outbox")
+            await asyncio.sleep(max(len(batch), 1) / rate)
+
+    def _publish_reading(
+        self,
+        data: Mapping[str, Any],
+        device: Dict[str, Any],
+        timestamp: Optional[float] = None,
+    ) -> bool:
+        """Publish one reading of a device to the broker.
+
+        ``timestamp`` is when the reading was taken, by default now. A
+        replayed reading carries it in its state or attributes document.
+        Sensor topics get the fields of the reading, while discovery, the
+        attributes, the compact state and keyframes cover all fields.
+        """
+        data = Reading.of(data)
+        device_id = device["device_id"]
+        previous = self.state.get(device_id)
+        # Readings are replayed before newer ones are published, so they are
+        # merged in the order they were taken
+        self.state[device_id] = full = (
+            data if previous is None else previous.merged(data)
+        )
+        try:
+            # QoS 0 messages would be lost, paho queues QoS 1/2 until reconnected
+            if not self.connected.is_set() and self.qos == 0:
+                logger.warning(
+                    f"MQTT broker not connected, dropping reading "
+                    f"of {device['device_name']}"
+                )
+                return False
+
+            # Send new or changed discovery configs once per run and inverter,
+            # and all of them again after Home Assistant restarted
+            forced = device_id in self.discovery_forced
+            if (forced or device_id not in self.discovery_sent) and self.config.get(
+                "home_assistant_discovery", True
+            ):
+                self.discovery_forced.discard(device_id)
+                sent = sum(
+                    self._send_discovery_config(field, full[field], device, forced)
+                    for field in full
+                )
+                if self.status_events is not None and "SAL" in full:
+                    sent += self._send_status_discovery(device, forced)
+                self.discovery_sent.add(device_id)
+                self.discovery_cache.save()
+                logger.info(
+                    f"Sent {sent} of {len(full)} Home Assistant discovery "
+                    f"configurations for {device['device_name']}"
+                )
+
+            # In change-only mode, skip values within their deadband
+            change_filter = self.change_filter
+            now = time.monotonic()
+            keyframe = True
+            if change_filter is not None:
+                keyframe = change_filter.start_cycle(device_id, now)
+
+            # Keyframes of change-only mode send the values of all fields
+            values = dict(full.value_items())
+            if change_filter is not None:
+                changed = [
+                    field
+                    for field in (full if keyframe else data)
+                    if change_filter.changed(
+                        device_id, field, values[field], force=keyframe
+                    )
+                ]
+            else:
+                changed = list(data)
+
+            if self.config.get("compact_state"):
+                # One JSON document per cycle with all values of the inverter
+                published = len(changed)
+                if changed or keyframe:
+                    state_topic = f"{device['mqtt_topic_prefix']}/state"
+                    state: Dict[str, Any] = values
+                    if timestamp is not None:
+                        state = {**values, "timestamp": timestamp}
+                    payload = json.dumps(state, separators=(",", ":"))
+                    if not self._publish(state_topic, payload):
+                        return False
+                    if change_filter is not None:
+                        for field in changed:
+                            change_filter.remember(device_id, field, values[field])
+            else:
+                # Publish individual sensor values; a dropped message leaves
+                # the reading to the outbox, if there is one
+                published = 0
+                for field in changed:
+                    topic = f"{device['mqtt_topic_prefix']}/{field}"
+                    if not self._publish(topic, str(values[field])):
+                        return False
+                    if change_filter is not None:
+                        change_filter.remember(device_id, field, values[field])
+                    published += 1
+
+                # The attributes are by far the largest message and change with
+                # any value, so change-only mode only sends them with keyframes
+                if keyframe:
+                    # Publish full data as attributes
+                    attributes_topic = f"{device['mqtt_topic_prefix']}/attributes"
+                    attributes: Dict[str, Any] = full.to_dict()
+                    if timestamp is not None:
+                        attributes["timestamp"] = timestamp
+                    if not self._publish(attributes_topic, json.dumps(attributes)):
+                        return False
+
+            if self.status_events is not None:
+                self._publish_status_events(
+                    data, device, time.time() if timestamp is None else timestamp
+                )
+
+            if keyframe:
+                # Update availability
+                self._publish_availability("online", device)
+                if change_filter is not None:
+                    change_filter.keyframe_sent(device_id, now)
+
+            logger.info(
+                "Published %d of %d sensors of %s",
+                published,
+                len(full),
+                device["device_name"],
+            )
+            return True
+
+        except Exception as e:
+            logger.error(f"Failed to publish MQTT message: {e}")
+            return False
+
+    def disconnect(self):
+        """Disconnect from MQTT broker."""
+        if self.client:
+            for device in self.devices.values():
+                self._publish_availability("offline", device)
+            # Give outstanding QoS 1/2 messages a moment to be acknowledged
+            deadline = time.monotonic() + MQTT_DRAIN_TIMEOUT
+            while self.pending and self.connected.is_set():
+                if time.monotonic() > deadline:
+                    break
+                time.sleep(0.05)
+            self.client.disconnect()
+            self.client.loop_stop()
+            self.client = None
+            self.connected.clear()
+
+
+def escape_tag(value: str) -> str:
+    """Escape a tag key or value for the InfluxDB line protocol."""
+    return (
+        value.replace("\\", "\\\\")
+        .replace(",", "\\,")
+        .replace("=", "\\=")
+        .replace(" ", "\\ ")
+    )
+
+
+class SinkRecord:
+    """One reading on its way to the sinks.
+
+    Each serialization is built on first use and shared by all sinks that
+    need it, so a reading is serialized once per format, not once per sink.
+    """
+
+    __slots__ = ("device", "data", "timestamp", "_json", "_line", "_csv")
+
+    def __init__(
+        self, device: Dict[str, Any], data: Mapping[str, Any], timestamp: float
+    ):
+        self.device = device
+        self.data = Reading.of(data)
+        self.timestamp = timestamp
+        self._json: Optional[str] = None
+        self._line: Optional[str] = None
+        self._csv: Optional[str] = None
+
+    def to_json(self) -> str:
+        """The reading as one JSON line with the values by field."""
+        if self._json is None:
+            self._json = json.dumps(
+                {
+                    "timestamp": self.timestamp,
+                    "device": self.device["device_id"],
+                    "values": dict(self.data.value_items()),
+                }
+            )
+        return self._json
+
+    def to_line_protocol(self) -> str:
+        """The reading in the InfluxDB line protocol, with nanosecond time."""
+        if self._line is None:
+            fields = []
+            for field, value, raw in self.data.entries():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    # Status texts are stored by their code
+                    value = raw
+                    if not isinstance(value, int):
+                        continue
+                fields.append(
+                    f"{escape_tag(field)}={value}i"
+                    if isinstance(value, int)
+                    else f"{escape_tag(field)}={value}"
+                )
+            self._line = (
+                f"solarmax,device={escape_tag(self.device['device_id'])} "
+                f"{','.join(fields)} {int(self.timestamp * 1e9)}"
+            )
+        return self._line
+
+    def to_csv(self) -> str:
+        """The reading as CSV rows of timestamp, device, field and value."""
+        if self._csv is None:
+            output = io.StringIO()
+            writer = csv.writer(output, lineterminator="\n")
+            for field, value in self.data.value_items():
+                writer.writerow(
+                    [self.timestamp, self.device["device_id"], field, value]
+                )
+            self._csv = output.getvalue()
+        return self._csv
+
+
+class Sink:
+    """Destination of readings, fed from its own queue by the fan-out stage."""
+
+    # Readings handed to write() at once
+    batch_size = 1
+
+    def __init__(self, name: str):
+        self.name = name
+
+    async def write(self, records: List[SinkRecord]):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MQTTSink(Sink):
+    """Publishes readings through the Home Assistant MQTT publisher."""
+
+    def __init__(self, publisher: HomeAssistantMQTTPublisher):
+        super().__init__("mqtt")
+        self.publisher = publisher
+
+    async def write(self, records: List[SinkRecord]):
+        for record in records:
+            self.publisher.publish_data(record.data, record.device)
+
+
+class InfluxHTTPSink(Sink):
+    """Writes readings to an InfluxDB write endpoint over HTTP.
+
+    ``url`` is the complete write URL, e.g.
+    ``http://influxdb:8086/api/v2/write?org=home&bucket=solar`` or
+    ``http://influxdb:8086/write?db=solar`` for InfluxDB 1.x.
+    """
+
+    batch_size = 100
+
+    def __init__(self, url: str, token: str = "", timeout: float = 10):
+        super().__init__("influx_http")
+        self.url = url
+        self.token = token
+        self.timeout = timeout
+
+    def _post(self, body: bytes):
+        import urllib.request
+
+        request = urllib.request.Request(self.url, data=body, method="POST")
+        request.add_header("Content-Type", "text/plain; charset=utf-8")
+        if self.token:
+            request.add_header("Authorization", f"Token {self.token}")
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+    async def write(self, records: List[SinkRecord]):
+        body = "\n".join(record.to_line_protocol() for record in records).encode()
+        await asyncio.get_running_loop().run_in_executor(None, self._post, body)
+
+
+class InfluxUDPSink(Sink):
+    """Sends readings to an InfluxDB UDP listener, one datagram per reading."""
+
+    def __init__(self, host: str, port: int):
+        super().__init__("influx_udp")
+        self.host = host
+        self.port = port
+        self.transport: Optional[asyncio.DatagramTransport] = None
+
+    async def write(self, records: List[SinkRecord]):
+        if self.transport is None:
+            (
+                self.transport,
+                _,
+            ) = await asyncio.get_running_loop().create_datagram_endpoint(
+                asyncio.DatagramProtocol, remote_addr=(self.host, self.port)
+            )
+        for record in records:
+            self.transport.sendto(record.to_line_protocol().encode())
+
+    async def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class FileSink(Sink):
+    """Appends readings to a rotating NDJSON or CSV file.
+
+    Once the file exceeds ``max_bytes`` it is renamed to ``.1``, older
+    files are shifted up to ``backups`` and the oldest is removed.
+    """
+
+    batch_size = 100
+
+    def __init__(
+        self,
+        file_path: str,
+        fmt: str = "ndjson",
+        max_bytes: int = 10 * 1024 * 1024,
+        backups: int = 3,
+    ):
+        super().__init__(f"file:{file_path}")
+        if fmt not in ("ndjson", "csv"):
+            raise ValueError(f"Unknown file format: {fmt}")
+        self.path = file_path
+        self.format = fmt
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def _rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            if path.exists(f"{self.path}.{index}"):
+                replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups:
+            replace(self.path, f"{self.path}.1")
+        else:
+            remove(self.path)
+
+    def _append(self, text: str):
+        new_file = not path.exists(self.path)
+        with open(self.path, "a") as f:
+            if new_file and self.format == "csv":
+                f.write("timestamp,device,field,value\n")
+            f.write(text)
+            size = f.tell()
+        if size > self.max_bytes:
+            self._rotate()
+
+    async def write(self, records: List[SinkRecord]):
+        if self.format == "csv":
+            text = "".join(record.to_csv() for record in records)
+        else:
+            text = "".join(record.to_json() + "\n" for record in records)
+        # File writes may stall on slow storage; keep them off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self._append, text)
+
+
+# Resolutions of the history store: name -> (seconds, partition format)
+HISTORY_RESOLUTIONS = {
+    "raw": (0, "%Y%m%d"),
+    "1m": (60, "%Y%m%d"),
+    "15m": (900, "%Y%m"),
+}
+
+# Samples are stored as (timestamp, value), rollups as
+# (bucket start, min, max, mean, sample count)
+RAW_RECORD = struct.Struct("<If")
+ROLLUP_RECORD = struct.Struct("<IfffI")
+
+# Default days each resolution is kept
+HISTORY_RETENTION_DAYS = {"raw": 7, "1m": 90, "15m": 730}
+
+# Fields stored by default: power, string voltages and currents
+HISTORY_FIELDS = ["PAC", "PDC", "PD01", "PD02", "UD01", "UD02", "ID01", "ID02"]
+
+
+class HistoryStore:
+    """Embedded time series store with one column file per field.
+
+    Samples are appended as fixed-size binary records to files partitioned
+    by day (by month for 15 minute rollups) and rolled up into 1 and 15
+    minute buckets with min/max/mean on the fly. Rows are buffered in
+    memory and written in one append per file and flush, which keeps
+    writes to SD cards rare. Expired partitions are deleted as a whole.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        fields: Optional[List[str]] = None,
+        retention_days: Optional[Dict[str, float]] = None,
+    ):
+        self.directory = directory
+        self.fields = fields or HISTORY_FIELDS
+        self.retention_days = {**HISTORY_RETENTION_DAYS, **(retention_days or {})}
+        # (device, field, resolution) -> rows not yet written
+        self.rows: Dict[Tuple[str, str, str], List[Tuple[Any, ...]]] = {}
+        # (device, field, resolution) -> [start, min, max, sum, count]
+        self.buckets: Dict[Tuple[str, str, str], List[float]] = {}
+        self.last_expiry = 0.0
+
+    def _column_dir(self, device_id: str, field: str, resolution: str) -> str:
+        safe_device = re.sub(r"[^A-Za-z0-9_.-]", "_", device_id)
+        return path.join(self.directory, safe_device, field, resolution)
+
+    def append(self, device_id: str, field: str, timestamp: float, value: float):
+        """Add a sample and update the rollups."""
+        ts = int(timestamp)
+        self.rows.setdefault((device_id, field, "raw"), []).append((ts, value))
+        self._roll(device_id, field, "1m", ts, value, value, value, 1)
+
+    def _roll(self, device_id, field, resolution, ts, low, high, total, count):
+        key = (device_id, field, resolution)
+        seconds = HISTORY_RESOLUTIONS[resolution][0]
+        start = ts - ts % seconds
+        bucket = self.buckets.get(key)
+        if bucket is not None and bucket[0] != start:
+            self._emit(key, bucket)
+            bucket = None
+        if bucket is None:
+            self.buckets[key] = [start, low, high, total, count]
+        else:
+            bucket[1] = min(bucket[1], low)
+            bucket[2] = max(bucket[2], high)
+            bucket[3] += total
+            bucket[4] += count
+
+    def _emit(self, key: Tuple[str, str, str], bucket: List[float]):
+        """Store a completed bucket and feed it into the next coarser rollup."""
+        device_id, field, resolution = key
+        start, low, high, total, count = bucket
+        self.rows.setdefault(key, []).append(
+            (int(start), low, high, total / count, int(count))
+        )
+        if resolution == "1m":
+            self._roll(device_id, field, "15m", int(start), low, high, total, count)
+
+    def close_buckets(self):
+        """Store the buckets in progress, e.g. before shutting down."""
+        for resolution in ("1m", "15m"):
+            for key in [key for key in self.buckets if key[2] == resolution]:
+                self._emit(key, self.buckets.pop(key))
+
+    def take_rows(self) -> Dict[Tuple[str, str, str], List[Tuple[Any, ...]]]:
+        """Hand over the buffered rows for writing."""
+        rows, self.rows = self.rows, {}
+        return rows
+
+    def write_rows(self, rows: Dict[Tuple[str, str, str], List[Tuple[Any, ...]]]):
+        """Append rows to their partition files; blocking."""
+        for (device_id, field, resolution), column_rows in rows.items():
+            record = RAW_RECORD if resolution == "raw" else ROLLUP_RECORD
+            partition_format = HISTORY_RESOLUTIONS[resolution][1]
+            directory = self._column_dir(device_id, field, resolution)
+            makedirs(directory, exist_ok=True)
+            partitions: Dict[str, List[bytes]] = {}
+            for row in column_rows:
+                name = time.strftime(partition_format, time.gmtime(row[0]))
+                partitions.setdefault(name, []).append(record.pack(*row))
+            for name, packed in partitions.items():
+                with open(path.join(directory, name + ".bin"), "ab") as f:
+                    f.write(b"".join(packed))
+        if time.time() - self.last_expiry > 3600:
+            self.expire()
+
+    def expire(self, now: Optional[float] = None):
+        """Delete partitions that are entirely older than their retention."""
+        now = time.time() if now is None else now
+        self.last_expiry = now
+        if not path.isdir(self.directory):
+            return
+        for resolution, days in self.retention_days.items():
+            partition_format = HISTORY_RESOLUTIONS[resolution][1]
+            oldest = time.strftime(partition_format, time.gmtime(now - days * 86400))
+            for device_id in listdir(self.directory):
+                device_dir = path.join(self.directory, device_id)
+                for field in listdir(device_dir):
+                    directory = path.join(device_dir, field, resolution)
+                    if not path.isdir(directory):
+                        continue
+                    for name in listdir(directory):
+                        # Partition names sort like their dates
+                        if name[:-4] < oldest:
+                            remove(path.join(directory, name))
+
+    def query(
+        self,
+        device_id: str,
+        field: str,
+        start: float,
+        end: float,
+        resolution: Optional[str] = None,
+    ) -> Tuple[str, List[Tuple[Any, ...]]]:
+        """Return the resolution and rows of a field between start and end.
+
+        Without a resolution the finest one that keeps the result small is
+        chosen: samples for up to 6 hours, 1 minute rollups up to 7 days.
+        Raw rows are (timestamp, value), rollups (start, min, max, mean, count).
+        """
+        if resolution is None:
+            span = end - start
+            resolution = (
+                "raw" if span <= 6 * 3600 else "1m" if span <= 7 * 86400 else "15m"
+            )
+        record = RAW_RECORD if resolution == "raw" else ROLLUP_RECORD
+        partition_format = HISTORY_RESOLUTIONS[resolution][1]
+        first = time.strftime(partition_format, time.gmtime(start))
+        last = time.strftime(partition_format, time.gmtime(end))
+        directory = self._column_dir(device_id, field, resolution)
+
+        rows: List[Tuple[Any, ...]] = []
+        if path.isdir(directory):
+            for name in sorted(listdir(directory)):
+                if first <= name[:-4] <= last:
+                    try:
+                        with open(path.join(directory, name), "rb") as f:
+                            data = f.read()
+                    except FileNotFoundError:
+                        # Expired by the writer thread after it was listed
+                        continue
+                    usable = len(data) - len(data) % record.size
+                    rows.extend(record.iter_unpack(data[:usable]))
+        rows.extend(self.rows.get((device_id, field, resolution), []))
+        bucket = self.buckets.get((device_id, field, resolution))
+        if bucket is not None:  # Include the bucket in progress
+            rows.append(
+                (
+                    int(bucket[0]),
+                    bucket[1],
+                    bucket[2],
+                    bucket[3] / bucket[4],
+                    int(bucket[4]),
+                )
+            )
+        rows = [row for row in rows if start <= row[0] < end]
+        if resolution != "raw":
+            rows = merge_rollups(rows)
+        return resolution, rows
+
+
+def merge_rollups(rows: List[Tuple[Any, ...]]) -> List[Tuple[Any, ...]]:
+    """Combine rollup rows of the same bucket, written before and after a restart."""
+    merged: Dict[int, Tuple[Any, ...]] = {}
+    for row in rows:
+        previous = merged.get(row[0])
+        if previous is None:
+            merged[row[0]] = row
+            continue
+        count = previous[4] + row[4]
+        mean = (previous[3] * previous[4] + row[3] * row[4]) / count
+        merged[row[0]] = (
+            row[0],
+            min(previous[1], row[1]),
+            max(previous[2], row[2]),
+            mean,
+            count,
+        )
+    return [merged[start] for start in sorted(merged)]
+
+
+class HistorySink(Sink):
+    """Feeds readings into the history store and writes it periodically."""
+
+    def __init__(self, store: HistoryStore, flush_interval: float = 60):
+        super().__init__("history")
+        self.store = store
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+
+    async def write(self, records: List[SinkRecord]):
+        for record in records:
+            for field in self.store.fields:
+                value = record.data.value(field)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self.store.append(
+                        record.device["device_id"], field, record.timestamp, value
+                    )
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.last_flush = time.monotonic()
+            rows = self.store.take_rows()
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.store.write_rows, rows
+            )
+
+    async def close(self):
+        self.store.close_buckets()
+        self.store.write_rows(self.store.take_rows())
+
+
+def json_response(status: int, document: Any) -> Tuple[int, str, bytes]:
+    """An HTTP response with a JSON body."""
+    return status, "application/json", json.dumps(document).encode()
+
+
+def downsample(rows: List[Tuple[Any, ...]], step: int) -> List[Tuple[Any, ...]]:
+    """Combine rollup rows into buckets of ``step`` seconds."""
+    buckets = [(row[0] - row[0] % step,) + tuple(row[1:]) for row in rows]
+    return merge_rollups(buckets)
+
+
+class LatestReadings(Sink):
+    """Serves the latest reading of every inverter and the history over HTTP.
+
+    Responses are serialized on the first request after a reading arrived
+    and then served from a cache until the next reading, so frequent polling
+    by many clients costs a dictionary lookup per request.
+    """
+
+    # Distinct requests cached per cycle, to bound memory
+    MAX_CACHED_RESPONSES = 1000
+
+    def __init__(self, history: Optional[HistoryStore] = None):
+        super().__init__("latest")
+        self.history = history
+        self.readings: Dict[str, SinkRecord] = {}
+        self.responses: Dict[Tuple[str, str], Tuple[int, str, bytes]] = {}
+
+    async def write(self, records: List[SinkRecord]):
+        for record in records:
+            # Fields not polled in this cycle keep their last values
+            device_id = record.device["device_id"]
+            previous = self.readings.get(device_id)
+            if previous is not None:
+                record = SinkRecord(
+                    record.device, previous.data.merged(record.data), record.timestamp
+                )
+            self.readings[device_id] = record
+        self.responses.clear()
+
+    def route(self, request_path: str, query: Dict[str, str]) -> Tuple[int, str, bytes]:
+        """Answer a request from the cache, building the response if needed."""
+        key = (request_path, json.dumps(query, sort_keys=True))
+        response = self.responses.get(key)
+        if response is None:
+            response = self._respond(request_path, query)
+            if len(self.responses) < self.MAX_CACHED_RESPONSES:
+                self.responses[key] = response
+        return response
+
+    def _devices(self, query: Dict[str, str]) -> List[SinkRecord]:
+        if "device" in query:
+            record = self.readings.get(query["device"])
+            return [] if record is None else [record]
+        return list(self.readings.values())
+
+    def _respond(
+        self, request_path: str, query: Dict[str, str]
+    ) -> Tuple[int, str, bytes]:
+        parts = [part for part in request_path.split("/") if part]
+        if parts == ["latest"]:
+            return json_response(
+                200,
+                {
+                    record.device["device_id"]: {
+                        "timestamp": record.timestamp,
+                        "values": dict(record.data.value_items()),
+                    }
+                    for record in self._devices(query)
+                },
+            )
+        if len(parts) == 2 and parts[0] == "latest":
+            field = parts[1]
+            document = {
+                record.device["device_id"]: {
+                    "timestamp": record.timestamp,
+                    "value": record.data.value(field),
+                    "unit": UNITS_OF_MEASUREMENT.get(field),
+                }
+                for record in self._devices(query)
+                if field in record.data
+            }
+            if not document:
+                return json_response(404, {"error": f"No value of {field}"})
+            return json_response(200, document)
+        if parts == ["history"]:
+            return self._history(query)
+        return json_response(404, {"error": "Not found"})
+
+    def _history(self, query: Dict[str, str]) -> Tuple[int, str, bytes]:
+        if self.history is None:
+            return json_response(404, {"error": "History is not enabled"})
+        field = query.get("field", "PAC")
+        if field not in self.history.fields:
+            return json_response(404, {"error": f"{field} is not kept in the history"})
+        device_id = query.get("device") or next(iter(self.readings), None)
+        if device_id is None:
+            return json_response(404, {"error": "No readings yet"})
+        try:
+            end = float(query.get("to", time.time()))
+            start = float(query.get("from", end - 3600))
+            step = int(query.get("step", 0))
+        except ValueError:
+            return json_response(400, {"error": "from, to and step must be numbers"})
+        resolution: Optional[str] = None
+        if step:
+            resolution = "raw" if step < 60 else "1m" if step < 900 else "15m"
+        resolution, rows = self.history.query(device_id, field, start, end, resolution)
+        columns = ["timestamp", "min", "max", "mean", "count"]
+        if resolution == "raw":
+            if step > 1:
+                rows = downsample([(ts, v, v, v, 1) for ts, v in rows], step)
+            else:
+                columns = ["timestamp", "value"]
+        elif step > HISTORY_RESOLUTIONS[resolution][0]:
+            rows = downsample(rows, step)
+        # Values are stored as 32-bit floats; don't expose their noise digits
+        rows = [
+            tuple(float(f"{v:.7g}") if isinstance(v, float) else v for v in row)
+            for row in rows
+        ]
+        return json_response(
+            200,
+            {
+                "device": device_id,
+                "field": field,
+                "resolution": resolution,
+                "columns": columns,
+                "rows": rows,
+            },
+        )
+
+
+def create_sink(options: Dict[str, Any]) -> Sink:
+    """Create a sink from its configuration entry."""
+    sink_type = options.get("type")
+    if sink_type == "influx_http":
+        return InfluxHTTPSink(options["url"], options.get("token", ""))
+    if sink_type == "influx_udp":
+        return InfluxUDPSink(options["host"], int(options.get("port", 8089)))
+    if sink_type == "file":
+        return FileSink(
+            options["path"],
+            options.get("format", "ndjson"),
+            int(float(options.get("max_mb", 10)) * 1024 * 1024),
+            int(options.get("backups", 3)),
+        )
+    raise ValueError(f"Unknown sink type: {sink_type}")
+
+
+class FanOut:
+    """Delivers every reading to several sinks concurrently.
+
+    Each sink has its own bounded queue and worker task. When a sink falls
+    behind and its queue is full, its oldest reading is dropped, so a slow
+    sink never blocks polling or the other sinks. Offers the same
+    ``publish_data`` interface as the MQTT publisher.
+    """
+
+    def __init__(self, sinks: List[Sink], queue_size: int = 1000):
+        self.sinks = sinks
+        self.queue_size = queue_size
+        self.queues: Dict[str, "asyncio.Queue[SinkRecord]"] = {}
+        self.tasks: List["asyncio.Task[None]"] = []
+
+    def start(self):
+        """Start one worker per sink; needs a running event loop."""
+        for sink in self.sinks:
+            queue: "asyncio.Queue[SinkRecord]" = asyncio.Queue(self.queue_size)
+            self.queues[sink.name] = queue
+            self.tasks.append(asyncio.create_task(self._drain(sink, queue)))
+
+    def publish_data(self, data: Mapping[str, Any], device: Dict[str, Any]) -> bool:
+        """Queue a reading for every sink."""
+        record = SinkRecord(device, data, time.time())
+        for name, queue in self.queues.items():
+            if queue.full():
+                queue.get_nowait()
+                queue.task_done()
+                METRICS.inc("solarmax_sink_dropped_total", sink=name)
+                logger.warning(f"Sink {name} is falling behind, dropped a reading")
+            queue.put_nowait(record)
+        return True
+
+    async def _drain(self, sink: Sink, queue: "asyncio.Queue[SinkRecord]"):
+        while True:
+            records = [await queue.get()]
+            while len(records) < sink.batch_size and not queue.empty():
+                records.append(queue.get_nowait())
+            start = time.perf_counter()
+            try:
+                await sink.write(records)
+                METRICS.observe(
+                    "solarmax_sink_write_seconds",
+                    time.perf_counter() - start,
+                    sink=sink.name,
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                METRICS.inc("solarmax_sink_errors_total", sink=sink.name)
+                logger.warning(
+                    f"Sink {sink.name} failed to write {len(records)} reading(s): {e}"
+                )
+            finally:
+                for _ in records:
+                    queue.task_done()
+
+    def collect_metrics(self):
+        """Refresh the queue depth gauges before a scrape."""
+        for name, queue in self.queues.items():
+            METRICS.set("solarmax_sink_queue_depth", queue.qsize(), sink=name)
+
+    async def close(self, timeout: float = MQTT_DRAIN_TIMEOUT):
+        """Give the sinks a moment to write what is queued, then stop them."""
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self.queues.values())),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Not all sinks finished writing before shutdown")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for sink in self.sinks:
+            await sink.close()
+
+
+class ShardOutput:
+    """Passes the readings of a worker process to the supervisor.
+
+    A reading is reduced to (field, value, raw value) tuples, the supervisor
+    knows the descriptions, and all readings of one event loop iteration are
+    sent as a single pickled message. With metrics enabled, the heartbeat
+    also carries a snapshot of the worker's metrics.
+    """
+
+    def __init__(self, connection: "Connection"):
+        self.connection = connection
+        self.pending: List[Tuple[str, List[Tuple[str, Any, Any]]]] = []
+        self.scheduled = False
+
+    def publish_data(self, data: Mapping[str, Any], device: Dict[str, Any]) -> bool:
+        values = list(Reading.of(data).entries())
+        self.pending.append((device["device_id"], values))
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+        return True
+
+    def flush(self, with_metrics: bool = False):
+        """Send the pending readings; an empty batch serves as heartbeat."""
+        self.scheduled = False
+        batch, self.pending = self.pending, []
+        metrics = METRICS.snapshot() if with_metrics and METRICS.enabled else None
+        try:
+            self.connection.send_bytes(
+                pickle.dumps((batch, metrics), pickle.HIGHEST_PROTOCOL)
+            )
+        except OSError as e:
+            logger.debug(f"Supervisor not reachable: {e!r}")
+
+    async def heartbeat(self):
+        """Keep the supervisor informed that this worker is alive."""
+        while True:
+            await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+            # Pending readings go out early, a later scheduled flush is empty
+            self.flush(with_metrics=True)
+
+
+def convert_to_json(
+    field_map: Dict[str, str], data: Union[bytes, bytearray, memoryview, str]
+) -> Dict[str, Any]:
+    """Convert inverter response to JSON format."""
+    # Example data:
+    # b'{01;FB;EA|64:PAC=1F0A;PD01=CB2;PD02=13BA;PDC=206C;CAC=CAF;...}'
+    if isinstance(data, str):
+        data = data.encode("latin-1", errors="replace")
+    try:
+        result_dict = {}
+        for field, value in decode_values(data).items():
+            result_dict[field] = {
+                "Value": map_data_value(field, value),
+                "Description": field_map.get(field, field),
+                "Raw Value": value,
+            }
+
+        # Lazy formatting, this runs for every poll of every inverter
+        logger.debug("Converted data: %s", result_dict)
+        return result_dict
+
+    except Exception as e:
+        logger.error(f"Error converting data to JSON: {e}")
+        return {}
+
+
+def enable_keepalive(sock: socket.socket):
+    """Enable TCP keepalive so a half-open inverter session is detected."""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # The fine-grained options are platform specific (Linux has all of them)
+    for option, value in (
+        ("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+        ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+        ("TCP_KEEPCNT", KEEPALIVE_COUNT),
+    ):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+class InverterConnection:
+    """Handles the asyncio TCP connection to a Solarmax inverter.
+
+    By default a new connection is opened for every request. In persistent
+    mode the session is kept open across polls and reconnected when it drops.
+
+    Inverters chained behind one RS485 gateway share a connection: their
+    queries take turns on the bus, and the session stays open while others
+    wait, so a sweep over all addresses runs back-to-back on one session.
+    Replies are matched to the polled inverter by their source address.
+    """
+
+    def __init__(
+        self,
+        ip: str,
+        port: int,
+        timeout: float = 10,
+        persistent: bool = False,
+        reply_timeout: Optional[float] = None,
+    ):
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        # Shorter timeout for replies, so a silent inverter holds the bus briefly
+        self.reply_timeout = reply_timeout
+        self.persistent = persistent
+        # Pollers using this connection and queries waiting for the bus
+        self.users = 0
+        self.waiting = 0
+        self.lock: Optional[asyncio.Lock] = None
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.buffer = bytearray()
+        self.checksum_failures = 0
+        self.connects = 0
+        self.labels = {"inverter": f"{ip}:{port}"}
+
+    @property
+    def connected(self) -> bool:
+        """Whether the session is open and the inverter has not closed it."""
+        return (
+            self.reader is not None
+            and self.writer is not None
+            and not self.reader.at_eof()
+            and not self.writer.is_closing()
+        )
+
+    async def connect(self) -> bool:
+        """Establish connection to the inverter."""
+        start = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.ip, self.port), self.timeout
+            )
+            self.reader, self.writer = reader, writer
+            METRICS.observe(
+                "solarmax_connect_seconds", time.perf_counter() - start, **self.labels
+            )
+            if self.connects:
+                METRICS.inc("solarmax_reconnects_total", **self.labels)
+            self.connects += 1
+            if self.persistent:
+                sock = writer.get_extra_info("socket")
+                if sock is not None:
+                    enable_keepalive(sock)
+            logger.info("Connected to inverter at %s:%s", self.ip, self.port)
+            return True
+        except (OSError, asyncio.TimeoutError) as e:
+            METRICS.inc("solarmax_connect_failures_total", **self.labels)
+            logger.error(f"Failed to connect to inverter at {self.ip}:{self.port}: {e}")
+            return False
+
+    async def read_frame(self) -> bytes:
+        """Read bytes until one complete, checksum-valid frame is buffered."""
+        if self.reader is None:
+            raise ConnectionError("Not connected")
+        while True:
+            frame = extract_frame(self.buffer)
+            if frame is not None:
+                return frame
+            chunk = await self.reader.read(READ_CHUNK_SIZE)
+            if not chunk:
+                raise ConnectionError(
+                    f"Connection closed with {len(self.buffer)} bytes of a partial frame"
+                )
+            self.buffer += chunk
+
+    async def read_reply(self, address: Optional[int]) -> bytes:
+        """Read frames until one was sent by the inverter at ``address``.
+
+        Late replies of other inverters on the bus are skipped.
+        """
+        while True:
+            frame = await self.read_frame()
+            source = frame_source(frame)
+            if address is None or source == address:
+                return frame
+            logger.debug("Skipping reply from bus address %s", source)
+
+    async def read_data(self, request: str, address: Optional[int] = None) -> bytes:
+        """Send request and read the response frame from the inverter.
+
+        Returns the checksum-valid frame as received, or b"" if it failed.
+        """
+        if self.reader is None or self.writer is None:
+            return b""
+        try:
+            # Lazy formatting, this runs for every request of every inverter
+            logger.info("Sending request: %s", request)
+            self.buffer.clear()  # Drop anything left over from a previous reply
+            start = time.perf_counter()
+            self.writer.write(bytes(request, "utf-8"))
+            await self.writer.drain()
+
+            frame = await asyncio.wait_for(
+                self.read_reply(address), self.reply_timeout or self.timeout
+            )
+            METRICS.observe(
+                "solarmax_read_seconds", time.perf_counter() - start, **self.labels
+            )
+            METRICS.observe("solarmax_frame_bytes", len(frame), **self.labels)
+            logger.info("Received response: %s", frame)
+            return frame
+
+        except FrameError as e:
+            self.checksum_failures += 1
+            METRICS.inc("solarmax_checksum_failures_total", **self.labels)
+            logger.error(f"Invalid frame from inverter: {e}")
+            return b""
         except Exception as e:
-            logger.error(f"Unexpected error: {e}", exc_info=True)
-            time.sleep(60)  # Wait before retrying on errors
+            logger.error(f"Error reading data from inverter: {e!r}")
+            return b""
+
+    async def query(
+        self, request: str, address: Optional[int] = None
+    ) -> Optional[bytes]:
+        """Send a request and return the response, or None if unreachable."""
+        responses = await self.query_all([request], address)
+        return None if responses is None else responses[0]
+
+    def _must_reset(self) -> bool:
+        """Whether to reopen the session after a request failed.
+
+        On a gateway shared by several inverters a missing reply usually
+        means that one of them is silent, so an open session is kept.
+        """
+        return self.users < 2 or not self.connected
+
+    async def query_all(
+        self, requests: List[str], address: Optional[int] = None
+    ) -> Optional[List[bytes]]:
+        """Send requests back-to-back on one session and return the responses.
+
+        Returns None if the inverter is unreachable. A response is empty if
+        that request failed. A persistent session that went stale since the
+        last poll is reconnected once transparently before giving up.
+        """
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        self.waiting += 1
+        try:
+            await self.lock.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            return await self._query_all(requests, address)
+        finally:
+            self.lock.release()
+
+    async def _query_all(
+        self, requests: List[str], address: Optional[int]
+    ) -> Optional[List[bytes]]:
+        reused = self.connected
+        if not reused and not await self.connect():
+            return None
+        try:
+            responses: List[bytes] = []
+            for request in requests:
+                response = await self.read_data(request, address)
+                if not response and reused and not responses and self._must_reset():
+                    logger.info(
+                        f"Session to {self.ip}:{self.port} went stale, reconnecting"
+                    )
+                    await self.close()
+                    if not await self.connect():
+                        return None
+                    response = await self.read_data(request, address)
+                if not response and self._must_reset():
+                    # Don't reuse a session in an unknown state
+                    await self.close()
+                    if not await self.connect():
+                        return responses + [b""] * (len(requests) - len(responses))
+                responses.append(response)
+            return responses
+        finally:
+            # Inverters waiting for the bus continue on this session
+            if not self.persistent and not self.waiting:
+                await self.close()
+
+    async def close(self):
+        """Close the connection to the inverter."""
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = None
+        self.writer = None
+        self.buffer.clear()
+
+
+async def scan_bus(
+    ip: str, port: int, addresses: List[int], timeout: float = 2
+) -> Dict[int, Any]:
+    """Find the inverters chained behind a gateway.
+
+    Every address is asked for its type over one session; returns the
+    type code of each address that answered.
+    """
+    connection = InverterConnection(ip, port, persistent=True, reply_timeout=timeout)
+    connection.users = len(addresses)  # Keep the session when an address is silent
+    found = {}
+    try:
+        for address in addresses:
+            response = await connection.query(
+                build_request(SCAN_FIELDS, address), address
+            )
+            if response is None:
+                break  # Gateway unreachable
+            if response:
+                data = convert_to_json(SCAN_FIELDS, response)
+                found[address] = data.get("TYP", {}).get("Raw Value")
+    finally:
+        await connection.close()
+    return found
+
+
+def generate_empty_data(
+    field_map: Dict[str, str], last_data: Optional[Mapping[str, Any]] = None
+) -> Reading:
+    """Generate empty/default data when inverter is not available.
+
+    Returns a new reading and leaves the last known data untouched.
+    """
+    if last_data:
+        # Update last known data with offline status
+        last = Reading.of(last_data)
+        raw = list(last.raw)
+        values = list(last.decoded)
+        for position, field in enumerate(last.schema.fields):
+            if raw[position] is None or field in COUNTER_FIELDS:
+                continue  # Keep energy/counter values
+            code = NO_COMMUNICATION_STATUS if field == "SYS" else 0
+            raw[position] = code
+            values[position] = map_data_value(field, code)
+        return Reading(last.schema, raw, values)
+    # Generate fresh empty data
+    schema = ReadingSchema(field_map)
+    return Reading(
+        schema,
+        [NO_COMMUNICATION_STATUS if field == "SYS" else 0 for field in schema.fields],
+        [
+            map_data_value(field, NO_COMMUNICATION_STATUS) if field == "SYS" else 0
+            for field in schema.fields
+        ],
+    )
+
+
+class FieldSchedule:
+    """Tracks when each field is next due, so each cycle polls only due fields.
+
+    Intervals may be given per field or per FIELD_GROUPS group; a field entry
+    takes precedence over its group. Unlisted fields use the default interval.
+    """
+
+    def __init__(
+        self,
+        fields: List[str],
+        default_interval: float,
+        intervals: Optional[Dict[str, float]] = None,
+    ):
+        intervals = intervals or {}
+        self.intervals: Dict[str, float] = {}
+        for field in fields:
+            interval = resolve_field_option(intervals, field)
+            self.intervals[field] = float(interval or default_interval)
+        self.next_due = dict.fromkeys(self.intervals, 0.0)
+
+    def reset(self):
+        """Make all fields due, e.g. after the inverter was unreachable."""
+        self.next_due = dict.fromkeys(self.intervals, 0.0)
+
+    def reconfigure(
+        self,
+        fields: List[str],
+        default_interval: float,
+        intervals: Optional[Dict[str, float]] = None,
+    ):
+        """Change the fields and intervals, keeping when fields were polled.
+
+        A field stays scheduled relative to its last poll under its new
+        interval; added fields are due at once.
+        """
+        old_intervals = self.intervals
+        self.intervals = FieldSchedule(fields, default_interval, intervals).intervals
+        next_due = {}
+        for field, interval in self.intervals.items():
+            due = self.next_due.get(field, 0.0)
+            if due:
+                due += interval - old_intervals[field]
+            next_due[field] = due
+        self.next_due = next_due
+
+    def due(self, now: float) -> Tuple[str, ...]:
+        """Return the fields due at ``now``, in field map order."""
+        return tuple(
+            field
+            for field, due in self.next_due.items()
+            if due <= now + SCHEDULE_TOLERANCE
+        )
+
+    def mark_polled(self, fields: Tuple[str, ...], now: float):
+        """Schedule the next poll of the given fields."""
+        for field in fields:
+            self.next_due[field] = now + self.intervals[field]
+
+    def seconds_until_due(self, now: float) -> float:
+        """Seconds until the next field becomes due."""
+        return max(min(self.next_due.values()) - now, 0.0)
+
+
+def sun_times(
+    latitude: float, longitude: float, day: datetime.date
+) -> Optional[Tuple[float, float]]:
+    """Sunrise and sunset of a day as Unix timestamps, computed offline.
+
+    Uses the NOAA approximation, accurate to a minute or two. Returns None
+    during polar night; during polar day the whole day counts as daylight.
+    """
+    gamma = 2 * math.pi / 365 * (day.timetuple().tm_yday - 1)
+    equation_of_time = 229.18 * (
+        0.000075
+        + 0.001868 * math.cos(gamma)
+        - 0.032077 * math.sin(gamma)
+        - 0.014615 * math.cos(2 * gamma)
+        - 0.040849 * math.sin(2 * gamma)
+    )
+    declination = (
+        0.006918
+        - 0.399912 * math.cos(gamma)
+        + 0.070257 * math.sin(gamma)
+        - 0.006758 * math.cos(2 * gamma)
+        + 0.000907 * math.sin(2 * gamma)
+        - 0.002697 * math.cos(3 * gamma)
+        + 0.00148 * math.sin(3 * gamma)
+    )
+    lat = math.radians(latitude)
+    cos_hour_angle = math.cos(math.radians(90.833)) / (
+        math.cos(lat) * math.cos(declination)
+    ) - math.tan(lat) * math.tan(declination)
+    midnight = calendar.timegm(day.timetuple())
+    if cos_hour_angle > 1:
+        return None
+    if cos_hour_angle < -1:
+        return float(midnight), float(midnight + 86400)
+    hour_angle = math.degrees(math.acos(cos_hour_angle))
+    sunrise = 720 - 4 * (longitude + hour_angle) - equation_of_time
+    sunset = 720 - 4 * (longitude - hour_angle) - equation_of_time
+    return midnight + sunrise * 60, midnight + sunset * 60
+
+
+class AdaptivePolling:
+    """Adapts the poll interval of an inverter to what it is doing.
+
+    While the inverter sleeps (SYS 20000/20002) or is unreachable, the
+    interval doubles with every poll up to ``max_interval``. With known
+    coordinates the backoff is capped to the daytime retry interval between
+    ``SUNRISE_LEAD`` before sunrise and sunset, and never sleeps past that
+    point at night. When PAC moves fast, the power fields are polled every
+    ``RAMP_INTERVAL`` seconds for a while.
+    """
+
+    def __init__(
+        self,
+        max_interval: float = 1800,
+        latitude: Optional[float] = None,
+        longitude: Optional[float] = None,
+    ):
+        self.max_interval = max_interval
+        self.latitude = latitude
+        self.longitude = longitude
+        self.idle_polls = 0
+        self.last_pac: Optional[float] = None
+        self.ramp_until = 0.0
+
+    def _sun_times(self, timestamp: float) -> Optional[Tuple[float, float]]:
+        assert self.latitude is not None and self.longitude is not None
+        day = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).date()
+        return sun_times(self.latitude, self.longitude, day)
+
+    def seconds_until_wake(self, now: float) -> Optional[float]:
+        """Seconds until polling should resume, 0 in daylight, None if unknown."""
+        if self.latitude is None or self.longitude is None:
+            return None
+        for day_offset in (0, 1, 2):
+            times = self._sun_times(now + day_offset * 86400)
+            if times is None:
+                continue
+            wake, sunset = times[0] - SUNRISE_LEAD, times[1]
+            if now < sunset:
+                return max(wake - now, 0.0)
+        return None  # Polar night, fall back to the plain backoff
+
+    def ramping(self, now: float) -> bool:
+        """Whether PAC changed fast recently."""
+        return now < self.ramp_until
+
+    def after_reading(
+        self, data: Mapping[str, Any], interval: float, now: float
+    ) -> float:
+        """Interval after a successful poll that returned ``data``."""
+        data = Reading.of(data)
+        status = data.raw_value("SYS")
+        if status in IDLE_STATUS_CODES:
+            return self.after_idle(interval, now)
+        self.idle_polls = 0
+        pac = data.value("PAC")
+        if isinstance(pac, (int, float)):
+            last = self.last_pac
+            if last is not None and abs(pac - last) > max(
+                RAMP_THRESHOLD * abs(last), RAMP_MIN_CHANGE
+            ):
+                self.ramp_until = now + RAMP_DURATION
+            self.last_pac = pac
+        if self.ramping(now):
+            return min(interval, RAMP_INTERVAL)
+        return interval
+
+    def after_idle(self, interval: float, now: float) -> float:
+        """Interval after the inverter was found sleeping or unreachable."""
+        # A night of idle polls would overflow 2**idle_polls as a float
+        self.idle_polls = min(self.idle_polls + 1, MAX_IDLE_DOUBLINGS)
+        self.last_pac = None
+        backoff = min(interval * 2**self.idle_polls, self.max_interval)
+        wake = self.seconds_until_wake(now)
+        if wake is None:
+            return backoff
+        if wake == 0:
+            # Daylight: don't miss the inverter starting up
+            return min(backoff, max(interval, OFFLINE_RETRY_INTERVAL))
+        return max(min(backoff, wake), interval)
+
+
+# Layout of the readings returned by DerivedMetrics
+DERIVED_SCHEMA = ReadingSchema(DERIVED_FIELDS)
+
+
+class DerivedMetrics:
+    """Computes derived sensors from the readings of one inverter.
+
+    Each reading updates constant-size state: DC/AC efficiency and string
+    imbalance from the current values, specific yield from KDY and the
+    installed power, the day's energy as KDY plus PAC integrated since KDY
+    last changed, the day's PAC peak and an exponentially weighted rolling
+    mean of PAC.
+    """
+
+    def __init__(
+        self,
+        installed_power: Optional[float] = None,
+        mean_window: float = DERIVED_MEAN_WINDOW,
+    ):
+        self.installed_power = installed_power
+        self.mean_window = mean_window
+        self.day: Optional[Tuple[int, int, int]] = None
+        self.last_time: Optional[float] = None
+        self.last_pac = 0.0
+        self.mean: Optional[float] = None
+        self.peak = 0.0
+        self.kdy: Optional[float] = None
+        self.integrated = 0.0  # Wh since KDY last changed
+        self.energy = 0.0
+
+    def update(self, data: Mapping[str, Any], now: float) -> Reading:
+        """Return the derived sensors for a reading taken at ``now``."""
+        reading = Reading.of(data)
+
+        def value(field: str) -> Optional[float]:
+            number = reading.value(field)
+            return number if isinstance(number, (int, float)) else None
+
+        day = time.localtime(now)[:3]
+        if day != self.day:
+            self.day = day
+            self.peak = 0.0
+            self.energy = 0.0
+
+        values: Dict[str, float] = {}
+        pac = value("PAC")
+        pdc = value("PDC")
+        if pac is not None and pdc is not None:
+            values["EFF"] = round(min(pac / pdc, 1.0) * 100, 1) if pdc > 0 else 0.0
+        pd01, pd02 = value("PD01"), value("PD02")
+        if pd01 is not None and pd02 is not None:
+            highest = max(pd01, pd02)
+            values["SIMB"] = (
+                round(abs(pd01 - pd02) / highest * 100, 1) if highest > 0 else 0.0
+            )
+        kdy = value("KDY")
+        installed = value("PIN") or self.installed_power
+        if kdy is not None and ("PIN" in reading or self.installed_power):
+            values["SPY"] = round(kdy / installed, 3) if installed else 0.0
+
+        if pac is not None:
+            if self.last_time is not None and now > self.last_time:
+                elapsed = now - self.last_time
+                # Trapezoidal rule; gaps longer than the mean window count as
+                # one window so an outage does not add a burst of energy
+                self.integrated += (
+                    (self.last_pac + pac) / 2 * min(elapsed, self.mean_window) / 3600
+                )
+                weight = 1 - math.exp(-elapsed / self.mean_window)
+                assert self.mean is not None
+                self.mean += weight * (pac - self.mean)
+            else:
+                self.mean = pac
+            self.last_time = now
+            self.last_pac = pac
+            self.peak = max(self.peak, pac)
+            values["PMAX"] = self.peak
+            values["PAVG"] = round(self.mean, 1)
+            if kdy is not None:
+                if kdy != self.kdy:
+                    self.kdy = kdy
+                    self.integrated = 0.0
+                # Never decreasing within the day, also when KDY catches up
+                self.energy = max(self.energy, kdy + self.integrated)
+                values["EDAY"] = round(self.energy, 1)
+
+        return Reading.from_entries(
+            DERIVED_SCHEMA,
+            ((field, number, number) for field, number in values.items()),
+        )
+
+
+class InverterPoller:
+    """Polls a single inverter on its own schedule within the asyncio loop."""
+
+    def __init__(
+        self,
+        inverter: Dict[str, Any],
+        publisher: Union[HomeAssistantMQTTPublisher, FanOut, ShardOutput],
+        field_map: Dict[str, str] = FIELD_MAP_INVERTER,
+        adaptive: Optional[AdaptivePolling] = None,
+        connection: Optional[InverterConnection] = None,
+        derived: Optional[DerivedMetrics] = None,
+    ):
+        self.inverter = inverter
+        self.derived = derived
+        self.publisher = publisher
+        self.field_map = field_map
+        self.schema = ReadingSchema(field_map)
+        # Inverters behind one gateway are given the same connection
+        self.connection = connection or InverterConnection(
+            inverter["ip"],
+            inverter["port"],
+            persistent=inverter.get("persistent_connection", False),
+        )
+        self.connection.users += 1
+        self.schedule = FieldSchedule(
+            list(field_map),
+            inverter["update_interval"],
+            inverter.get("field_intervals"),
+        )
+        self.last_good_data: Optional[Reading] = None
+        # Set when the schedule changed while sleeping; created in run()
+        self.rescheduled: Optional[asyncio.Event] = None
+        self.connect_failures = 0
+        self.last_latency: Optional[float] = None
+        self.adaptive = adaptive
+        # Polled during PAC ramps even if not due yet
+        self.ramp_fields = self._ramp_fields(field_map)
+
+    @staticmethod
+    def _ramp_fields(field_map: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(
+            field
+            for field in field_map
+            if field in FIELD_GROUPS["power"] or field == "SYS"
+        )
+
+    def reconfigure(
+        self,
+        field_map: Dict[str, str],
+        update_interval: float,
+        field_intervals: Optional[Dict[str, float]] = None,
+    ):
+        """Change the polled fields and intervals of the running poller.
+
+        Fields keep their last poll time, values of fields no longer polled
+        are dropped, and a sleeping poller wakes up for the new schedule.
+        """
+        self.inverter["update_interval"] = update_interval
+        self.inverter["field_intervals"] = field_intervals or {}
+        if field_map != self.field_map:
+            self.field_map = field_map
+            self.schema = ReadingSchema(field_map)
+            self.ramp_fields = self._ramp_fields(field_map)
+            if self.last_good_data is not None:
+                self.last_good_data = Reading.from_entries(
+                    self.schema,
+                    (
+                        entry
+                        for entry in self.last_good_data.entries()
+                        if entry[0] in field_map
+                    ),
+                )
+        self.schedule.reconfigure(list(field_map), update_interval, field_intervals)
+        if self.rescheduled is not None:
+            self.rescheduled.set()
+
+    def _with_derived(self, data: Reading, state: Optional[Reading] = None) -> Reading:
+        """Add the derived sensors to a reading, if enabled.
+
+        They are computed from ``state``, the last values of all fields, if
+        the reading only holds the fields polled this cycle.
+        """
+        if self.derived is None:
+            return data
+        return data.merged(self.derived.update(state or data, time.time()))
+
+    def _retry_interval(self) -> float:
+        """Seconds to wait after a failed connect, backing off in persistent mode."""
+        if not self.connection.persistent:
+            return OFFLINE_RETRY_INTERVAL
+        backoff = RECONNECT_BACKOFF_MIN * 2 ** (self.connect_failures - 1)
+        return min(backoff, OFFLINE_RETRY_INTERVAL)
+
+    async def poll_once(self) -> float:
+        """Poll the inverter once and return the seconds until the next poll."""
+        start = time.monotonic()
+        fields = self.schedule.due(start) or self.ramp_fields
+        requests = requests_for_fields(fields, self.inverter["address"])
+        responses = await self.connection.query_all(
+            list(requests), self.inverter["address"]
+        )
+
+        if responses is not None and not any(responses):
+            # An always-on gateway keeps the session up for an inverter that
+            # is off at night, so no reply at all means unavailable too
+            responses = None
+
+        labels = {"device": self.inverter["device_id"]}
+        METRICS.inc("solarmax_polls_total", **labels)
+        if responses is not None:
+            self.connect_failures = 0
+            self.last_latency = time.monotonic() - start
+            METRICS.observe("solarmax_poll_seconds", self.last_latency, **labels)
+            logger.info(
+                "Polled %s in %.1f ms (%d frame(s))",
+                self.inverter["device_name"],
+                self.last_latency * 1000,
+                len(responses),
+            )
+            # Merge the replies to all batches into one record
+            parse_start = time.perf_counter()
+            json_data = decode_reading(self.schema, responses)
+            METRICS.observe(
+                "solarmax_parse_seconds", time.perf_counter() - parse_start, **labels
+            )
+
+            if json_data:  # Only publish if we got valid data
+                self.schedule.mark_polled(fields, start)
+                # Fields not due this cycle keep their last polled values
+                self.last_good_data = (
+                    json_data
+                    if self.last_good_data is None
+                    else self.last_good_data.merged(json_data)
+                )
+                publish_start = time.perf_counter()
+                # Only the polled fields are published, so slow fields are not
+                # sent again with every fast cycle; outputs keep the others
+                self.publisher.publish_data(
+                    self._with_derived(json_data, self.last_good_data), self.inverter
+                )
+                METRICS.observe(
+                    "solarmax_publish_seconds",
+                    time.perf_counter() - publish_start,
+                    **labels,
+                )
+                METRICS.set("solarmax_up", 1, **labels)
+                if METRICS.enabled:
+                    record_values(self.inverter["device_id"], json_data)
+                interval = self.schedule.seconds_until_due(time.monotonic())
+                if self.adaptive is not None:
+                    interval = self.adaptive.after_reading(
+                        self.last_good_data, interval, time.time()
+                    )
+                return interval
+
+            logger.warning(
+                f"No valid data received from {self.inverter['device_name']}"
+            )
+            METRICS.inc("solarmax_poll_failures_total", **labels)
+            METRICS.set("solarmax_up", 0, **labels)
+            return OFFLINE_RETRY_INTERVAL  # Wait longer on data errors
+
+        # Inverter not available, publish empty/last known data
+        self.connect_failures += 1
+        METRICS.inc("solarmax_poll_failures_total", **labels)
+        METRICS.set("solarmax_up", 0, **labels)
+        self.schedule.reset()  # Poll every field once it is back
+        logger.warning(
+            f"{self.inverter['device_name']} not available, publishing offline status"
+        )
+        offline_data = generate_empty_data(self.field_map, self.last_good_data)
+        self.publisher.publish_data(self._with_derived(offline_data), self.inverter)
+        if self.adaptive is not None:
+            return self.adaptive.after_idle(
+                self.inverter["update_interval"], time.time()
+            )
+        return self._retry_interval()  # Wait longer when inverter is offline
+
+    async def run(self):
+        """Poll the inverter until the task is cancelled."""
+        while True:
+            try:
+                sleep_time = await self.poll_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Unexpected error: {e}", exc_info=True)
+                sleep_time = OFFLINE_RETRY_INTERVAL  # Wait before retrying on errors
+
+            logger.debug(
+                f"{self.inverter['device_name']}: sleeping for {sleep_time} seconds..."
+            )
+            await self._sleep(sleep_time)
+
+    async def _sleep(self, seconds: float):
+        """Sleep until the next poll; a changed schedule ends the sleep early."""
+        if self.rescheduled is None:
+            self.rescheduled = asyncio.Event()
+        deadline = time.monotonic() + seconds
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(self.rescheduled.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+            self.rescheduled.clear()
+            now = time.monotonic()
+            deadline = now + self.schedule.seconds_until_due(now)
+
+
+def record_values(device_id: str, data: Mapping[str, Any]):
+    """Export the numeric values of a reading as metrics."""
+    for field, value in Reading.of(data).value_items():
+        if not isinstance(value, (int, float)):
             continue
+        if STATE_CLASSES.get(field) == "total_increasing":
+            METRICS.set("solarmax_counter_total", value, device=device_id, field=field)
+        else:
+            METRICS.set("solarmax_value", value, device=device_id, field=field)
+
+
+async def cancel_tasks(tasks: List["asyncio.Task[Any]"]):
+    """Cancel the tasks and wait until they are done.
+
+    asyncio.wait_for() can swallow a cancellation that arrives just as the
+    awaited operation completes, so tasks still running are cancelled again.
+    """
+    pending = set(tasks)
+    while pending:
+        for task in pending:
+            task.cancel()
+        _, pending = await asyncio.wait(pending, timeout=0.1)
+
+
+def field_map_for(config: Dict[str, Any]) -> Dict[str, str]:
+    """Fields polled from every inverter with the configuration."""
+    field_map = dict(FIELD_MAP_INVERTER)
+    if config.get("extended_fields"):
+        field_map.update(FIELD_MAP_EXTENDED)
+    for field in config.get("disabled_fields") or ():
+        field_map.pop(field, None)
+    return field_map
+
+
+def reconfigure_pollers(pollers: List[InverterPoller], config: Dict[str, Any]):
+    """Apply the reloadable options of the configuration to running pollers."""
+    field_map = field_map_for(config)
+    inverters = {inv["device_id"]: inv for inv in config["inverters"]}
+    for poller in pollers:
+        inverter = inverters.get(poller.inverter["device_id"], poller.inverter)
+        poller.reconfigure(
+            field_map, inverter["update_interval"], inverter.get("field_intervals")
+        )
+
+
+def apply_log_level(level: str):
+    """Change the log level of the running process."""
+    logging.getLogger().setLevel(getattr(logging, level.upper(), logging.INFO))
+
+
+def create_pollers(
+    config: Dict[str, Any],
+    output: Union[HomeAssistantMQTTPublisher, FanOut, ShardOutput],
+) -> List[InverterPoller]:
+    """Create a poller for every inverter of the configuration.
+
+    Inverters with the same IP and port are chained behind one gateway and
+    share its connection.
+    """
+    field_map = field_map_for(config)
+    gateways: Dict[Tuple[str, int], List[Dict[str, Any]]] = {}
+    for inv in config["inverters"]:
+        gateways.setdefault((inv["ip"], inv["port"]), []).append(inv)
+    connections = {
+        key: InverterConnection(
+            *key,
+            persistent=any(inv.get("persistent_connection") for inv in group),
+            reply_timeout=config.get("bus_timeout") if len(group) > 1 else None,
+        )
+        for key, group in gateways.items()
+    }
+    return [
+        InverterPoller(
+            inv,
+            output,
+            field_map,
+            (
+                AdaptivePolling(
+                    config["max_poll_interval"],
+                    config.get("latitude"),
+                    config.get("longitude"),
+                )
+                if config.get("adaptive_polling")
+                else None
+            ),
+            connections[(inv["ip"], inv["port"])],
+            (
+                DerivedMetrics(inv.get("installed_power"))
+                if config.get("derived_metrics")
+                else None
+            ),
+        )
+        for inv in config["inverters"]
+    ]
+
+
+def shard_inverters(
+    inverters: List[Dict[str, Any]], count: int
+) -> List[List[Dict[str, Any]]]:
+    """Split the inverters into at most ``count`` shards of similar size.
+
+    Inverters behind the same IP and port stay in one shard, as only one
+    connection to a gateway can be open at a time.
+    """
+    groups: Dict[Tuple[str, int], List[Dict[str, Any]]] = {}
+    for inverter in inverters:
+        groups.setdefault((inverter["ip"], inverter["port"]), []).append(inverter)
+    shards: List[List[Dict[str, Any]]] = [[] for _ in range(min(count, len(groups)))]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(shards, key=len).extend(group)
+    return shards
+
+
+def run_worker(config: Dict[str, Any], connection: "Connection"):
+    """Entry point of a worker process polling one shard of the fleet."""
+    # The supervisor stops its workers, Ctrl+C in a terminal must not
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    configure_logging()
+    if config.get("log_level"):
+        apply_log_level(config["log_level"])
+    # Recorded here and sent to the supervisor, which serves them
+    METRICS.enabled = bool(config.get("metrics_port"))
+    asyncio.run(poll_shard(config, connection))
+
+
+async def poll_shard(config: Dict[str, Any], connection: "Connection"):
+    """Poll the inverters of the configuration until the supervisor goes away."""
+    loop = asyncio.get_running_loop()
+    output = ShardOutput(connection)
+    pollers = create_pollers(config, output)
+
+    # The supervisor sends changed configurations over the pipe, and closes
+    # its end to stop the worker
+    stop_event = asyncio.Event()
+
+    def receive():
+        try:
+            changed = pickle.loads(connection.recv_bytes())
+        except (EOFError, OSError):
+            stop_event.set()
+            return
+        apply_log_level(changed["log_level"])
+        reconfigure_pollers(pollers, changed)
+
+    loop.add_reader(connection.fileno(), receive)
+    loop.add_signal_handler(signal.SIGTERM, stop_event.set)
+
+    tasks = [asyncio.create_task(poller.run()) for poller in pollers]
+    tasks.append(asyncio.create_task(output.heartbeat()))
+    await stop_event.wait()
+    loop.remove_reader(connection.fileno())
+    await cancel_tasks(tasks)
+    await asyncio.gather(*(poller.connection.close() for poller in pollers))
+    connection.close()
+
+
+class WorkerPool:
+    """Polls shards of the inverter fleet in worker processes.
+
+    The readings of the workers are passed to the supervisor's output, so
+    that MQTT, sinks, history and API stay in one process. A worker that
+    exits or misses its heartbeats is restarted with backoff.
+    """
+
+    def __init__(
+        self,
+        config: Dict[str, Any],
+        output: Union[HomeAssistantMQTTPublisher, FanOut],
+        count: int,
+    ):
+        import multiprocessing
+
+        # Workers start from a fresh interpreter, not a copy of the threads
+        # and sockets of the supervisor
+        self.context = multiprocessing.get_context("spawn")
+        self.config = config
+        self.output = output
+        self.devices = {inv["device_id"]: inv for inv in config["inverters"]}
+        self.schema = ReadingSchema(
+            {**FIELD_MAP_INVERTER, **FIELD_MAP_EXTENDED, **DERIVED_FIELDS}
+        )
+        self.shards = shard_inverters(config["inverters"], count)
+        self.processes: List[Optional["BaseProcess"]] = [None] * len(self.shards)
+        self.connections: List[Optional["Connection"]] = [None] * len(self.shards)
+        self.last_seen = [0.0] * len(self.shards)
+        self.failures = [0] * len(self.shards)
+        self.restart_at = [0.0] * len(self.shards)
+        self.readings = 0
+
+    def _start_worker(self, index: int):
+        parent, child = self.context.Pipe()
+        process = self.context.Process(
+            target=run_worker,
+            args=({**self.config, "inverters": self.shards[index]}, child),
+            name=f"solarmax-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        child.close()
+        self.processes[index] = process
+        self.connections[index] = parent
+        self.last_seen[index] = time.monotonic()
+        asyncio.get_running_loop().add_reader(parent.fileno(), self._receive, index)
+        logger.info(
+            f"Started worker {index} (pid {process.pid}) for "
+            f"{len(self.shards[index])} inverter(s)"
+        )
+
+    def _stop_worker(self, index: int):
+        """Close the pipe to a failed worker, kill it and schedule its restart."""
+        connection = self.connections[index]
+        if connection is not None:
+            asyncio.get_running_loop().remove_reader(connection.fileno())
+            connection.close()
+            self.connections[index] = None
+        process = self.processes[index]
+        if process is not None and process.is_alive():
+            process.terminate()
+        self.processes[index] = None
+        self.failures[index] += 1
+        backoff = WORKER_HEARTBEAT_INTERVAL * 2 ** (self.failures[index] - 1)
+        self.restart_at[index] = time.monotonic() + min(
+            backoff, WORKER_RESTART_BACKOFF_MAX
+        )
+
+    def _receive(self, index: int):
+        connection = self.connections[index]
+        if connection is None:
+            return
+        try:
+            while connection.poll():
+                batch, metrics = pickle.loads(connection.recv_bytes())
+                for device_id, values in batch:
+                    self._publish(device_id, values)
+                if batch:
+                    self.failures[index] = 0
+                if metrics is not None:
+                    METRICS.remote[str(index)] = metrics
+        except (EOFError, OSError):
+            logger.warning(f"Worker {index} closed its connection")
+            self._stop_worker(index)
+            return
+        self.last_seen[index] = time.monotonic()
+
+    def _publish(self, device_id: str, values: List[Tuple[str, Any, Any]]):
+        device = self.devices.get(device_id)
+        if device is None:
+            return
+        data = Reading.from_entries(self.schema, values)
+        self.readings += 1
+        self.output.publish_data(data, device)
+        if METRICS.enabled:
+            record_values(device_id, data)
+
+    def _check(self, now: float):
+        """Restart workers that exited or stopped sending heartbeats."""
+        for index, process in enumerate(self.processes):
+            if process is None:
+                if now >= self.restart_at[index]:
+                    METRICS.inc("solarmax_worker_restarts_total", worker=str(index))
+                    logger.warning(f"Restarting worker {index}")
+                    self._start_worker(index)
+            elif not process.is_alive():
+                logger.warning(f"Worker {index} exited with code {process.exitcode}")
+                self._stop_worker(index)
+            elif now - self.last_seen[index] > WORKER_HEARTBEAT_TIMEOUT:
+                logger.warning(f"Worker {index} missed its heartbeats")
+                self._stop_worker(index)
+
+    async def run(self):
+        """Start the workers and keep them running until cancelled."""
+        for index in range(len(self.shards)):
+            self._start_worker(index)
+        logger.info(
+            f"Polling {len(self.devices)} inverter(s) in {len(self.shards)} workers"
+        )
+        while True:
+            await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL / 5)
+            self._check(time.monotonic())
+
+    def reconfigure(self, config: Dict[str, Any]):
+        """Pass a changed configuration to the workers and to restarted ones."""
+        self.config = config
+        inverters = {inv["device_id"]: inv for inv in config["inverters"]}
+        self.shards = [
+            [inverters.get(inv["device_id"], inv) for inv in shard]
+            for shard in self.shards
+        ]
+        for index, connection in enumerate(self.connections):
+            if connection is None:
+                continue
+            message = {**config, "inverters": self.shards[index]}
+            try:
+                connection.send_bytes(pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+            except OSError as e:
+                logger.warning(f"Failed to reconfigure worker {index}: {e!r}")
+
+    def collect_metrics(self):
+        """Refresh the worker gauges before a scrape."""
+        for index, process in enumerate(self.processes):
+            up = process is not None and process.is_alive()
+            METRICS.set("solarmax_worker_up", int(up), worker=str(index))
+
+    async def close(self, timeout: float = MQTT_DRAIN_TIMEOUT):
+        """Stop the workers, giving them a moment to close their connections."""
+        loop = asyncio.get_running_loop()
+        for index in range(len(self.shards)):
+            connection = self.connections[index]
+            if connection is not None:
+                loop.remove_reader(connection.fileno())
+                connection.close()
+                self.connections[index] = None
+        for process in self.processes:
+            if process is None:
+                continue
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+
+
+# Handler of an HTTP route: (path, query) -> (status, content type, body)
+RouteHandler = Callable[[str, Dict[str, str]], Tuple[int, str, bytes]]
+
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+}
+
+
+class StatusServer:
+    """Minimal asyncio HTTP server for the metrics endpoint.
+
+    Only GET requests are served. Routes are matched by path prefix, the
+    longest prefix wins.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.routes: Dict[str, RouteHandler] = {}
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    def add_route(self, prefix: str, handler: RouteHandler):
+        """Serve requests whose path starts with prefix by the handler."""
+        self.routes[prefix] = handler
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Serving HTTP on {self.host}:{self.port}")
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def _dispatch(self, method: str, target: str) -> Tuple[int, str, bytes]:
+        if method != "GET":
+            return 405, "text/plain", b"Method not allowed\n"
+        url = urlsplit(target)
+        for prefix in sorted(self.routes, key=len, reverse=True):
+            if url.path == prefix or url.path.startswith(prefix.rstrip("/") + "/"):
+                return self.routes[prefix](url.path, dict(parse_qsl(url.query)))
+        return 404, "text/plain", b"Not found\n"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            # Skip the headers, no route needs them
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 10)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2:
+                status, content_type, body = 400, "text/plain", b"Bad request\n"
+            else:
+                status, content_type, body = self._dispatch(parts[0], parts[1])
+            writer.write(
+                (
+                    f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    "Connection: close\r\n\r\n"
+                ).encode("latin-1")
+                + body
+            )
+            await writer.drain()
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.debug(f"HTTP request failed: {e!r}")
+        except Exception as e:
+            logger.error(f"Error serving HTTP request: {e}", exc_info=True)
+        finally:
+            writer.close()
+
+
+def metrics_route(path: str, query: Dict[str, str]) -> Tuple[int, str, bytes]:
+    """Serve the metrics in the Prometheus text format."""
+    return 200, "text/plain; version=0.0.4; charset=utf-8", METRICS.render().encode()
+
+
+class ConfigReloader:
+    """Applies configuration changes to the running agent without a restart.
+
+    Changes come from the options file, checked for modifications every
+    CONFIG_WATCH_INTERVAL seconds, and from JSON commands such as
+    ``{"update_interval": 10}`` on the command topic. Only the
+    RELOADABLE_OPTIONS are applied; other changed options are logged as
+    needing a restart.
+    """
+
+    def __init__(
+        self,
+        config: Dict[str, Any],
+        publisher: HomeAssistantMQTTPublisher,
+        pollers: List[InverterPoller],
+        pool: Optional[WorkerPool] = None,
+        config_path: Optional[str] = None,
+    ):
+        self.config = config
+        self.publisher = publisher
+        self.pollers = pollers
+        self.pool = pool
+        self.config_path = config_path
+        self.mtime = self._mtime()
+
+    def _mtime(self) -> Optional[float]:
+        if self.config_path is None:
+            return None
+        try:
+            return path.getmtime(self.config_path)
+        except OSError:
+            return None
+
+    def apply(
+        self,
+        settings: Dict[str, Any],
+        inverter_settings: Optional[Dict[str, Dict[str, Any]]] = None,
+    ) -> List[str]:
+        """Apply reloadable options and return the names of those that changed.
+
+        ``inverter_settings`` gives the per-inverter options by device id;
+        without it the options in ``settings`` apply to every inverter.
+        """
+        changed = [
+            name for name, value in settings.items() if value != self.config.get(name)
+        ]
+        inverters = []
+        for inverter in self.config["inverters"]:
+            if inverter_settings is not None:
+                overrides = inverter_settings.get(inverter["device_id"], {})
+            else:
+                overrides = {
+                    name: settings[name]
+                    for name in INVERTER_RELOADABLE_OPTIONS
+                    if name in settings
+                }
+            for name, value in overrides.items():
+                if value != inverter.get(name) and name not in changed:
+                    changed.append(name)
+            inverters.append({**inverter, **overrides})
+        if not changed:
+            return []
+
+        config = {**self.config, **settings, "inverters": inverters}
+        field_map = field_map_for(config)
+        removed = [
+            field for field in field_map_for(self.config) if field not in field_map
+        ]
+        if "log_level" in changed:
+            apply_log_level(config["log_level"])
+        self.publisher.reconfigure(config, removed)
+        if self.pool is not None:
+            self.pool.reconfigure(config)
+        else:
+            reconfigure_pollers(self.pollers, config)
+        self.config = config
+        logger.info(f"Applied configuration changes: {', '.join(changed)}")
+        return changed
+
+    def check_file(self) -> List[str]:
+        """Apply the options file if it was modified since the last check."""
+        mtime = self._mtime()
+        if mtime is None or mtime == self.mtime:
+            return []
+        self.mtime = mtime
+        loaded = load_config(self.config_path)
+        settings = {name: loaded[name] for name in RELOADABLE_OPTIONS}
+        problems = check_settings(settings)
+        for problem in problems:
+            logger.error(f"Not reloading {self.config_path}: {problem}")
+        if problems:
+            return []
+
+        def fixed(inverters: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+            return [
+                {
+                    key: value
+                    for key, value in inverter.items()
+                    if key not in INVERTER_RELOADABLE_OPTIONS
+                }
+                for inverter in inverters
+            ]
+
+        for name, value in loaded.items():
+            if name in RELOADABLE_OPTIONS:
+                continue
+            current: Any = self.config.get(name)
+            if name == "inverters":
+                value, current = fixed(value), fixed(current)
+            if value != current:
+                logger.warning(
+                    f"{name} changed in {self.config_path}, "
+                    f"restart the agent to apply it"
+                )
+        return self.apply(
+            settings,
+            {
+                inverter["device_id"]: {
+                    name: inverter[name] for name in INVERTER_RELOADABLE_OPTIONS
+                }
+                for inverter in loaded["inverters"]
+            },
+        )
+
+    def command(self, payload: bytes) -> List[str]:
+        """Apply a JSON object of options received on the command topic."""
+        try:
+            settings = json.loads(payload)
+        except ValueError as e:
+            logger.warning(f"Ignoring malformed command: {e}")
+            return []
+        if not isinstance(settings, dict):
+            logger.warning("Ignoring command that is not a JSON object")
+            return []
+        problems = check_settings(settings)
+        for problem in problems:
+            logger.warning(f"Ignoring command: {problem}")
+        if problems:
+            return []
+        if "log_level" in settings:
+            settings["log_level"] = settings["log_level"].upper()
+        return self.apply(settings)
+
+    async def watch(self):
+        """Check the options file for changes until cancelled."""
+        while True:
+            await asyncio.sleep(CONFIG_WATCH_INTERVAL)
+            try:
+                self.check_file()
+            except Exception as e:
+                logger.error(f"Failed to reload configuration: {e}", exc_info=True)
+
+
+async def run_agent(config: Dict[str, Any]):
+    """Poll all configured inverters concurrently until a shutdown signal."""
+    mqtt_publisher = HomeAssistantMQTTPublisher(config)
+    loop = asyncio.get_running_loop()
+
+    # Connect in the background and wait for the CONNACK, not a fixed delay
+    mqtt_publisher.start()
+    if not await loop.run_in_executor(
+        None, mqtt_publisher.wait_connected, MQTT_CONNECT_TIMEOUT
+    ):
+        logger.warning("MQTT broker not reachable yet, polling anyway")
+
+    # Additional sinks get the readings through a fan-out stage
+    output: Union[HomeAssistantMQTTPublisher, FanOut] = mqtt_publisher
+    fan_out = None
+    sinks: List[Sink] = []
+    for options in config.get("sinks") or []:
+        try:
+            sinks.append(create_sink(options))
+        except (KeyError, ValueError) as e:
+            logger.error(f"Ignoring invalid sink {options}: {e!r}")
+    history = None
+    if config.get("history_dir"):
+        history = HistoryStore(
+            config["history_dir"],
+            config.get("history_fields"),
+            {"raw": config["history_days"]},
+        )
+        sinks.append(HistorySink(history))
+    latest = None
+    if config.get("api_port"):
+        latest = LatestReadings(history)
+        sinks.append(latest)
+    if sinks:
+        sinks.insert(0, MQTTSink(mqtt_publisher))
+        fan_out = FanOut(sinks, config["sink_queue_size"])
+        fan_out.start()
+        METRICS.collectors.append(fan_out.collect_metrics)
+        output = fan_out
+        logger.info(f"Writing readings to {', '.join(sink.name for sink in sinks)}")
+    # With several workers the supervisor only publishes what they poll
+    pool = None
+    pollers: List[InverterPoller] = []
+    workers = config.get("workers", 1) or cpu_count() or 1
+    if workers > 1 and len(config["inverters"]) > 1:
+        pool = WorkerPool(config, output, workers)
+        METRICS.collectors.append(pool.collect_metrics)
+    else:
+        pollers = create_pollers(config, output)
+
+    # Set up signal handlers for graceful shutdown
+    stop_event = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop_event.set)
+
+    # Metrics and API share one server when configured on the same port
+    servers: Dict[int, StatusServer] = {}
+    if config.get("metrics_port"):
+        METRICS.enabled = True
+        METRICS.collectors.append(mqtt_publisher.collect_metrics)
+        port = config["metrics_port"]
+        servers[port] = StatusServer(config["metrics_host"], port)
+        servers[port].add_route("/metrics", metrics_route)
+    if latest is not None:
+        port = config["api_port"]
+        server = servers.setdefault(port, StatusServer(config["api_host"], port))
+        server.add_route("/latest", latest.route)
+        server.add_route("/history", latest.route)
+    for server in servers.values():
+        await server.start()
+
+    # Reloadable options are applied live from the options file and commands
+    reloader = ConfigReloader(config, mqtt_publisher, pollers, pool, config_file())
+    if config.get("remote_config"):
+        mqtt_publisher.enable_commands(reloader.command)
+        logger.info(
+            f"Accepting configuration changes on {mqtt_publisher.command_topic}"
+        )
+
+    tasks = [asyncio.create_task(poller.run()) for poller in pollers]
+    if pool is not None:
+        tasks.append(asyncio.create_task(pool.run()))
+    if reloader.config_path is not None:
+        tasks.append(asyncio.create_task(reloader.watch()))
+    if mqtt_publisher.outbox is not None:
+        rate = float(config.get("outbox_replay_rate", 5))
+        tasks.append(asyncio.create_task(mqtt_publisher.replay_outbox(rate)))
+    if pollers:
+        logger.info(f"Polling {len(pollers)} inverter(s)")
+
+    await stop_event.wait()
+    logger.info("Received shutdown signal, cleaning up...")
+    await cancel_tasks(tasks)
+    await asyncio.gather(*(poller.connection.close() for poller in pollers))
+    if pool is not None:
+        await pool.close()
+    if fan_out is not None:
+        await fan_out.close()
+    for server in servers.values():
+        await server.close()
+    mqtt_publisher.disconnect()
+
+
+def describe_config(config: Dict[str, Any]) -> str:
+    """Summarize the effective configuration for the log and ``--check``."""
+    inverters = ", ".join(
+        f"{inv['ip']}:{inv['port']}#{inv['address']}" for inv in config["inverters"]
+    )
+    features = [
+        name
+        for name in (
+            "persistent_connection",
+            "extended_fields",
+            "adaptive_polling",
+            "publish_on_change",
+            "compact_state",
+            "derived_metrics",
+            "status_events",
+            "remote_config",
+            "home_assistant_discovery",
+        )
+        if config.get(name)
+    ]
+    if config.get("workers", 1) != 1:
+        features.append(f"workers={config['workers'] or 'auto'}")
+    for name in ("outbox_dir", "history_dir", "metrics_port", "api_port"):
+        if config.get(name):
+            features.append(f"{name}={config[name]}")
+    if config.get("sinks"):
+        features.append(f"sinks={len(config['sinks'])}")
+    return (
+        f"inverters={inverters}, mqtt={config['mqtt_host']}:{config['mqtt_port']}, "
+        f"features={','.join(features) or 'none'}"
+    )
+
+
+def main(argv: Optional[List[str]] = None):
+    """Main function to run the inverter monitoring agent."""
+    parser = argparse.ArgumentParser(description="Solarmax inverter to MQTT agent")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="validate the configuration and exit without connecting",
+    )
+    parser.add_argument(
+        "--scan",
+        metavar="HOST[:PORT]",
+        help="list the inverters answering behind a gateway and exit",
+    )
+    parser.add_argument(
+        "--addresses",
+        default="1-32",
+        help="bus addresses to scan, e.g. 1-8,12 (default: 1-32)",
+    )
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    if args.scan:
+        host, _, port = args.scan.partition(":")
+        found = asyncio.run(
+            scan_bus(host, int(port or 12345), parse_addresses(args.addresses))
+        )
+        for address, type_code in found.items():
+            print(f"Inverter at bus address {address} (type {type_code})")
+        if not found:
+            print(f"No inverter answered at {args.scan}")
+            sys.exit(1)
+        return
+
+    config = load_config()
+    # The options file may set another level than the environment
+    apply_log_level(config["log_level"])
+    problems = validate_config(config)
+    for problem in problems:
+        logger.error(f"Invalid configuration: {problem}")
+    if problems:
+        sys.exit(1)
+    if args.check:
+        print(f"Configuration OK: {describe_config(config)}")
+        return
+
+    logger.info("Starting Solarmax to MQTT Agent for Home Assistant...")
+    logger.info(f"Starting Solarmax Agent with config: {describe_config(config)}")
+    try:
+        asyncio.run(run_agent(config))
+    except KeyboardInterrupt:
+        logger.info("Agent stopped by user")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,596 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Solarmax agent's hot paths and polling cycle.
+
+Measures how many request builds, frame reads, reply decodes, discovery
+payloads and publishes per second the agent manages on this machine, and
+polls fleets of simulated inverters end to end, reporting cycle and poll
+latency, CPU time per poll and peak memory. The sharding benchmark polls a
+fleet as fast as possible with 1..N worker processes. Results can be saved as JSON
+and compared against a previous run to spot regressions between releases
+and hardware (e.g. the Raspberry Pi running the add-on).
+
+Usage:
+    python benchmark.py [--json] [--seconds 1.0] [--fleets 1,10,500]
+                        [--workers 1,2,4] [--output results.json]
+                        [--compare baseline.json]
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None  # type: ignore[assignment]
+
+from agent import (
+    FIELD_MAP_EXTENDED,
+    FIELD_MAP_INVERTER,
+    HomeAssistantMQTTPublisher,
+    InverterPoller,
+    ReadingSchema,
+    WorkerPool,
+    build_inverter_list,
+    build_request,
+    cancel_tasks,
+    convert_to_json,
+    create_pollers,
+    decode_reading,
+    extract_frame,
+    load_config,
+    logger,
+    map_data_value,
+    requests_for_fields,
+)
+from simulator import sample_reply, server_port, start_fleet
+
+# Metrics where a smaller value is better; all others are rates
+LOWER_IS_BETTER = ("_ms", "_mb", "_kb", "messages_per_poll")
+
+
+class StandInMQTTClient:
+    """In-process replacement of the paho client that accepts every message."""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self._mid = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self._mid += 1
+        self.messages += 1
+        self.bytes += len(topic) + len(payload or "")
+        return _PublishResult(self._mid)
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+class _PublishResult:
+    __slots__ = ("mid",)
+    rc = 0
+
+    def __init__(self, mid: int):
+        self.mid = mid
+
+
+def benchmark_config(**overrides) -> Dict[str, Any]:
+    """Agent configuration for benchmarks: discovery on, no outbox."""
+    return {
+        **load_config(),
+        "home_assistant_discovery": True,
+        "publish_on_change": False,
+        "compact_state": False,
+        "outbox_dir": "",
+        **overrides,
+    }
+
+
+def stand_in_publisher(
+    config: Dict[str, Any], client: StandInMQTTClient
+) -> HomeAssistantMQTTPublisher:
+    """Publisher connected to a stand-in client instead of a broker."""
+    publisher = HomeAssistantMQTTPublisher(config)
+    publisher.client = client  # type: ignore[assignment]
+    publisher.connected.set()
+    return publisher
+
+
+def legacy_convert(field_map: Dict[str, str], data: str) -> Dict[str, Any]:
+    """Reference split-chain parser of earlier releases, for comparison.
+
+    Like the original it formats its debug message even when DEBUG is off.
+    """
+    result = {}
+    for item in data.split(":")[1].split("|")[0].split(";"):
+        field, value_str = item.split("=", 1)
+        value = int(value_str.split(",")[0], 16)
+        result[field] = {
+            "Value": map_data_value(field, value),
+            "Description": field_map[field],
+            "Raw Value": value,
+        }
+    logger.debug(f"Converted data: {result}")
+    return result
+
+
+def ops_per_second(func: Callable[[], Any], seconds: float) -> float:
+    """Run func repeatedly for about the given time and return calls/second."""
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    repeat = max(1, int(seconds / max(elapsed, 1e-9)))
+    best = min(timer.repeat(repeat=min(repeat, 5), number=number))
+    return number / best
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of the values."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident memory of this process in megabytes, if known."""
+    # ru_maxrss survives exec on Linux, so a spawned child would report the
+    # peak of its parent; VmHWM starts afresh with the new process image
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def best_run_ms(command: List[str], runs: int, env: Dict[str, str]) -> float:
+    """Fastest wall time of running the command, in milliseconds."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def run_startup_benchmarks(runs: int = 5) -> Dict[str, float]:
+    """Measure how long a fresh interpreter takes to import and check the agent.
+
+    The bare interpreter start is subtracted from the import time.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    env = {**os.environ, "INVERTER_IP": "127.0.0.1", "PYTHONDONTWRITEBYTECODE": "1"}
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [directory, env.get("PYTHONPATH")])
+    )
+    interpreter = best_run_ms([sys.executable, "-c", "pass"], runs, env)
+    return {
+        "interpreter_ms": interpreter,
+        "import_agent_ms": best_run_ms(
+            [sys.executable, "-c", "import agent"], runs, env
+        )
+        - interpreter,
+        "check_config_ms": best_run_ms(
+            [sys.executable, os.path.join(directory, "agent.py"), "--check"], runs, env
+        ),
+    }
+
+
+def run_codec_benchmarks(seconds: float) -> Dict[str, float]:
+    """Benchmark request building, frame reading, decoding and publishing."""
+    reply = sample_reply(FIELD_MAP_INVERTER)
+    reply_bytes = reply.encode("ascii")
+    fields = tuple(FIELD_MAP_INVERTER)
+    extended_map = {**FIELD_MAP_INVERTER, **FIELD_MAP_EXTENDED}
+    extended_reply = sample_reply(extended_map)
+    schema = ReadingSchema(FIELD_MAP_INVERTER)
+
+    config = benchmark_config()
+    publisher = stand_in_publisher(config, StandInMQTTClient())
+    device = build_inverter_list(config)[0]
+    data = decode_reading(schema, [reply_bytes])
+    publisher.publish_data(data, device)  # Discovery is only sent once
+
+    return {
+        "build_request": ops_per_second(
+            lambda: build_request(FIELD_MAP_INVERTER), seconds
+        ),
+        "requests_for_fields_cached": ops_per_second(
+            lambda: requests_for_fields(fields, 1), seconds
+        ),
+        "decode_str": ops_per_second(
+            lambda: convert_to_json(FIELD_MAP_INVERTER, reply), seconds
+        ),
+        "decode_bytes": ops_per_second(
+            lambda: convert_to_json(FIELD_MAP_INVERTER, reply_bytes), seconds
+        ),
+        "decode_reading": ops_per_second(
+            lambda: decode_reading(schema, [reply_bytes]), seconds
+        ),
+        "decode_legacy_split": ops_per_second(
+            lambda: legacy_convert(FIELD_MAP_INVERTER, reply), seconds
+        ),
+        "decode_extended_str": ops_per_second(
+            lambda: convert_to_json(extended_map, extended_reply), seconds
+        ),
+        "map_data_value": ops_per_second(lambda: map_data_value("UL1", 0x8FC), seconds),
+        "extract_frame": ops_per_second(
+            lambda: extract_frame(bytearray(reply_bytes)), seconds
+        ),
+        "discovery_payload": ops_per_second(
+            lambda: publisher._send_discovery_config("PAC", data["PAC"], device, True),
+            seconds,
+        ),
+        "publish_data": ops_per_second(
+            lambda: publisher.publish_data(data, device), seconds
+        ),
+    }
+
+
+def traced_peak_kb(func: Callable[[], Any], runs: int = 20) -> float:
+    """Median peak of the memory allocated while func runs, in kilobytes."""
+    peaks: List[float] = []
+    for _ in range(runs):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        func()
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    return percentile(peaks, 0.5) / 1024
+
+
+def run_memory_benchmarks(count: int = 500) -> Dict[str, float]:
+    """Compare the memory of dict readings with the compact Reading type.
+
+    Reports the memory held by one reading, as every poller keeps its last
+    one, and the peak of the temporary allocations of decoding a reply and
+    merging it into the last reading, with and without publishing it. The
+    dict flow is the one of earlier releases.
+    """
+    reply = sample_reply(FIELD_MAP_INVERTER).encode("ascii")
+    config = benchmark_config()
+    publisher = stand_in_publisher(config, StandInMQTTClient())
+    device = build_inverter_list(config)[0]
+    schema = ReadingSchema(FIELD_MAP_INVERTER)
+    dict_last = convert_to_json(FIELD_MAP_INVERTER, reply)
+    reading_last = decode_reading(schema, [reply])
+    publisher.publish_data(dict_last, device)  # Discovery is only sent once
+
+    def decode_dict():
+        return {**dict_last, **convert_to_json(FIELD_MAP_INVERTER, reply)}
+
+    def decode_compact():
+        return reading_last.merged(decode_reading(schema, [reply]))
+
+    results = {}
+    tracemalloc.start()
+    try:
+        for name, decode in (("dict", decode_dict), ("reading", decode_compact)):
+            gc.collect()
+            before = tracemalloc.get_traced_memory()[0]
+            kept = [decode() for _ in range(count)]
+            results[f"{name}_reading_kb"] = (
+                (tracemalloc.get_traced_memory()[0] - before) / count / 1024
+            )
+            results[f"{name}_decode_peak_kb"] = traced_peak_kb(decode)
+            results[f"{name}_publish_peak_kb"] = traced_peak_kb(
+                lambda: publisher.publish_data(decode(), device)
+            )
+            del kept
+    finally:
+        tracemalloc.stop()
+    return results
+
+
+def _serve_fleet(count: int, connection):
+    """Run simulated inverters in a child process until told to stop."""
+
+    async def serve():
+        servers = await start_fleet(count)
+        connection.send([server_port(server) for server in servers])
+        await asyncio.get_running_loop().run_in_executor(None, connection.recv)
+        for server in servers:
+            server.close()
+
+    asyncio.run(serve())
+
+
+async def poll_fleet(ports: List[int], cycles: int) -> Dict[str, float]:
+    """Poll every simulated inverter ``cycles`` times and measure the cycles."""
+    config = benchmark_config()
+    entries = [
+        {"ip": "127.0.0.1", "port": port, "device_id": f"bench_{index:03d}"}
+        for index, port in enumerate(ports)
+    ]
+    client = StandInMQTTClient()
+    publisher = stand_in_publisher(config, client)
+    pollers = [
+        InverterPoller(inverter, publisher)
+        for inverter in build_inverter_list(config, entries)
+    ]
+
+    async def cycle():
+        for poller in pollers:
+            poller.schedule.reset()  # Request every field each cycle
+        await asyncio.gather(*(poller.poll_once() for poller in pollers))
+
+    await cycle()  # Warm up; also sends the discovery configs
+    messages_before = client.messages
+    cycle_times = []
+    poll_times: List[float] = []
+    cpu_start = time.process_time()
+    for _ in range(cycles):
+        start = time.perf_counter()
+        await cycle()
+        cycle_times.append(time.perf_counter() - start)
+        poll_times.extend(poller.last_latency or 0.0 for poller in pollers)
+    cpu = time.process_time() - cpu_start
+
+    for poller in pollers:
+        await poller.connection.close()
+    polls = len(pollers) * cycles
+    results = {
+        "cycle_p50_ms": percentile(cycle_times, 0.5) * 1000,
+        "cycle_p99_ms": percentile(cycle_times, 0.99) * 1000,
+        "poll_p50_ms": percentile(poll_times, 0.5) * 1000,
+        "poll_p99_ms": percentile(poll_times, 0.99) * 1000,
+        "cpu_per_poll_ms": cpu / polls * 1000,
+        "polls_per_second": polls / sum(cycle_times),
+        "messages_per_poll": (client.messages - messages_before) / polls,
+    }
+    rss = peak_rss_mb()
+    if rss is not None:
+        results["peak_rss_mb"] = rss
+    return results
+
+
+def _poll_fleet(ports: List[int], cycles: int, connection):
+    """Run poll_fleet in a child process and send back its results."""
+    logger.setLevel(logging.WARNING)
+    connection.send(asyncio.run(poll_fleet(ports, cycles)))
+
+
+def run_fleet_benchmark(count: int, cycles: int) -> Dict[str, float]:
+    """Poll ``count`` simulated inverters served by a child process.
+
+    The simulator runs in its own process so that CPU time and memory are
+    those of the agent alone. The pollers run in a fresh interpreter as
+    well, as the peak memory of a process never goes down and would
+    otherwise be that of the largest run so far.
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_serve_fleet, args=(count, child))
+    process.start()
+    try:
+        ports = parent.recv()
+        context = multiprocessing.get_context("spawn")
+        results, results_child = context.Pipe()
+        poller = context.Process(
+            target=_poll_fleet, args=(ports, cycles, results_child)
+        )
+        poller.start()
+        results_child.close()
+        try:
+            return results.recv()
+        finally:
+            poller.join(timeout=10)
+    finally:
+        parent.send("stop")
+        process.join(timeout=10)
+
+
+async def poll_sharded(ports: List[int], workers: int, seconds: float) -> float:
+    """Poll the inverters without pause for ``seconds``, return MQTT messages/s."""
+    entries = [
+        {"ip": "127.0.0.1", "port": port, "device_id": f"bench_{index:03d}"}
+        for index, port in enumerate(ports)
+    ]
+    config = benchmark_config(update_interval=0)
+    config["inverters"] = build_inverter_list(config, entries)
+    client = StandInMQTTClient()
+    publisher = stand_in_publisher(config, client)
+
+    pool = None
+    if workers > 1:
+        pool = WorkerPool(config, publisher, workers)
+        tasks = [asyncio.create_task(pool.run())]
+    else:
+        pollers = create_pollers(config, publisher)
+        tasks = [asyncio.create_task(poller.run()) for poller in pollers]
+
+    await asyncio.sleep(2)  # Let the workers start and the discovery pass
+    messages = client.messages
+    await asyncio.sleep(seconds)
+    messages = client.messages - messages
+
+    await cancel_tasks(tasks)
+    if pool is not None:
+        await pool.close()
+    else:
+        for poller in pollers:
+            await poller.connection.close()
+    return messages / seconds
+
+
+def run_sharding_benchmark(
+    count: int, worker_counts: List[int], seconds: float
+) -> Dict[str, float]:
+    """Measure polling throughput of ``count`` inverters with each worker count.
+
+    The simulated inverters are spread over as many child processes as
+    there are workers at most, so that they do not limit the agent.
+    """
+    servers = max(worker_counts)
+    connections = []
+    processes = []
+    for index in range(servers):
+        parent, child = multiprocessing.Pipe()
+        share = count // servers + (index < count % servers)
+        process = multiprocessing.Process(target=_serve_fleet, args=(share, child))
+        process.start()
+        connections.append(parent)
+        processes.append(process)
+    try:
+        ports = [port for connection in connections for port in connection.recv()]
+        return {
+            f"messages_per_second_{workers}w": asyncio.run(
+                poll_sharded(ports, workers, seconds)
+            )
+            for workers in worker_counts
+        }
+    finally:
+        for connection, process in zip(connections, processes):
+            connection.send("stop")
+            process.join(timeout=10)
+
+
+def compare_results(
+    results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float
+) -> List[str]:
+    """Describe every metric that got worse than the baseline by more than tolerance."""
+    regressions = []
+    for section, metrics in results.items():
+        if not isinstance(metrics, dict):
+            continue
+        for name, value in metrics.items():
+            if isinstance(value, dict):
+                old_metrics = baseline.get(section, {}).get(name, {})
+                pairs = [
+                    (f"{section}.{name}.{key}", v, old_metrics.get(key))
+                    for key, v in value.items()
+                ]
+            else:
+                pairs = [
+                    (f"{section}.{name}", value, baseline.get(section, {}).get(name))
+                ]
+            for label, new, old in pairs:
+                if not isinstance(old, (int, float)) or not old:
+                    continue
+                change = new / old - 1
+                if label.endswith(LOWER_IS_BETTER):
+                    worse = change > tolerance
+                else:
+                    worse = change < -tolerance
+                if worse:
+                    regressions.append(
+                        f"{label}: {old:,.3f} -> {new:,.3f} ({change:+.0%})"
+                    )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument(
+        "--seconds", type=float, default=1.0, help="approximate time per benchmark"
+    )
+    parser.add_argument(
+        "--fleets",
+        default="1,10,500",
+        help="comma-separated fleet sizes to poll end to end ('' to skip)",
+    )
+    parser.add_argument(
+        "--cycles", type=int, default=20, help="measured poll cycles per fleet"
+    )
+    parser.add_argument(
+        "--workers",
+        default="1,2,4",
+        help="comma-separated worker counts for the sharding benchmark ('' to skip)",
+    )
+    parser.add_argument(
+        "--shard-fleet",
+        type=int,
+        default=200,
+        help="inverters polled by the sharding benchmark",
+    )
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    parser.add_argument(
+        "--compare", help="JSON results of a previous run to compare with"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="relative change counted as a regression when comparing",
+    )
+    args = parser.parse_args()
+
+    # Log output would dominate the measurements, also in worker processes
+    logger.setLevel(logging.WARNING)
+    os.environ["LOG_LEVEL"] = "WARNING"
+
+    results: Dict[str, Any] = {
+        "system": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "startup": run_startup_benchmarks(),
+        "codec": run_codec_benchmarks(args.seconds),
+        "memory": run_memory_benchmarks(),
+        "fleet": {},
+    }
+    for count in (int(size) for size in args.fleets.split(",") if size.strip()):
+        results["fleet"][str(count)] = run_fleet_benchmark(count, args.cycles)
+    worker_counts = [int(count) for count in args.workers.split(",") if count.strip()]
+    if worker_counts:
+        results["sharding"] = run_sharding_benchmark(
+            args.shard_fleet, worker_counts, max(args.seconds, 3.0)
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        for name, value in results["startup"].items():
+            print(f"{name:<28} {value:>14,.1f} ms")
+        for name, value in results["codec"].items():
+            print(f"{name:<28} {value:>14,.0f} ops/s")
+        print("\nMemory per poll cycle:")
+        for name, value in results["memory"].items():
+            print(f"  {name:<26} {value:>14,.2f}")
+        for count, metrics in results["fleet"].items():
+            print(f"\n{count} inverter(s):")
+            for name, value in metrics.items():
+                print(f"  {name:<26} {value:>14,.2f}")
+        if "sharding" in results:
+            print(f"\nSharding {args.shard_fleet} inverter(s):")
+            for name, value in results["sharding"].items():
+                print(f"  {name:<26} {value:>14,.0f}")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
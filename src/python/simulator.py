@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Local simulator of Solarmax inverters speaking the MaxTalk protocol.
+
+Answers `{FB;01;..|64:PAC;...|CCCC}` requests with realistic values, so the
+agent can be tested and benchmarked without hardware. Latency, jitter,
+fragmented replies, truncated frames and dropped connections can be
+injected, and hundreds of virtual inverters can be served on consecutive
+ports. Several bus addresses on one port emulate inverters chained behind
+an RS485 gateway.
+
+Usage:
+    python simulator.py [--count 1] [--port 12345] [--addresses 1-4]
+                        [--latency 0.05] ...
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from agent import (
+    MASTER_ADDRESS,
+    FrameError,
+    build_frame,
+    extract_frame,
+    logger,
+    parse_addresses,
+)
+
+# Realistic raw values of a three-phase inverter at midday
+SAMPLE_VALUES = {
+    "KDY": 0x1F,
+    "KMT": 0x2A,
+    "KYR": 0x1C3,
+    "KT0": 0x4D2,
+    "PDC": 0x206C,
+    "PD01": 0xCB2,
+    "PD02": 0x13BA,
+    "UD01": 0xF0A,
+    "UD02": 0xF11,
+    "IDC": 0x2BC,
+    "ID01": 0x12C,
+    "ID02": 0x190,
+    "PAC": 0x1F0A,
+    "UL1": 0x8FC,
+    "UL2": 0x901,
+    "UL3": 0x8F7,
+    "IL1": 0x1F4,
+    "IL2": 0x1F5,
+    "IL3": 0x1F3,
+    "CAC": 0xCAF,
+    "KHR": 0x1234,
+    "TKK": 0x2D,
+    "SAL": 0x0,
+    "SYS": 0x4E21,
+}
+
+# Value used for fields without a sample
+DEFAULT_SAMPLE_VALUE = 0x64
+
+# Fields whose values fluctuate between replies, by relative amplitude
+NOISY_FIELDS = {
+    "PAC": 0.05,
+    "PDC": 0.05,
+    "PD01": 0.05,
+    "PD02": 0.05,
+    "IDC": 0.05,
+    "ID01": 0.05,
+    "ID02": 0.05,
+    "IL1": 0.05,
+    "IL2": 0.05,
+    "IL3": 0.05,
+    "UL1": 0.01,
+    "UL2": 0.01,
+    "UL3": 0.01,
+    "UD01": 0.02,
+    "UD02": 0.02,
+}
+
+
+def format_items(values: Dict[str, int]) -> str:
+    """Format raw values as the data part of a reply."""
+    items = []
+    for field, value in values.items():
+        items.append(f"{field}={value:X},0" if field == "SYS" else f"{field}={value:X}")
+    return ";".join(items)
+
+
+def sample_reply(field_map: Iterable[str], address: int = 1) -> str:
+    """Build a reply frame as the inverter would send it for the fields."""
+    values = {
+        field: SAMPLE_VALUES.get(field, DEFAULT_SAMPLE_VALUE) for field in field_map
+    }
+    return build_frame(
+        format(address, "02X"), MASTER_ADDRESS, "64:" + format_items(values)
+    )
+
+
+def parse_request(frame: bytes) -> Optional[Tuple[int, List[str]]]:
+    """Return the destination and requested fields of a query frame.
+
+    Returns None if the frame is not a query.
+    """
+    text = frame.decode("ascii", errors="replace")
+    try:
+        header, data = text.split("|")[:2]
+        destination = int(header.split(";")[1], 16)
+    except (IndexError, ValueError):
+        return None
+    if not data.startswith("64:"):
+        return None
+    return destination, [field for field in data[3:].split(";") if field]
+
+
+class SimulatedInverter:
+    """A virtual inverter with misbehaviour that can be injected per reply.
+
+    ``truncate_rate`` and ``drop_rate`` are probabilities per request. A
+    truncated reply is cut short and the connection stays open, a dropped
+    connection is closed without reply. With ``fragment_size`` set, replies
+    are written in chunks of that many bytes. Given ``addresses``, it
+    answers for each of them like inverters sharing a gateway.
+    """
+
+    def __init__(
+        self,
+        address: int = 1,
+        addresses: Iterable[int] = (),
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        fragment_size: int = 0,
+        truncate_rate: float = 0.0,
+        drop_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.address = address
+        self.addresses = set(addresses) or {address}
+        self.latency = latency
+        self.jitter = jitter
+        self.fragment_size = fragment_size
+        self.truncate_rate = truncate_rate
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.started = time.time()
+        self.requests = 0
+        self.connections = 0
+
+    def values(self, fields: Iterable[str]) -> Dict[str, int]:
+        """Current raw values of the fields, with some noise and rising counters."""
+        elapsed_hours = int((time.time() - self.started) / 3600)
+        values = {}
+        for field in fields:
+            value = SAMPLE_VALUES.get(field, DEFAULT_SAMPLE_VALUE)
+            amplitude = NOISY_FIELDS.get(field)
+            if amplitude:
+                value = max(
+                    0, int(value * (1 + self.random.uniform(-amplitude, amplitude)))
+                )
+            elif field in ("KT0", "KHR"):
+                value += elapsed_hours
+            values[field] = value
+        return values
+
+    def reply(self, fields: Iterable[str], address: Optional[int] = None) -> bytes:
+        """Build the reply frame to a request for the fields."""
+        payload = "64:" + format_items(self.values(fields))
+        source = format(self.address if address is None else address, "02X")
+        return build_frame(source, MASTER_ADDRESS, payload).encode("ascii")
+
+    async def _send(self, writer: asyncio.StreamWriter, reply: bytes):
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.truncate_rate and self.random.random() < self.truncate_rate:
+            reply = reply[: self.random.randint(1, len(reply) - 1)]
+        if not self.fragment_size:
+            writer.write(reply)
+            await writer.drain()
+            return
+        for start in range(0, len(reply), self.fragment_size):
+            writer.write(reply[start : start + self.fragment_size])
+            await writer.drain()
+            await asyncio.sleep(0)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve one client connection until it closes."""
+        self.connections += 1
+        buffer = bytearray()
+        try:
+            while True:
+                chunk = await reader.read(1024)
+                if not chunk:
+                    break
+                buffer += chunk
+                while True:
+                    try:
+                        frame = extract_frame(buffer)
+                    except FrameError as e:
+                        logger.debug(f"Simulator ignoring malformed request: {e}")
+                        continue
+                    if frame is None:
+                        break
+                    request = parse_request(frame)
+                    if request is None or request[0] not in self.addresses:
+                        continue
+                    address, fields = request
+                    self.requests += 1
+                    if self.drop_rate and self.random.random() < self.drop_rate:
+                        return
+                    await self._send(writer, self.reply(fields, address))
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def start_fleet(
+    count: int, host: str = "127.0.0.1", base_port: int = 0, **options
+) -> List[asyncio.AbstractServer]:
+    """Start ``count`` simulated inverters on consecutive ports.
+
+    With ``base_port`` 0 every inverter gets a free port chosen by the OS.
+    The keyword options are passed to SimulatedInverter; a ``seed`` is
+    offset per inverter so that their noise differs.
+    """
+    servers: List[asyncio.AbstractServer] = []
+    seed = options.pop("seed", None)
+    for index in range(count):
+        inverter = SimulatedInverter(
+            seed=None if seed is None else seed + index, **options
+        )
+        port = base_port + index if base_port else 0
+        server = await asyncio.start_server(inverter.handle, host, port)
+        server.inverter = inverter  # type: ignore[attr-defined]
+        servers.append(server)
+    return servers
+
+
+def server_port(server: asyncio.AbstractServer) -> int:
+    """Port a simulator server is listening on."""
+    return server.sockets[0].getsockname()[1]  # type: ignore[attr-defined]
+
+
+async def serve(args: argparse.Namespace):
+    servers = await start_fleet(
+        args.count,
+        host=args.host,
+        base_port=args.port,
+        address=args.address,
+        addresses=parse_addresses(args.addresses) if args.addresses else (),
+        latency=args.latency,
+        jitter=args.jitter,
+        fragment_size=args.fragment,
+        truncate_rate=args.truncate,
+        drop_rate=args.drop,
+        seed=args.seed,
+    )
+    ports = [server_port(server) for server in servers]
+    logger.info(
+        f"Simulating {len(servers)} inverter(s) on {args.host} "
+        f"ports {ports[0]}-{ports[-1]}"
+    )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for server in servers:
+            server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--count", type=int, default=1, help="number of inverters")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument(
+        "--port", type=int, default=12345, help="port of the first inverter"
+    )
+    parser.add_argument("--address", type=int, default=1, help="inverter bus address")
+    parser.add_argument(
+        "--addresses", help="bus addresses answered on each port, e.g. 1-4"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="reply delay in seconds"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="random extra delay in seconds"
+    )
+    parser.add_argument(
+        "--fragment", type=int, default=0, help="write replies in chunks of N bytes"
+    )
+    parser.add_argument(
+        "--truncate", type=float, default=0.0, help="probability of a truncated reply"
+    )
+    parser.add_argument(
+        "--drop", type=float, default=0.0, help="probability of a dropped connection"
+    )
+    parser.add_argument("--seed", type=int, help="random seed for reproducible runs")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
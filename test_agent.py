@@ -3,37 +3,72 @@
 Basic test for the Solarmax agent functionality.
 """
 
+import asyncio
+import calendar
+import datetime
+import json
+import logging
 import os
+import pickle
 import sys
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import Mock, patch, MagicMock, mock_open
+from unittest.mock import Mock, patch
 
+# Add the src directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "src", "python"))
 
-def mock_open_side_effect(*args, **kwargs):
-    """Mock open function to avoid file system access during tests."""
-    raise FileNotFoundError("Mocked file not found")
-
-
-# Mock environment variables and config files before importing
-os.environ["INVERTER_IP"] = "192.168.1.100"
-os.environ["MQTT_BROKER_IP"] = "192.168.1.10"
-os.environ["MQTT_INVERTER_TOPIC"] = "test/topic"
-
-# Mock config file loading
-with patch("builtins.open", side_effect=mock_open_side_effect):
-    with patch("os.path.exists", return_value=False):
-        # Add the src directory to Python path
-        sys.path.insert(0, os.path.join(os.path.dirname(__file__), "src", "python"))
-
-        from agent import (
-            build_request,
-            calculate_checksum,
-            map_data_value,
-            convert_to_json,
-            FIELD_MAP_INVERTER,
-            STATUS_CODES,
-            ALARM_CODES,
-        )
+from agent import (
+    InverterConnection,
+    FIELD_MAP_EXTENDED,
+    MAX_FRAME_LENGTH,
+    FanOut,
+    FileSink,
+    HistoryStore,
+    LatestReadings,
+    AdaptivePolling,
+    Metrics,
+    Sink,
+    SinkRecord,
+    StatusServer,
+    Outbox,
+    ChangeFilter,
+    FieldSchedule,
+    HomeAssistantMQTTPublisher,
+    FrameError,
+    InverterPoller,
+    build_frame,
+    sun_times,
+    build_inverter_list,
+    extract_frame,
+    requests_for_fields,
+    build_request,
+    build_requests,
+    calculate_checksum,
+    map_data_value,
+    convert_to_json,
+    decode_values,
+    decode_reading,
+    generate_empty_data,
+    Reading,
+    ReadingSchema,
+    FIELD_MAP_INVERTER,
+    STATUS_CODES,
+    validate_config,
+    DerivedMetrics,
+    create_pollers,
+    parse_addresses,
+    scan_bus,
+    shard_inverters,
+    WorkerPool,
+    load_config,
+    ConfigReloader,
+    main,
+    ALARM_CODES,
+)
+from simulator import server_port, start_fleet
 
 
 class TestSolarmaxAgent(unittest.TestCase):
@@ -55,6 +90,1322 @@ class TestSolarmaxAgent(unittest.TestCase):
         self.assertTrue(request.startswith("{FB;01;"))
         self.assertTrue(request.endswith("}"))
 
+    def test_build_request_address(self):
+        """Test that the destination address is encoded as two hex digits."""
+        request = build_request({"PAC": "AC Power"}, address=12)
+        self.assertTrue(request.startswith("{FB;0C;"))
+        self.assertEqual(int(request[7:9], 16), len(request))
+
+    def test_build_inverter_list(self):
+        """Test expanding the inverter list from the configuration."""
+        base = {
+            "inverter_ip": "192.168.1.100",
+            "inverter_port": 12345,
+            "update_interval": 30,
+            "device_id": "solarmax",
+            "device_name": "Solarmax",
+            "mqtt_topic_prefix": "solarmax",
+            "availability_topic": "solarmax/availability",
+        }
+
+        single = build_inverter_list(base)
+        self.assertEqual(len(single), 1)
+        self.assertEqual(single[0]["availability_topic"], "solarmax/availability")
+
+        fleet = build_inverter_list(
+            base, [{"address": 1}, {"ip": "192.168.1.101", "address": 2}]
+        )
+        self.assertEqual([inv["address"] for inv in fleet], [1, 2])
+        self.assertEqual(fleet[1]["ip"], "192.168.1.101")
+        self.assertEqual(fleet[1]["device_id"], "solarmax_02")
+        self.assertEqual(fleet[1]["mqtt_topic_prefix"], "solarmax/solarmax_02")
+
+    def test_validate_config(self):
+        """Test that a missing inverter address is reported before startup."""
+        config = load_config()
+        config["mqtt_host"] = "broker"
+        config["inverters"] = build_inverter_list({**config, "inverter_ip": "10.0.0.2"})
+        self.assertEqual(validate_config(config), [])
+
+        config["mqtt_host"] = ""
+        config["inverters"] = build_inverter_list({**config, "inverter_ip": None})
+        problems = validate_config(config)
+        self.assertEqual(len(problems), 2)
+        self.assertIn("mqtt_host", problems[0])
+        self.assertIn("not set", problems[1])
+
+    def test_log_level_from_options_at_startup(self):
+        """Test that the log level of the options file applies from the start."""
+        root = logging.getLogger()
+        self.addCleanup(root.setLevel, root.level)
+        with tempfile.TemporaryDirectory() as directory:
+            options = os.path.join(directory, "options.json")
+            with open(options, "w") as f:
+                json.dump(
+                    {
+                        "mqtt_host": "broker",
+                        "inverter_ip": "10.0.0.2",
+                        "log_level": "error",
+                    },
+                    f,
+                )
+            with patch("agent.CONFIG_PATH", options), patch("builtins.print"):
+                main(["--check"])
+        self.assertEqual(root.level, logging.ERROR)
+
+    def test_shard_inverters(self):
+        """Test that shards are balanced and keep inverters of a gateway together."""
+        inverters = [
+            {"ip": "10.0.0.1", "port": 12345, "address": 1},
+            {"ip": "10.0.0.1", "port": 12345, "address": 2},
+            {"ip": "10.0.0.2", "port": 12345, "address": 1},
+            {"ip": "10.0.0.3", "port": 12345, "address": 1},
+        ]
+        shards = shard_inverters(inverters, 2)
+        self.assertEqual([len(shard) for shard in shards], [2, 2])
+        self.assertEqual({inv["ip"] for inv in shards[0]}, {"10.0.0.1"})
+        self.assertEqual(len(shard_inverters(inverters, 8)), 3)
+
+    def test_worker_pool(self):
+        """Test that worker processes poll their shards and are restarted."""
+
+        async def run():
+            servers = await start_fleet(3)
+            base = {
+                "inverter_ip": "127.0.0.1",
+                "inverter_port": 12345,
+                "update_interval": 1,
+                "device_id": "solarmax",
+                "device_name": "Solarmax",
+                "mqtt_topic_prefix": "solarmax",
+                "availability_topic": "solarmax/availability",
+            }
+            entries = [
+                {"port": server_port(server), "device_id": f"inv{index}"}
+                for index, server in enumerate(servers)
+            ]
+            config = {"inverters": build_inverter_list(base, entries)}
+            output = Mock()
+            pool = WorkerPool(config, output, 2)
+
+            def published():
+                return {
+                    call.args[1]["device_id"]
+                    for call in output.publish_data.call_args_list
+                }
+
+            async def wait_for_readings():
+                output.reset_mock()
+                for _ in range(300):
+                    if published() == {"inv0", "inv1", "inv2"}:
+                        return
+                    await asyncio.sleep(0.05)
+
+            try:
+                for index in range(len(pool.shards)):
+                    pool._start_worker(index)
+                await wait_for_readings()
+                self.assertEqual(published(), {"inv0", "inv1", "inv2"})
+                data = output.publish_data.call_args_list[-1].args[0]
+                self.assertEqual(data["PAC"]["Description"], FIELD_MAP_INVERTER["PAC"])
+
+                crashed = pool.processes[0]
+                crashed.kill()
+                crashed.join()
+                pool._check(time.monotonic())
+                self.assertIsNone(pool.processes[0])
+                pool.restart_at[0] = 0  # Skip the backoff
+                pool._check(time.monotonic())
+                self.assertIsNot(pool.processes[0], crashed)
+                await wait_for_readings()
+                self.assertEqual(published(), {"inv0", "inv1", "inv2"})
+            finally:
+                await pool.close()
+                for server in servers:
+                    server.close()
+            self.assertFalse(any(p.is_alive() for p in pool.processes if p))
+
+        asyncio.run(run())
+
+    def test_poll_inverters_concurrently(self):
+        """Test that a silent inverter does not delay polling the others."""
+        response = build_frame("01", "FB", "64:PAC=1F40;SYS=4E21,0").encode()
+
+        async def handle(reader, writer):
+            await reader.read(1024)
+            writer.write(response)
+            await writer.drain()
+
+        async def silent(reader, writer):
+            await asyncio.sleep(5)
+
+        async def scenario():
+            good = await asyncio.start_server(handle, "127.0.0.1", 0)
+            bad = await asyncio.start_server(silent, "127.0.0.1", 0)
+            publisher = Mock()
+            field_map = {"PAC": "AC Power (W)", "SYS": "Status Code"}
+            pollers = []
+            for server in (bad, good):
+                port = server.sockets[0].getsockname()[1]
+                inverter = {
+                    "ip": "127.0.0.1",
+                    "port": port,
+                    "address": 1,
+                    "device_id": f"inv_{port}",
+                    "device_name": f"Inverter {port}",
+                    "update_interval": 30,
+                }
+                pollers.append(InverterPoller(inverter, publisher, field_map))
+            pollers[0].connection.timeout = 1
+
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            fast = asyncio.ensure_future(pollers[1].poll_once())
+            slow = asyncio.ensure_future(pollers[0].poll_once())
+            self.assertAlmostEqual(await fast, 30, delta=1)
+            fast_elapsed = loop.time() - start
+            await slow
+            good.close()
+            bad.close()
+            return publisher, fast_elapsed
+
+        publisher, fast_elapsed = asyncio.run(scenario())
+        self.assertLess(fast_elapsed, 0.5)
+        data, device = publisher.publish_data.call_args_list[0][0]
+        self.assertEqual(data["PAC"]["Value"], 4000.0)
+        self.assertTrue(device["device_id"].startswith("inv_"))
+
+    def test_persistent_connection_reuse(self):
+        """Test that persistent sessions are reused and reconnected when dropped."""
+        response = build_frame("01", "FB", "64:PAC=1F40;SYS=4E21,0").encode()
+        connections = []
+
+        async def handle(reader, writer):
+            connections.append(writer)
+            while await reader.read(1024):
+                writer.write(response)
+                await writer.drain()
+
+        async def scenario():
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            connection = InverterConnection("127.0.0.1", port, persistent=True)
+            responses = [await connection.query("{FB;01;...}") for _ in range(3)]
+
+            # Drop the session on the server side; the next query reconnects
+            connections[-1].close()
+            await asyncio.sleep(0.05)
+            responses.append(await connection.query("{FB;01;...}"))
+            await connection.close()
+            server.close()
+            return responses
+
+        responses = asyncio.run(scenario())
+        self.assertEqual(responses, [response] * 4)
+        self.assertEqual(len(connections), 2)
+
+    def test_extract_frame(self):
+        """Test frame assembly from fragments, with leading garbage."""
+        frame = build_frame("01", "FB", "64:PAC=1F40;PDC=1388").encode()
+        buffer = bytearray(b"\x00garbage")
+        for index in range(0, len(frame), 5):
+            self.assertIsNone(extract_frame(buffer))
+            buffer += frame[index : index + 5]
+        buffer += b"{01;"  # Start of the next frame stays buffered
+        self.assertEqual(extract_frame(buffer), frame)
+        self.assertEqual(buffer, bytearray(b"{01;"))
+
+    def test_extract_frame_checksum_mismatch(self):
+        """Test that corrupted frames are rejected."""
+        frame = build_frame("01", "FB", "64:PAC=1F40").replace("1F40", "1F41")
+        with self.assertRaises(FrameError):
+            extract_frame(bytearray(frame.encode()))
+
+    def test_read_data_returns_on_complete_frame(self):
+        """Test that a fragmented reply is returned as soon as it is complete."""
+        frame = build_frame("01", "FB", "64:" + ";".join(["PAC=1F40"] * 150))
+
+        async def handle(reader, writer):
+            await reader.read(1024)
+            for index in range(0, len(frame), 300):
+                writer.write(frame[index : index + 300].encode())
+                await writer.drain()
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(5)  # Keep the connection open
+
+        async def scenario():
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            connection = InverterConnection("127.0.0.1", port, timeout=2)
+            await connection.connect()
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            response = await connection.read_data("{FB;01;...}")
+            elapsed = loop.time() - start
+            await connection.close()
+            server.close()
+            return response, elapsed
+
+        response, elapsed = asyncio.run(scenario())
+        self.assertEqual(response, frame.encode())
+        self.assertGreater(len(response), 1024)
+        self.assertLess(elapsed, 1)
+
+    def test_simulator_round_trip(self):
+        """Test polling simulated inverters with fragmented and truncated replies."""
+
+        async def scenario():
+            servers = await start_fleet(2, fragment_size=7, latency=0.01, seed=1)
+            truncating = await start_fleet(1, truncate_rate=1.0)
+            responses = []
+            for server in servers + truncating:
+                connection = InverterConnection(
+                    "127.0.0.1", server_port(server), timeout=0.5
+                )
+                responses.append(
+                    await connection.query(build_request(FIELD_MAP_INVERTER))
+                )
+            for server in servers + truncating:
+                server.close()
+            return responses, servers[0].inverter.requests
+
+        responses, requests = asyncio.run(scenario())
+        self.assertEqual(requests, 1)
+        for response in responses[:2]:
+            data = convert_to_json(FIELD_MAP_INVERTER, response)
+            self.assertEqual(set(data), set(FIELD_MAP_INVERTER))
+            self.assertEqual(data["SYS"]["Raw Value"], 20001)
+        self.assertEqual(responses[2], b"")
+
+    def test_gateway_shared_by_several_addresses(self):
+        """Test polling inverters chained behind one gateway over one session."""
+        self.assertEqual(parse_addresses("1-3,7"), [1, 2, 3, 7])
+
+        async def scenario():
+            servers = await start_fleet(1, addresses=[1, 2])
+            base = {
+                "inverter_ip": "127.0.0.1",
+                "inverter_port": server_port(servers[0]),
+                "update_interval": 30,
+                "device_id": "solarmax",
+                "device_name": "Solarmax",
+                "mqtt_topic_prefix": "solarmax",
+                "availability_topic": "solarmax/availability",
+            }
+            config = {
+                "inverters": build_inverter_list(base, [{"addresses": "1-3"}]),
+                "bus_timeout": 0.2,
+            }
+            publisher = Mock()
+            pollers = create_pollers(config, publisher)
+            await asyncio.gather(*(poller.poll_once() for poller in pollers))
+            found = await scan_bus("127.0.0.1", base["inverter_port"], [1, 2, 3], 0.2)
+            servers[0].close()
+            return pollers, publisher, servers[0].inverter, found
+
+        pollers, publisher, inverter, found = asyncio.run(scenario())
+        self.assertEqual(len({id(poller.connection) for poller in pollers}), 1)
+        self.assertEqual(inverter.connections, 2)  # The sweep and the scan
+        published = {
+            call.args[1]["address"]: call.args[0]
+            for call in publisher.publish_data.call_args_list
+        }
+        self.assertEqual(sorted(published), [1, 2, 3])
+        # The silent address behind the reachable gateway is reported offline
+        self.assertEqual(published[3].raw_value("SYS"), 20000)
+        self.assertNotEqual(published[1].raw_value("SYS"), 20000)
+        self.assertEqual(pollers[0].inverter["device_id"], "solarmax_01")
+        self.assertEqual(list(found), [1, 2])
+
+    def test_reply_routed_by_source_address(self):
+        """Test that a late reply from another bus address is skipped."""
+        stray = build_frame("02", "FB", "64:PAC=10").encode()
+        reply = build_frame("01", "FB", "64:PAC=1F40").encode()
+
+        async def handle(reader, writer):
+            await reader.read(1024)
+            writer.write(stray + reply)
+            await writer.drain()
+
+        async def scenario():
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            connection = InverterConnection(
+                "127.0.0.1", server.sockets[0].getsockname()[1]
+            )
+            response = await connection.query(build_request({"PAC": ""}, 1), 1)
+            server.close()
+            return response
+
+        self.assertEqual(asyncio.run(scenario()), reply)
+
+    def test_build_requests_splits_large_field_maps(self):
+        """Test that large field maps are split into frames under the limit."""
+        self.assertEqual(len(build_requests(FIELD_MAP_INVERTER)), 1)
+
+        field_map = {**FIELD_MAP_INVERTER, **FIELD_MAP_EXTENDED}
+        requests = build_requests(field_map, address=3)
+        self.assertGreater(len(requests), 1)
+
+        polled = []
+        for request in requests:
+            self.assertLessEqual(len(request), MAX_FRAME_LENGTH)
+            self.assertTrue(request.startswith("{FB;03;"))
+            polled.extend(request.split(":")[1].split("|")[0].split(";"))
+        self.assertEqual(polled, list(field_map))
+
+    def test_query_all_merges_batches(self):
+        """Test that batched requests are answered on one connection."""
+        connections = []
+
+        async def handle(reader, writer):
+            connections.append(writer)
+            buffer = bytearray()
+            while True:
+                chunk = await reader.read(1024)
+                if not chunk:
+                    break
+                buffer += chunk
+                request = extract_frame(buffer)
+                if request is not None:
+                    fields = request.decode().split(":")[1].split("|")[0]
+                    payload = ";".join(f"{f}=1" for f in fields.split(";"))
+                    writer.write(build_frame("01", "FB", "64:" + payload).encode())
+                    await writer.drain()
+
+        async def scenario():
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            field_map = {**FIELD_MAP_INVERTER, **FIELD_MAP_EXTENDED}
+            inverter = {
+                "ip": "127.0.0.1",
+                "port": port,
+                "address": 1,
+                "device_id": "inv",
+                "device_name": "Inverter",
+                "update_interval": 30,
+            }
+            publisher = Mock()
+            poller = InverterPoller(inverter, publisher, field_map)
+            await poller.poll_once()
+            server.close()
+            return publisher.publish_data.call_args[0][0]
+
+        data = asyncio.run(scenario())
+        self.assertEqual(set(data), set(FIELD_MAP_INVERTER) | set(FIELD_MAP_EXTENDED))
+        self.assertEqual(len(connections), 1)
+
+    def test_field_schedule(self):
+        """Test that only due fields are polled in each cycle."""
+        schedule = FieldSchedule(
+            ["PAC", "PDC", "KT0", "SWV"], 30, {"power": 2, "energy": 300, "SWV": 3600}
+        )
+        self.assertEqual(schedule.due(0), ("PAC", "PDC", "KT0", "SWV"))
+        schedule.mark_polled(("PAC", "PDC", "KT0", "SWV"), 0)
+
+        self.assertEqual(schedule.seconds_until_due(0), 2)
+        self.assertEqual(schedule.due(2), ("PAC", "PDC"))
+        schedule.mark_polled(("PAC", "PDC"), 2)
+        self.assertEqual(schedule.due(299.5), ("PAC", "PDC", "KT0"))
+
+        schedule.reset()
+        self.assertEqual(len(schedule.due(300)), 4)
+
+    def test_field_schedule_reconfigure(self):
+        """Test that changed intervals keep the time of the last poll."""
+        schedule = FieldSchedule(["PAC", "KT0"], 30)
+        schedule.mark_polled(("PAC", "KT0"), 100)
+        schedule.reconfigure(["PAC", "KT0", "SAL"], 30, {"PAC": 10})
+        self.assertEqual(schedule.next_due, {"PAC": 110, "KT0": 130, "SAL": 0})
+        self.assertEqual(schedule.due(110), ("PAC", "SAL"))
+
+    def test_slow_fields_not_republished(self):
+        """Test that fast cycles only publish the fields polled in them."""
+
+        async def handle(reader, writer):
+            buffer = bytearray()
+            while True:
+                chunk = await reader.read(1024)
+                if not chunk:
+                    break
+                buffer += chunk
+                request = extract_frame(buffer)
+                if request is not None:
+                    fields = request.decode().split(":")[1].split("|")[0]
+                    payload = ";".join(f"{f}=1" for f in fields.split(";"))
+                    writer.write(build_frame("01", "FB", "64:" + payload).encode())
+                    await writer.drain()
+
+        async def scenario():
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            publisher = HomeAssistantMQTTPublisher(
+                {
+                    "device_id": "inv",
+                    "device_name": "Inverter",
+                    "mqtt_topic_prefix": "solarmax",
+                    "availability_topic": "solarmax/availability",
+                    "home_assistant_discovery": False,
+                }
+            )
+            publisher.client = Mock()
+            publisher.client.publish.return_value = Mock(rc=0, mid=1)
+            publisher.connected.set()
+            inverter = {
+                "ip": "127.0.0.1",
+                "port": server.sockets[0].getsockname()[1],
+                "address": 1,
+                "device_id": "inv",
+                "device_name": "Inverter",
+                "mqtt_topic_prefix": "solarmax",
+                "availability_topic": "solarmax/availability",
+                "update_interval": 2,
+                "field_intervals": {"energy": 300},
+            }
+            field_map = {"PAC": "AC Power", "SYS": "Status", "KT0": "Total Energy"}
+            poller = InverterPoller(inverter, publisher, field_map)
+            await poller.poll_once()
+            first = publisher.client.publish.call_count
+            await poller.poll_once()  # Nothing due yet, so only the ramp fields
+            server.close()
+            return publisher.client.publish.call_args_list[first:]
+
+        calls = asyncio.run(scenario())
+        topics = {c.args[0]: c.args[1] for c in calls}
+        self.assertIn("solarmax/PAC", topics)
+        self.assertNotIn("solarmax/KT0", topics)
+        # The attributes still carry the last value of the slow field
+        self.assertIn("KT0", json.loads(topics["solarmax/attributes"]))
+
+    def test_config_reloader(self):
+        """Test that reloadable options are applied from commands and the file."""
+        root = logging.getLogger()
+        self.addCleanup(root.setLevel, root.level)
+        with tempfile.TemporaryDirectory() as directory:
+            options = os.path.join(directory, "options.json")
+            settings = {
+                "mqtt_host": "broker",
+                "inverter_ip": "10.0.0.2",
+                "device_id": "inv",
+                "update_interval": 30,
+                "publish_on_change": True,
+            }
+            with open(options, "w") as f:
+                json.dump(settings, f)
+            config = load_config(options)
+            publisher = HomeAssistantMQTTPublisher(config)
+            publisher.client = Mock()
+            publisher.client.publish.return_value = Mock(rc=0, mid=1)
+            publisher.connected.set()
+            pollers = create_pollers(config, publisher)
+            reloader = ConfigReloader(config, publisher, pollers, config_path=options)
+            poller = pollers[0]
+
+            changed = reloader.command(b'{"update_interval": 10, "log_level": "debug"}')
+            self.assertEqual(changed, ["update_interval", "log_level"])
+            self.assertEqual(poller.schedule.intervals["PAC"], 10)
+            self.assertEqual(root.level, logging.DEBUG)
+            self.assertEqual(reloader.command(b'{"mqtt_host": "other"}'), [])
+            self.assertEqual(reloader.command(b'{"update_interval": -1}'), [])
+            self.assertEqual(reloader.command(b"not json"), [])
+            self.assertEqual(reloader.config["mqtt_host"], "broker")
+
+            self.assertEqual(
+                reloader.command(b'{"extended_fields": true}'), ["extended_fields"]
+            )
+            self.assertIn("KLD", poller.field_map)
+            self.assertIn("KLD", poller.schedule.due(0))
+
+            self.assertEqual(reloader.command(b'{"disabled_fields": ["XYZ"]}'), [])
+            self.assertEqual(reloader.command(b'{"disabled_fields": "TKK"}'), [])
+            self.assertEqual(
+                reloader.command(b'{"disabled_fields": ["TKK"]}'), ["disabled_fields"]
+            )
+            self.assertNotIn("TKK", poller.field_map)
+            self.assertNotIn("TKK", poller.schedule.intervals)
+            publisher.publish_data(
+                generate_empty_data(poller.field_map), poller.inverter
+            )
+
+            # Unchanged file: nothing to do; changed file: reloadable options applied
+            self.assertEqual(reloader.check_file(), [])
+            with open(options, "w") as f:
+                json.dump({**settings, "deadbands": {"PAC": 5}}, f)
+            os.utime(options, (reloader.mtime + 1, reloader.mtime + 1))
+            changed = reloader.check_file()
+        self.assertEqual(
+            changed,
+            [
+                "update_interval",
+                "extended_fields",
+                "disabled_fields",
+                "deadbands",
+                "log_level",
+            ],
+        )
+        self.assertNotIn("KLD", poller.field_map)
+        self.assertIn("TKK", poller.field_map)
+        self.assertEqual(poller.inverter["update_interval"], 30)
+        self.assertEqual(publisher.change_filter.deadbands, {"PAC": 5})
+        removed = [
+            c.args
+            for c in publisher.client.publish.call_args_list
+            if c.args[0] == "homeassistant/sensor/inv/kld/config"
+        ]
+        self.assertEqual(removed[-1][1], "")
+
+    def test_requests_for_fields_cached(self):
+        """Test that request frames are cached per field subset."""
+        first = requests_for_fields(("PAC", "PDC"), 1)
+        self.assertIs(requests_for_fields(("PAC", "PDC"), 1), first)
+        self.assertEqual(first, (build_request({"PAC": "", "PDC": ""}, 1),))
+
+    def test_change_filter_deadbands(self):
+        """Test absolute/relative deadbands and forced keyframes."""
+        change_filter = ChangeFilter(
+            {"power": {"absolute": 5, "relative": 0.01}, "UL1": 1}, 600
+        )
+        self.assertTrue(change_filter.start_cycle("inv", 0))
+        self.assertTrue(change_filter.changed("inv", "PAC", 1000.0, force=True))
+        # Nothing counts as published before the publisher reports it sent
+        self.assertTrue(change_filter.start_cycle("inv", 30))
+        self.assertTrue(change_filter.changed("inv", "PAC", 1000.0))
+        change_filter.remember("inv", "PAC", 1000.0)
+        change_filter.keyframe_sent("inv", 0)
+
+        self.assertFalse(change_filter.start_cycle("inv", 30))
+        self.assertFalse(change_filter.changed("inv", "PAC", 1009.0))  # 1% band
+        self.assertTrue(change_filter.changed("inv", "PAC", 1011.0))
+        change_filter.remember("inv", "UL1", 230.0)
+        self.assertFalse(change_filter.changed("inv", "UL1", 230.5))
+        self.assertTrue(change_filter.changed("inv", "UL1", 231.5))
+        change_filter.remember("inv", "SYS", "In Betrieb")
+        self.assertFalse(change_filter.changed("inv", "SYS", "In Betrieb"))
+        self.assertTrue(change_filter.changed("inv", "SYS", "Aus"))
+        self.assertTrue(change_filter.start_cycle("inv", 600))
+
+    def test_publish_on_change(self):
+        """Test that unchanged values are not republished between keyframes."""
+        publisher = HomeAssistantMQTTPublisher(
+            {
+                "device_id": "inv",
+                "device_name": "Inverter",
+                "mqtt_topic_prefix": "solarmax",
+                "availability_topic": "solarmax/availability",
+                "home_assistant_discovery": False,
+                "publish_on_change": True,
+                "deadbands": {"PAC": 10},
+            }
+        )
+        publisher.client = Mock()
+        publisher.client.publish.return_value = Mock(rc=0, mid=1)
+        publisher.connected.set()
+        data = convert_to_json(FIELD_MAP_INVERTER, "x:PAC=7D0;KT0=4D2|")
+        publisher.publish_data(data)
+        first = publisher.client.publish.call_count
+        self.assertEqual(first, 4)  # Two sensors, attributes, availability
+
+        publisher.publish_data(
+            convert_to_json(FIELD_MAP_INVERTER, "x:PAC=7D4;KT0=4D2|")
+        )
+        self.assertEqual(publisher.client.publish.call_count, first)
+
+        publisher.publish_data(
+            convert_to_json(FIELD_MAP_INVERTER, "x:PAC=802;KT0=4D2|")
+        )
+        topics = [c[0][0] for c in publisher.client.publish.call_args_list[first:]]
+        self.assertEqual(topics, ["solarmax/PAC"])  # Attributes wait for a keyframe
+
+        # A value whose publish failed is sent again with the next reading
+        publisher.client.publish.return_value = Mock(rc=4, mid=1)  # No connection
+        changed = convert_to_json(FIELD_MAP_INVERTER, "x:PAC=900;KT0=4D2|")
+        self.assertFalse(publisher.publish_data(changed))
+        publisher.client.publish.return_value = Mock(rc=0, mid=1)
+        publisher.client.publish.reset_mock()
+        publisher.publish_data(changed)
+        topics = [c[0][0] for c in publisher.client.publish.call_args_list]
+        self.assertEqual(topics, ["solarmax/PAC"])
+
+    def test_compact_state(self):
+        """Test that compact mode publishes one state document per cycle."""
+        publisher = HomeAssistantMQTTPublisher(
+            {
+                "device_id": "inv",
+                "device_name": "Inverter",
+                "mqtt_topic_prefix": "solarmax",
+                "availability_topic": "solarmax/availability",
+                "discovery_prefix": "homeassistant",
+                "compact_state": True,
+            }
+        )
+        publisher.client = Mock()
+        publisher.client.publish.return_value = Mock(rc=0, mid=1)
+        publisher.connected.set()
+        data = convert_to_json(FIELD_MAP_INVERTER, "x:PAC=7D0;SYS=4E21,0|")
+        publisher.publish_data(data)
+
+        published = {c[0][0]: c[0][1] for c in publisher.client.publish.call_args_list}
+        self.assertEqual(
+            json.loads(published["solarmax/state"]),
+            {"PAC": 1000.0, "SYS": "In Betrieb"},
+        )
+        self.assertNotIn("solarmax/PAC", published)
+
+        discovery = json.loads(published["homeassistant/sensor/inv/pac/config"])
+        self.assertEqual(discovery["state_topic"], "solarmax/state")
+        self.assertEqual(discovery["value_template"], "{{ value_json.PAC }}")
+
+    def test_discovery_cache(self):
+        """Test that unchanged discovery configs are only re-sent on HA birth."""
+        with tempfile.TemporaryDirectory() as directory:
+            config = {
+                "device_id": "inv",
+                "device_name": "Inverter",
+                "mqtt_topic_prefix": "solarmax",
+                "availability_topic": "solarmax/availability",
+                "discovery_prefix": "homeassistant",
+                "discovery_cache": os.path.join(directory, "discovery.json"),
+            }
+            data = convert_to_json(FIELD_MAP_INVERTER, "x:PAC=7D0;SYS=4E21,0|")
+
+            def discovery_topics(publisher):
+                return [
+                    c.args[0]
+                    for c in publisher.client.publish.call_args_list
+                    if c.args[0].endswith("/config")
+                ]
+
+            def start(config):
+                publisher = HomeAssistantMQTTPublisher(config)
+                publisher.client = Mock()
+                publisher.client.publish.return_value = Mock(rc=0, mid=1)
+                publisher.connected.set()
+                return publisher
+
+            first = start(config)
+            first.publish_data(data)
+            self.assertEqual(len(discovery_topics(first)), 2)
+
+            # After a restart nothing changed, so nothing is re-sent
+            second = start(config)
+            second.publish_data(data)
+            self.assertEqual(discovery_topics(second), [])
+
+            # A retained status only means Home Assistant ran at some point
+            second._on_message(
+                second.client, None, Mock(payload=b"online", retain=True)
+            )
+            second.publish_data(data)
+            self.assertEqual(discovery_topics(second), [])
+
+            # Home Assistant restarted: send everything again
+            second._on_message(
+                second.client, None, Mock(payload=b"online", retain=False)
+            )
+            second.publish_data(data)
+            self.assertEqual(len(discovery_topics(second)), 2)
+
+            # A changed config is sent without a restart of Home Assistant
+            third = start({**config, "compact_state": True})
+            third.publish_data(data)
+            self.assertEqual(len(discovery_topics(third)), 2)
+
+    def test_paho_callbacks_run_in_loop(self):
+        """Test that broker callbacks change shared state in the event loop."""
+
+        async def scenario():
+            publisher = HomeAssistantMQTTPublisher(
+                {
+                    "device_id": "inv",
+                    "device_name": "Inverter",
+                    "mqtt_topic_prefix": "solarmax",
+                    "availability_topic": "solarmax/availability",
+                    "discovery_prefix": "homeassistant",
+                }
+            )
+            publisher.client = Mock()
+            publisher.client.publish.return_value = Mock(rc=0, mid=1)
+            publisher.loop = asyncio.get_running_loop()
+            message = Mock(
+                topic="homeassistant/status", payload=b"online", retain=False
+            )
+            thread = threading.Thread(
+                target=publisher._on_message, args=(publisher.client, None, message)
+            )
+            thread.start()
+            thread.join()
+            before = set(publisher.discovery_forced)
+            await asyncio.sleep(0)
+            return before, publisher.discovery_forced
+
+        before, after = asyncio.run(scenario())
+        self.assertEqual(before, set())
+        self.assertEqual(after, {"inv"})
+
+    def test_publish_qos_tracking(self):
+        """Test that QoS 1 messages are tracked until the broker acknowledges."""
+        publisher = HomeAssistantMQTTPublisher(
+            {
+                "device_id": "inv",
+                "device_name": "Inverter",
+                "mqtt_topic_prefix": "solarmax",
+                "availability_topic": "solarmax/availability",
+                "home_assistant_discovery": False,
+                "mqtt_qos": 1,
+            }
+        )
+        publisher.client = Mock()
+        mids = iter(range(1, 100))
+        publisher.client.publish.side_effect = lambda *a, **k: Mock(
+            rc=4, mid=next(mids)  # MQTT_ERR_NO_CONN: queued by paho
+        )
+
+        # Not connected, but QoS 1 messages are queued instead of dropped
+        data = convert_to_json(FIELD_MAP_INVERTER, "x:PAC=7D0|")
+        self.assertTrue(publisher.publish_data(data))
+        self.assertEqual(sorted(publisher.pending), [1, 2, 3])
+
+        for mid in (1, 2, 3):
+            publisher._on_publish(publisher.client, None, mid)
+        self.assertEqual(publisher.pending, {})
+
+    def test_publish_without_connection_qos0(self):
+        """Test that QoS 0 readings are reported as not published when offline."""
+        publisher = HomeAssistantMQTTPublisher(
+            {
+                "device_id": "inv",
+                "device_name": "Inverter",
+                "mqtt_topic_prefix": "solarmax",
+                "availability_topic": "solarmax/availability",
+            }
+        )
+        publisher.client = Mock()
+        data = convert_to_json(FIELD_MAP_INVERTER, "x:PAC=7D0|")
+        self.assertFalse(publisher.publish_data(data))
+        publisher.client.publish.assert_not_called()
+        publisher.client.loop_stop.assert_not_called()
+
+    def test_outbox_order_and_cursor(self):
+        """Test that the outbox replays in order and survives a restart."""
+        with tempfile.TemporaryDirectory() as directory:
+            outbox = Outbox(directory, segment_bytes=100)
+            for value in range(5):
+                outbox.append("inv", {"PAC": value}, 1000.0 + value)
+            self.assertTrue(outbox.pending())
+
+            batch = outbox.read_batch(3)
+            self.assertEqual([entry["data"]["PAC"] for entry in batch], [0, 1, 2])
+            # Without an ack the same readings are returned again
+            self.assertEqual(outbox.read_batch(3), batch)
+            outbox.ack()
+
+            # A partly replayed batch resumes after the last acknowledged reading
+            self.assertEqual(len(outbox.read_batch(2)), 2)
+            outbox.ack(1)
+
+            reopened = Outbox(directory, segment_bytes=100)
+            rest = reopened.read_batch(10)
+            self.assertEqual([entry["data"]["PAC"] for entry in rest], [4])
+            reopened.ack()
+            self.assertFalse(reopened.pending())
+
+    def test_outbox_evicts_oldest(self):
+        """Test that the outbox drops the oldest segments beyond its size limit."""
+        with tempfile.TemporaryDirectory() as directory:
+            outbox = Outbox(directory, max_bytes=400, segment_bytes=100)
+            for value in range(20):
+                outbox.append("inv", {"PAC": value}, 1000.0 + value)
+            values = [entry["data"]["PAC"] for entry in outbox.read_batch(100)]
+            self.assertLess(len(values), 20)
+            self.assertEqual(values[-1], 19)
+            self.assertEqual(values, sorted(values))
+
+    def test_publish_to_outbox_when_offline(self):
+        """Test that readings are stored while the broker is unreachable."""
+        with tempfile.TemporaryDirectory() as directory:
+            config = {
+                "device_id": "inv",
+                "device_name": "Inverter",
+                "mqtt_topic_prefix": "solarmax",
+                "availability_topic": "solarmax/availability",
+                "home_assistant_discovery": False,
+                "outbox_dir": directory,
+            }
+            publisher = HomeAssistantMQTTPublisher(config)
+            publisher.client = Mock()
+            publisher.client.publish.return_value = Mock(rc=0, mid=1)
+            data = convert_to_json(FIELD_MAP_INVERTER, "x:PAC=7D0|")
+            self.assertTrue(publisher.publish_data(data))
+            publisher.client.publish.assert_not_called()
+            self.assertTrue(publisher.outbox.pending())
+
+            # Replayed by a restarted agent before any new reading
+            publisher = HomeAssistantMQTTPublisher(
+                {**config, "inverters": [dict(config)]}
+            )
+            publisher.client = Mock()
+            publisher.client.publish.return_value = Mock(rc=0, mid=1)
+            publisher.connected.set()
+
+            async def replay():
+                task = asyncio.create_task(publisher.replay_outbox(100))
+                while publisher.outbox.pending():
+                    await asyncio.sleep(0.01)
+                task.cancel()
+
+            asyncio.run(asyncio.wait_for(replay(), 5))
+            topics = {
+                c.args[0]: c.args[1] for c in publisher.client.publish.call_args_list
+            }
+            self.assertIn("solarmax/PAC", topics)
+            attributes = json.loads(topics["solarmax/attributes"])
+            self.assertLess(attributes["timestamp"], time.time())
+
+    def test_dropped_publish_goes_to_outbox(self):
+        """Test that a reading whose messages were dropped is stored."""
+        with tempfile.TemporaryDirectory() as directory:
+            publisher = HomeAssistantMQTTPublisher(
+                {
+                    "device_id": "inv",
+                    "device_name": "Inverter",
+                    "mqtt_topic_prefix": "solarmax",
+                    "availability_topic": "solarmax/availability",
+                    "home_assistant_discovery": False,
+                    "outbox_dir": directory,
+                }
+            )
+            publisher.client = Mock()
+            publisher.client.publish.return_value = Mock(rc=4, mid=1)  # No connection
+            publisher.connected.set()
+            data = convert_to_json(FIELD_MAP_INVERTER, "x:PAC=7D0|")
+            self.assertTrue(publisher.publish_data(data))
+            self.assertEqual(len(publisher.outbox.read_batch(10)), 1)
+
+    def test_metrics_render(self):
+        """Test the Prometheus text format of counters and histograms."""
+        metrics = Metrics()
+        metrics.inc("solarmax_polls_total", device="inv")
+        self.assertEqual(metrics.render(), "\n")  # Disabled by default
+
+        metrics.enabled = True
+        metrics.inc("solarmax_polls_total", device="inv")
+        metrics.inc("solarmax_polls_total", device="inv")
+        metrics.set("solarmax_value", 2500.0, device="inv", field="PAC")
+        metrics.observe("solarmax_read_seconds", 0.02, inverter="a")
+        metrics.observe("solarmax_read_seconds", 20, inverter="a")
+        text = metrics.render()
+
+        self.assertIn("# TYPE solarmax_polls_total counter", text)
+        self.assertIn('solarmax_polls_total{device="inv"} 2', text)
+        self.assertIn('solarmax_value{device="inv",field="PAC"} 2500', text)
+        self.assertIn('solarmax_read_seconds_bucket{inverter="a",le="0.01"} 0', text)
+        self.assertIn('solarmax_read_seconds_bucket{inverter="a",le="0.025"} 1', text)
+        self.assertIn('solarmax_read_seconds_bucket{inverter="a",le="+Inf"} 2', text)
+        self.assertIn('solarmax_read_seconds_count{inverter="a"} 2', text)
+        self.assertIn('solarmax_read_seconds_sum{inverter="a"} 20.02', text)
+
+    def test_metrics_from_workers(self):
+        """Test that the supervisor serves the metrics of its workers."""
+        worker = Metrics()
+        worker.enabled = True
+        worker.inc("solarmax_polls_total", device="inv")
+        worker.observe("solarmax_poll_seconds", 0.2, device="inv")
+        worker.set("solarmax_up", 0, device="inv")
+        supervisor = Metrics()
+        supervisor.enabled = True
+        supervisor.set("solarmax_up", 1, device="inv")
+        supervisor.remote["0"] = pickle.loads(pickle.dumps(worker.snapshot()))
+        text = supervisor.render()
+
+        self.assertIn('solarmax_polls_total{device="inv"} 1', text)
+        self.assertIn('solarmax_poll_seconds_count{device="inv"} 1', text)
+        self.assertIn('solarmax_up{device="inv"} 1', text)  # Recorded locally
+        self.assertNotIn("solarmax_poll_seconds", supervisor.histograms)
+
+    def test_status_server_routes(self):
+        """Test that the HTTP server dispatches GET requests by path prefix."""
+
+        async def fetch(port, request):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(request)
+            response = await reader.read()
+            writer.close()
+            return response.decode()
+
+        async def scenario():
+            server = StatusServer("127.0.0.1", 0)
+            server.add_route("/metrics", lambda path, query: (200, "text/plain", b"ok"))
+            await server.start()
+            port = server.server.sockets[0].getsockname()[1]
+            responses = [
+                await fetch(port, b"GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n"),
+                await fetch(port, b"GET /other HTTP/1.1\r\n\r\n"),
+                await fetch(port, b"POST /metrics HTTP/1.1\r\n\r\n"),
+            ]
+            await server.close()
+            return responses
+
+        ok, missing, post = asyncio.run(scenario())
+        self.assertTrue(ok.startswith("HTTP/1.1 200 OK"))
+        self.assertTrue(ok.endswith("\r\n\r\nok"))
+        self.assertIn("404", missing.splitlines()[0])
+        self.assertIn("405", post.splitlines()[0])
+
+    def test_sink_record_serializations(self):
+        """Test the line protocol, NDJSON and CSV forms of a reading."""
+        data = convert_to_json(FIELD_MAP_INVERTER, "x:PAC=7D0;SYS=4E21,0;KT0=4D2|")
+        record = SinkRecord({"device_id": "roof east"}, data, 1700000000.5)
+
+        self.assertEqual(
+            record.to_line_protocol(),
+            "solarmax,device=roof\\ east PAC=1000.0,SYS=20001i,KT0=1234i "
+            "1700000000500000000",
+        )
+        self.assertEqual(json.loads(record.to_json())["values"]["PAC"], 1000.0)
+        self.assertIn("1700000000.5,roof east,SYS,In Betrieb", record.to_csv())
+        # Serialized once and shared between sinks
+        self.assertIs(record.to_json(), record.to_json())
+
+    def test_fan_out_isolates_slow_sinks(self):
+        """Test that a stalled sink drops its oldest readings without blocking others."""
+
+        class CollectingSink(Sink):
+            def __init__(self, name, delay=0):
+                super().__init__(name)
+                self.delay = delay
+                self.records = []
+
+            async def write(self, records):
+                await asyncio.sleep(self.delay)
+                self.records.extend(records)
+
+        fast = CollectingSink("fast")
+        slow = CollectingSink("slow", delay=10)
+
+        async def scenario():
+            fan_out = FanOut([fast, slow], queue_size=3)
+            fan_out.start()
+            for value in range(10):
+                fan_out.publish_data({"PAC": {"Value": value}}, {"device_id": "inv"})
+                await asyncio.sleep(0)
+            await asyncio.sleep(0.05)
+            depth = fan_out.queues["slow"].qsize()
+            await fan_out.close(timeout=0.1)
+            return depth
+
+        depth = asyncio.run(scenario())
+        self.assertEqual(
+            [r.data["PAC"]["Value"] for r in fast.records], list(range(10))
+        )
+        self.assertEqual(slow.records, [])
+        self.assertEqual(depth, 3)
+
+    def test_file_sink_rotation(self):
+        """Test that the file sink writes CSV with a header and rotates."""
+        data = convert_to_json(FIELD_MAP_INVERTER, "x:PAC=7D0|")
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, "readings.csv")
+            sink = FileSink(file_path, "csv", max_bytes=100, backups=2)
+            records = [
+                SinkRecord({"device_id": "inv"}, data, float(t)) for t in range(12)
+            ]
+
+            async def scenario():
+                for record in records:
+                    await sink.write([record])
+
+            asyncio.run(scenario())
+            with open(file_path + ".1") as f:
+                self.assertTrue(f.readline().startswith("timestamp,device,field,value"))
+            self.assertTrue(os.path.exists(file_path + ".2"))
+            self.assertFalse(os.path.exists(file_path + ".3"))
+
+    def test_history_store_rollups(self):
+        """Test storing samples, rolling them up and querying ranges."""
+        now = int(time.time()) - 3600
+        start = now - now % 900
+        with tempfile.TemporaryDirectory() as directory:
+            store = HistoryStore(directory, ["PAC"])
+            for second in range(1800):
+                store.append("inv", "PAC", start + second, float(second % 60))
+            store.write_rows(store.take_rows())
+            # One sample after the flush is still buffered
+            store.append("inv", "PAC", start + 1800, 5.0)
+
+            resolution, rows = store.query("inv", "PAC", start, start + 1801)
+            self.assertEqual(resolution, "raw")
+            self.assertEqual(len(rows), 1801)
+            self.assertEqual(rows[61], (start + 61, 1.0))
+
+            _, minutes = store.query("inv", "PAC", start, start + 1800, "1m")
+            self.assertEqual(len(minutes), 30)  # Closed by the buffered sample
+            self.assertEqual(minutes[0], (start, 0.0, 59.0, 29.5, 60))
+
+            # Closing stores the open buckets, which merge with later rows
+            store.close_buckets()
+            store.write_rows(store.take_rows())
+            reopened = HistoryStore(directory, ["PAC"])
+            reopened.append("inv", "PAC", start + 1801, 7.0)
+            reopened.close_buckets()
+            _, quarters = reopened.query("inv", "PAC", start, start + 2700, "15m")
+            self.assertEqual(
+                [row[0] for row in quarters], [start, start + 900, start + 1800]
+            )
+            self.assertEqual(quarters[2][1:], (5.0, 7.0, 6.0, 2))
+
+    def test_history_store_expiry(self):
+        """Test that partitions older than their retention are deleted."""
+        with tempfile.TemporaryDirectory() as directory:
+            store = HistoryStore(directory, ["PAC"], {"raw": 2})
+            day = 86400
+            now = int(time.time())
+            for days_ago in (0, 1, 5):
+                store.append("inv", "PAC", now - days_ago * day, 1.0)
+            store.last_expiry = now  # Expire below, not while writing
+            store.write_rows(store.take_rows())
+            listed = os.listdir(os.path.join(directory, "inv", "PAC", "raw"))
+            store.expire()
+            _, rows = store.query("inv", "PAC", now - 10 * day, now + 1, "raw")
+            self.assertEqual(len(rows), 2)
+
+            # A partition expired between listing and reading is skipped
+            with patch("agent.listdir", return_value=listed):
+                _, rows = store.query("inv", "PAC", now - 10 * day, now + 1, "raw")
+            self.assertEqual(len(rows), 2)
+
+    def test_latest_readings_api(self):
+        """Test the latest and history routes and their per-cycle cache."""
+        now = int(time.time()) // 60 * 60  # Samples fill whole minutes
+        with tempfile.TemporaryDirectory() as directory:
+            history = HistoryStore(directory, ["PAC"])
+            for second in range(120):
+                history.append("inv", "PAC", now - 120 + second, 1.1)
+            latest = LatestReadings(history)
+            data = convert_to_json(FIELD_MAP_INVERTER, "x:PAC=7D0;SYS=4E21,0|")
+            record = SinkRecord({"device_id": "inv"}, data, now)
+            asyncio.run(latest.write([record]))
+
+            status, _, body = latest.route("/latest", {})
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body)["inv"]["values"]["SYS"], "In Betrieb")
+            status, _, body = latest.route("/latest/PAC", {})
+            self.assertEqual(json.loads(body)["inv"]["value"], 1000.0)
+            self.assertEqual(json.loads(body)["inv"]["unit"], "W")
+            # Served from the cache until the next reading
+            self.assertIs(latest.route("/latest/PAC", {})[2], body)
+            self.assertEqual(latest.route("/latest/XYZ", {})[0], 404)
+
+            query = {
+                "field": "PAC",
+                "from": str(now - 120),
+                "to": str(now),
+                "step": "60",
+            }
+            status, _, body = latest.route("/history", query)
+            document = json.loads(body)
+            self.assertEqual(document["columns"][0], "timestamp")
+            self.assertEqual(sum(row[4] for row in document["rows"]), 120)
+            self.assertEqual(document["rows"][0][3], 1.1)
+            self.assertEqual(latest.route("/history", {"step": "x"})[0], 400)
+
+            asyncio.run(latest.write([record]))
+            self.assertIsNot(latest.route("/latest/PAC", {})[2], body)
+
+    def test_status_events(self):
+        """Test alarm binary sensors and edge-triggered status events."""
+        publisher = HomeAssistantMQTTPublisher(
+            {
+                "device_id": "inv",
+                "device_name": "Inverter",
+                "mqtt_topic_prefix": "solarmax",
+                "availability_topic": "solarmax/availability",
+                "discovery_prefix": "homeassistant",
+                "status_events": True,
+            }
+        )
+        publisher.client = Mock()
+        publisher.client.publish.return_value = Mock(rc=0, mid=1)
+        publisher.connected.set()
+
+        def publish(status, alarms, timestamp):
+            publisher.client.publish.reset_mock()
+            data = {
+                "SYS": {"Value": map_data_value("SYS", status), "Raw Value": status},
+                "SAL": {"Value": map_data_value("SAL", alarms), "Raw Value": alarms},
+            }
+            publisher._publish_reading(data, publisher.config, timestamp)
+            return publisher.client.publish.call_args_list
+
+        # The first reading sets every alarm sensor and raises no event
+        calls = publish(20004, 0, 1000.0)
+        topics = {c.args[0]: c.args[1] for c in calls}
+        self.assertEqual(topics["solarmax/alarm/256"], "OFF")
+        self.assertNotIn("solarmax/events", topics)
+        alarm_config = json.loads(
+            topics["homeassistant/binary_sensor/inv/alarm_256/config"]
+        )
+        self.assertEqual(alarm_config["device_class"], "problem")
+        self.assertEqual(alarm_config["state_topic"], "solarmax/alarm/256")
+        event_config = json.loads(topics["homeassistant/event/inv/events/config"])
+        self.assertIn("status_change", event_config["event_types"])
+
+        # Unchanged values publish no alarm states or events
+        calls = publish(20004, 0, 1030.0)
+        self.assertFalse([c for c in calls if "/alarm/" in c.args[0]])
+
+        # Two alarms and a new status at once
+        calls = publish(20007, 2 | 256, 1060.0)
+        alarms = {c.args[0]: c.args[1] for c in calls if "/alarm/" in c.args[0]}
+        self.assertEqual(alarms, {"solarmax/alarm/2": "ON", "solarmax/alarm/256": "ON"})
+        events = [json.loads(c.args[1]) for c in calls if c.args[0].endswith("events")]
+        self.assertEqual(
+            [event["event_type"] for event in events],
+            ["status_change", "alarm_raised", "alarm_raised"],
+        )
+        self.assertEqual(events[0]["from"], "Betrieb auf MPP")
+        self.assertEqual(events[0]["to_code"], 20007)
+        self.assertEqual(events[0]["timestamp"], 1060.0)
+        self.assertEqual(events[2]["alarm"], "Ventilator defekt")
+        self.assertFalse(
+            [c for c in calls if c.args[0].endswith("events") and c.kwargs["retain"]]
+        )
+
+        # Losing the inverter keeps the alarms, clearing one is an event
+        calls = publish(20000, 0, 1090.0)
+        self.assertFalse([c for c in calls if "/alarm/" in c.args[0]])
+        calls = publish(20004, 2, 1120.0)
+        events = [json.loads(c.args[1]) for c in calls if c.args[0].endswith("events")]
+        self.assertEqual(
+            [(event["event_type"], event.get("code")) for event in events],
+            [("status_change", None), ("alarm_cleared", 256)],
+        )
+
+    def test_derived_metrics_published_and_discovered(self):
+        """Test that derived sensors are published like native ones."""
+        response = build_frame("01", "FB", "64:PAC=1C20;PDC=1F40;KDY=64").encode()
+
+        async def handle(reader, writer):
+            await reader.read(1024)
+            writer.write(response)
+            await writer.drain()
+
+        async def scenario():
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            publisher = HomeAssistantMQTTPublisher(
+                {
+                    "device_id": "inv",
+                    "device_name": "Inverter",
+                    "mqtt_topic_prefix": "solarmax",
+                    "availability_topic": "solarmax/availability",
+                    "discovery_prefix": "homeassistant",
+                }
+            )
+            publisher.client = Mock()
+            publisher.client.publish.return_value = Mock(rc=0, mid=1)
+            publisher.connected.set()
+            inverter = build_inverter_list(
+                {
+                    "inverter_ip": "127.0.0.1",
+                    "inverter_port": server.sockets[0].getsockname()[1],
+                    "update_interval": 30,
+                    "device_id": "inv",
+                    "device_name": "Inverter",
+                    "mqtt_topic_prefix": "solarmax",
+                    "availability_topic": "solarmax/availability",
+                }
+            )[0]
+            field_map = {"PAC": "AC Power", "PDC": "DC Power", "KDY": "Energy"}
+            poller = InverterPoller(
+                inverter, publisher, field_map, derived=DerivedMetrics()
+            )
+            await poller.poll_once()
+            server.close()
+            return publisher.client.publish.call_args_list
+
+        calls = asyncio.run(scenario())
+        topics = {c.args[0]: c.args[1] for c in calls}
+        self.assertEqual(topics["solarmax/EFF"], "90.0")
+        config = json.loads(topics["homeassistant/sensor/inv/eff/config"])
+        self.assertEqual(config["unit_of_measurement"], "%")
+        self.assertEqual(config["state_class"], "measurement")
+        self.assertIn("solarmax/EDAY", topics)
+
+    def test_sun_times(self):
+        """Test sunrise and sunset against known times for Berlin."""
+        sunrise, sunset = sun_times(52.52, 13.405, datetime.date(2026, 6, 21))
+        midnight = calendar.timegm((2026, 6, 21, 0, 0, 0))
+        self.assertAlmostEqual(sunrise - midnight, 2 * 3600 + 43 * 60, delta=180)
+        self.assertAlmostEqual(sunset - midnight, 19 * 3600 + 33 * 60, delta=180)
+        self.assertIsNone(sun_times(78.2, 15.6, datetime.date(2026, 12, 21)))
+
+    def test_adaptive_polling(self):
+        """Test night backoff, daytime retries and fast polling during ramps."""
+        midnight = calendar.timegm((2026, 6, 21, 0, 0, 0))
+        sleeping = {"SYS": {"Raw Value": 20000}}
+        adaptive = AdaptivePolling(1800, 52.52, 13.405)
+
+        # 23:00 UTC: back off, but never beyond 30 minutes before sunrise
+        intervals = [adaptive.after_idle(30, midnight - 3600) for _ in range(6)]
+        self.assertEqual(intervals[:5], [60, 120, 240, 480, 960])
+        self.assertEqual(intervals[5], 1800)
+        wake = adaptive.after_reading(sleeping, 30, midnight + 2 * 3600)
+        self.assertAlmostEqual(wake, 12 * 60, delta=180)
+
+        # Daylight: retry at least every minute
+        self.assertEqual(adaptive.after_idle(30, midnight + 12 * 3600), 60)
+
+        # Without coordinates the plain backoff applies
+        plain = AdaptivePolling(300)
+        self.assertEqual([plain.after_idle(30, 0) for _ in range(5)][-1], 300)
+        # A long night of idle readings keeps the interval at the maximum
+        idle = generate_empty_data(FIELD_MAP_INVERTER)
+        for _ in range(2000):
+            interval = plain.after_reading(idle, 28.7, 0)
+        self.assertEqual(interval, 300)
+
+        noon = midnight + 12 * 3600
+        running = AdaptivePolling()
+        reading = {"SYS": {"Raw Value": 20004}, "PAC": {"Value": 1000.0}}
+        self.assertEqual(running.after_reading(reading, 30, noon), 30)
+        reading["PAC"]["Value"] = 1500.0
+        self.assertEqual(running.after_reading(reading, 30, noon + 30), 5)
+        self.assertEqual(running.after_reading(reading, 30, noon + 300), 30)
+
+    def test_derived_metrics(self):
+        """Test derived sensors, energy integration and the daily reset."""
+        noon = time.mktime((2026, 6, 21, 12, 0, 0, 0, 0, -1))
+
+        def reading(pac, pdc, pd01, pd02, kdy):
+            values = {"PAC": pac, "PDC": pdc, "PD01": pd01, "PD02": pd02, "KDY": kdy}
+            return {field: {"Value": value} for field, value in values.items()}
+
+        derived = DerivedMetrics(installed_power=5000)
+        first = derived.update(reading(3600, 4000, 2400, 1600, 10000), noon)
+        self.assertEqual(first["EFF"]["Value"], 90.0)
+        self.assertEqual(first["SIMB"]["Value"], 33.3)
+        self.assertEqual(first["SPY"]["Value"], 2.0)
+        self.assertEqual(first["EDAY"]["Value"], 10000)
+        self.assertEqual(first["PAVG"]["Value"], 3600)
+        self.assertEqual(first["EFF"]["Description"], "DC_AC_Efficiency (%)")
+
+        # One minute at 3600 W adds 60 Wh until KDY catches up
+        second = derived.update(reading(3600, 4000, 2000, 2000, 10000), noon + 60)
+        self.assertAlmostEqual(second["EDAY"]["Value"], 10060, delta=0.1)
+        self.assertEqual(second["SIMB"]["Value"], 0.0)
+        third = derived.update(reading(1200, 1300, 600, 600, 10050), noon + 120)
+        self.assertGreaterEqual(third["EDAY"]["Value"], second["EDAY"]["Value"])
+        self.assertEqual(third["PMAX"]["Value"], 3600)
+        self.assertLess(third["PAVG"]["Value"], 3600)
+        self.assertGreater(third["PAVG"]["Value"], 1200)
+
+        # Night: no division by zero, and the next day starts afresh
+        night = derived.update(reading(0, 0, 0, 0, 10050), noon + 10 * 3600)
+        self.assertEqual(night["EFF"]["Value"], 0.0)
+        morning = derived.update(reading(100, 110, 50, 50, 0), noon + 20 * 3600)
+        self.assertEqual(morning["PMAX"]["Value"], 100)
+        self.assertLess(morning["EDAY"]["Value"], 100)
+
+        # Without the installed power there is no specific yield
+        self.assertNotIn("SPY", DerivedMetrics().update(reading(1, 1, 1, 1, 1), noon))
+
     def test_map_data_value(self):
         """Test data value mapping."""
         # Test power value (should be divided by 2)
@@ -71,6 +1422,10 @@ class TestSolarmaxAgent(unittest.TestCase):
 
         # Test alarm code
         self.assertEqual(map_data_value("SAL", 0), "kein Fehler")
+        self.assertEqual(
+            map_data_value("SAL", 2 | 256),
+            "Isolationsfehler DC-Seite, Ventilator defekt",
+        )
 
         # Test unknown status
         self.assertEqual(map_data_value("SYS", 99999), "Unknown Status Code")
@@ -101,6 +1456,62 @@ class TestSolarmaxAgent(unittest.TestCase):
         self.assertEqual(result["PAC"]["Value"], 4000.0)  # 0x1F40 / 2
         self.assertEqual(result["SAL"]["Value"], "kein Fehler")  # 0 = no error
 
+    def test_decode_values_from_bytes(self):
+        """Test decoding replies from bytes, bytearray and memoryview."""
+        frame = build_frame("01", "FB", "64:PAC=1F40;SYS=4E21,0;KT0=4d2").encode()
+        expected = {"PAC": 0x1F40, "SYS": 0x4E21, "KT0": 0x4D2}
+        self.assertEqual(decode_values(frame), expected)
+        self.assertEqual(decode_values(bytearray(frame)), expected)
+        self.assertEqual(decode_values(memoryview(frame)), expected)
+        self.assertEqual(decode_values(b"garbage"), {})
+
+    def test_reading(self):
+        """Test the compact reading against the dict format."""
+        schema = ReadingSchema(FIELD_MAP_INVERTER)
+        frames = [
+            build_frame("01", "FB", "64:PAC=1F40;SYS=4E21,0").encode(),
+            b"",
+            build_frame("01", "FB", "64:KT0=4D2;XYZ=5").encode(),
+        ]
+        reading = decode_reading(schema, frames)
+        expected = convert_to_json(FIELD_MAP_INVERTER, "x:PAC=1F40;SYS=4E21,0;KT0=4D2|")
+        expected["XYZ"] = {"Value": 5, "Description": "XYZ", "Raw Value": 5}
+        self.assertEqual(reading, expected)
+        self.assertEqual(reading.to_dict(), expected)
+        self.assertEqual(set(reading), {"SYS", "PAC", "KT0", "XYZ"})
+        self.assertEqual(len(reading), 4)
+        self.assertNotIn("PDC", reading)
+        self.assertEqual(reading.value("PAC"), 4000.0)
+        self.assertEqual(reading.raw_value("SYS"), 20001)
+        self.assertIsNone(reading.value("PDC"))
+        self.assertIs(Reading.of(reading), reading)
+        self.assertEqual(Reading.of(expected), reading)
+
+        # Merging builds a new reading and keeps the shared schema
+        update = decode_reading(
+            schema, [build_frame("01", "FB", "64:PAC=7D0").encode()]
+        )
+        merged = reading.merged(update)
+        self.assertEqual(merged.value("PAC"), 1000.0)
+        self.assertEqual(merged.value("KT0"), 1234)
+        self.assertEqual(reading.value("PAC"), 4000.0)
+        known = decode_reading(schema, [build_frame("01", "FB", "64:KDY=1").encode()])
+        self.assertIs(known.merged(update).schema, schema)
+
+        # Offline data leaves the last reading untouched
+        offline = generate_empty_data(FIELD_MAP_INVERTER, merged)
+        self.assertEqual(offline.value("SYS"), "Keine Kommunikation")
+        self.assertEqual(offline.value("PAC"), 0.0)
+        self.assertEqual(offline.value("KT0"), 1234)
+        self.assertEqual(merged.value("SYS"), "In Betrieb")
+        self.assertEqual(merged.value("PAC"), 1000.0)
+        last = convert_to_json(FIELD_MAP_INVERTER, "x:PAC=1F40;SYS=4E21,0|")
+        generate_empty_data(FIELD_MAP_INVERTER, last)
+        self.assertEqual(last["PAC"]["Value"], 4000.0)
+        fresh = generate_empty_data({"SYS": "Status", "PAC": "Power"})
+        self.assertEqual(fresh.raw_value("SYS"), 20000)
+        self.assertEqual(fresh.value("PAC"), 0)
+
     def test_field_map_completeness(self):
         """Test that field map contains expected fields."""
         expected_fields = [